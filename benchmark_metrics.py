@@ -0,0 +1,202 @@
+"""Compare the metrics of a task computed from its columns loaded once with the former
+query per metric, on the configured database.
+
+Runs on a temporary SQLite file unless DB_BACKEND is set, DB_BACKEND=mysql measures
+the MySQL path. Each run adds a generated streaming task with the given number of
+requests, measures task_metrics both ways and deletes the task.
+
+python benchmark_metrics.py [requests ...]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+os.environ.setdefault("DB_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "benchmark.db"))
+
+from helper import get_analytics, get_engine, get_mysql_session
+from tables import (
+    Base,
+    Chunks,
+    Requests,
+    Tasks,
+    add_task_partitions,
+    delete_task_tables,
+    partition_result_tables,
+    task_table,
+)
+from task_loads import sql_query
+from task_metrics import report_values, task_metrics
+from config import SQL_FETCH_ROWS
+
+chunks_per_request = 16
+
+# the queries task_metrics ran before, one per metric, dividing by 1000.0 so SQLite
+# buckets times like MySQL does
+former_chunk_queries = {
+    "Threads Per Sec": "SELECT ROUND((created_at / 1000.0)) AS timestamp_seconds, COUNT(DISTINCT thread_num) AS request_count FROM {chunks} GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
+    "Threads Per Minute": "SELECT ROUND((created_at / 60000.0)) AS timestamp_seconds, COUNT(DISTINCT thread_num) AS request_count FROM {chunks} GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
+    "Output Token Per Sec": "SELECT ROUND((created_at / 1000.0)) AS timestamp_seconds, sum(token_len) AS token_count FROM {chunks} WHERE token_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
+    "Output Token Per Minute": "SELECT ROUND((created_at / 60000.0)) AS timestamp_seconds, sum(token_len) AS token_count FROM {chunks} WHERE token_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
+    "Output Characters Per Sec": "SELECT ROUND((created_at / 1000.0)) AS timestamp_seconds, sum(characters_len) AS characters_count FROM {chunks} WHERE characters_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
+    "Output Characters Per Minute": "SELECT ROUND((created_at / 60000.0)) AS timestamp_seconds, sum(characters_len) AS characters_count FROM {chunks} WHERE characters_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
+}
+former_request_queries = {
+    "Concurrency": "SELECT COUNT(DISTINCT thread_num) AS request_count FROM {requests}",
+    "Requests Per Sec": "SELECT ROUND((created_at / 1000.0)) AS timestamp_seconds, COUNT(DISTINCT id) AS request_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
+    "Request Per Minute": "SELECT ROUND((created_at / 60000.0)) AS timestamp_seconds, COUNT(DISTINCT id) AS request_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
+    "Input Token Per Sec": "SELECT ROUND((start_req_time / 1000.0)) AS timestamp_seconds, sum(input_token_count) AS input_token_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
+    "Input Token Per Minute": "SELECT ROUND((start_req_time / 60000.0)) AS timestamp_seconds, sum(input_token_count) AS input_token_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
+    "Time To First Token (TTFT) Per Request": "SELECT first_token_latency_ms FROM {requests} WHERE first_token_latency_ms is not null;",
+    "Time To First Token (TTFT) Per Request, Corrected": "SELECT first_token_latency_ms + (start_req_time - scheduled_req_time) FROM {requests} WHERE first_token_latency_ms is not null and scheduled_req_time is not null;",
+    "Time Between Tokens (TBT) Per Request": "SELECT last_token_latency_ms FROM {requests} WHERE last_token_latency_ms is not null;",
+    "Request Latency Per Request": "SELECT request_latency_ms FROM {requests} WHERE request_latency_ms is not null;",
+    "Request Latency Per Request, Corrected": "SELECT end_req_time - scheduled_req_time FROM {requests} WHERE request_latency_ms is not null and scheduled_req_time is not null;",
+    "Harness Lag Per Request": "SELECT start_req_time - scheduled_req_time FROM {requests} WHERE start_req_time is not null and scheduled_req_time is not null;",
+    "Input Token Per Request": "SELECT input_token_count FROM {requests} WHERE success = 1 and input_token_count is not null;",
+    "Chunks Per Request": "SELECT chunks_count FROM {requests} WHERE success = 1 and chunks_count is not null;",
+    "Output Token Per Request": "SELECT output_token_count FROM {requests} WHERE success = 1 and output_token_count is not null;",
+}
+
+
+def sample_rows(
+    task_id: int,
+    count: int,
+    threads: int = 200,
+    seconds: int = 600,
+) -> tuple:
+    """Requests of a task sent by the threads over the seconds, and their chunks."""
+    rng = np.random.default_rng(0)
+    started = 1741572000000
+
+    start = np.sort(rng.integers(started, started + seconds * 1000, count))
+    scheduled = start - rng.integers(0, 50, count)
+    first_token = rng.integers(50, 500, count)
+    latency = first_token + rng.integers(500, 5000, count)
+    end = start + latency
+    thread_num = rng.integers(1, threads + 1, count)
+    success = (rng.random(count) < 0.95).astype(int)
+    input_tokens = rng.integers(100, 2000, count)
+    output_tokens = rng.integers(50, 500, count)
+
+    requests = [
+        {
+            "task_id": task_id,
+            "id": str(index),
+            "thread_num": int(thread_num[index]),
+            "success": int(success[index]),
+            "created_at": int(end[index]),
+            "start_req_time": int(start[index]),
+            "scheduled_req_time": int(scheduled[index]),
+            "end_req_time": int(end[index]),
+            "first_token_latency_ms": int(first_token[index]),
+            "last_token_latency_ms": int(latency[index] - first_token[index]),
+            "request_latency_ms": int(latency[index]),
+            "input_token_count": int(input_tokens[index]),
+            "output_token_count": int(output_tokens[index]),
+            "chunks_count": chunks_per_request,
+        }
+        for index in range(count)
+    ]
+
+    request_index = np.repeat(np.arange(count), chunks_per_request)
+    created_at = start[request_index] + (
+        first_token[request_index]
+        + rng.random(len(request_index)) * (latency - first_token)[request_index]
+    ).astype(np.int64)
+    token_len = rng.integers(0, 3, len(request_index))
+    characters_len = rng.integers(0, 12, len(request_index))
+
+    chunks = [
+        {
+            "task_id": task_id,
+            "id": str(index),
+            "request_id": str(request_index[index]),
+            "thread_num": int(thread_num[request_index[index]]),
+            "created_at": int(created_at[index]),
+            "token_len": int(token_len[index]),
+            "characters_len": int(characters_len[index]),
+        }
+        for index in range(len(request_index))
+    ]
+
+    return requests, chunks
+
+
+def add_task(count: int) -> Tasks:
+    session = get_mysql_session()
+    try:
+        task = Tasks(name=f"benchmark {count}", model_id="gpt-4o", threads=200)
+        session.add(task)
+        session.commit()
+        session.refresh(task)
+        session.expunge(task)
+    finally:
+        session.close()
+
+    add_task_partitions(task.id)
+    requests, chunks = sample_rows(task.id, count)
+    with get_engine().begin() as conn:
+        conn.execute(Requests.__table__.insert(), requests)
+        conn.execute(Chunks.__table__.insert(), chunks)
+    return task
+
+
+def delete_task(task: Tasks):
+    delete_task_tables(task.id)
+    with get_engine().begin() as conn:
+        conn.execute(Tasks.__table__.delete().where(Tasks.__table__.c.id == task.id))
+
+
+def former_metrics(task: Tasks) -> dict:
+    tables = {
+        "requests": task_table("requests", task.id),
+        "chunks": task_table("chunks", task.id),
+    }
+    return {
+        name: report_values([int(item[-1]) for item in sql_query(sql.format(**tables))])
+        for name, sql in {**former_chunk_queries, **former_request_queries}.items()
+    }
+
+
+def measure(task: Tasks, metrics) -> tuple:
+    started = time.perf_counter()
+    result = metrics(task)
+    return (time.perf_counter() - started) * 1000, result
+
+
+if __name__ == "__main__":
+
+    counts = [int(count) for count in sys.argv[1:]] or [1000, 10000, 50000]
+
+    engine = get_engine()
+    Base.metadata.create_all(engine, tables=[Tasks.__table__])
+    partition_result_tables(engine)
+    # connect to DuckDB up front, so the first run does not time it
+    if engine.dialect.name == "sqlite" and get_analytics() is not None:
+        loaded = "read by DuckDB"
+    else:
+        loaded = f"streamed {SQL_FETCH_ROWS} rows at a time"
+
+    print(f"{engine.dialect.name}: task_metrics of a streaming task, columns {loaded}")
+    print(
+        f"{'requests':>10}{'chunks':>10}{'former ms':>12}{'columns ms':>12}{'speedup':>10}"
+    )
+    for count in counts:
+        task = add_task(count)
+        try:
+            former_ms, former = measure(task, former_metrics)
+            columns_ms, columns = measure(task, task_metrics)
+        finally:
+            delete_task(task)
+
+        differ = [name for name in former if former[name] != columns.get(name)]
+        if differ:
+            raise ValueError(f"Metrics of {count} requests differ: {differ}")
+
+        print(
+            f"{count:>10}{count * chunks_per_request:>10}{former_ms:>12.1f}{columns_ms:>12.1f}{former_ms / columns_ms:>9.1f}x"
+        )
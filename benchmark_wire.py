@@ -0,0 +1,100 @@
+"""Compare the msgpack wire format with the former JSON records.
+
+python benchmark_wire.py [records]
+"""
+
+import json
+import sys
+import time
+from types import SimpleNamespace
+import task_wire
+
+
+def sample_records(count: int):
+    chunk = SimpleNamespace(
+        id="0001000001000001",
+        task_id=1,
+        request_id="0001000001",
+        chunk_index=1,
+        thread_num=1,
+        chunk_content=" token",
+        token_len=1,
+        characters_len=6,
+        request_latency_ms=523.417,
+        tpot=None,
+        last_token_latency_ms=11.302,
+        created_at=1741572000523,
+        created_at_us=1741572000523417,
+    )
+    log = SimpleNamespace(
+        id="9a4f64b0-54d1-4be9-8d2e-2c6a3f4c2f1e",
+        task_id=1,
+        thread_num=1,
+        request_id="0001000001",
+        log_message="loop stream start",
+        log_data=None,
+        created_at=1741572000512,
+    )
+    request = SimpleNamespace(
+        **{field: None for field in task_wire.SCHEMA_FIELDS[task_wire.SCHEMA_REQUEST]}
+    )
+    request.id = "0001000001"
+    request.task_id = 1
+    request.response = "token " * 200
+    request.success = 1
+
+    # chunks outnumber logs and requests by far in a streamed task
+    records = []
+    for index in range(count):
+        if index % 50 == 0:
+            records.append((task_wire.SCHEMA_REQUEST, request))
+        elif index % 10 == 0:
+            records.append((task_wire.SCHEMA_LOG, log))
+        else:
+            records.append((task_wire.SCHEMA_CHUNK, chunk))
+    return records
+
+
+def json_encode(schema: int, record) -> bytes:
+    fields = task_wire.SCHEMA_FIELDS[schema]
+    return json.dumps({field: getattr(record, field) for field in fields}).encode()
+
+
+def json_decode(payload: bytes):
+    record = SimpleNamespace()
+    for key, value in json.loads(payload).items():
+        setattr(record, key, value)
+    return record
+
+
+def measure(records: list, encode, decode):
+    started = time.perf_counter()
+    payloads = [encode(schema, record) for schema, record in records]
+    encoded = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    decoded = time.perf_counter()
+
+    return {
+        "encode_us": (encoded - started) / len(records) * 1_000_000,
+        "decode_us": (decoded - encoded) / len(records) * 1_000_000,
+        "bytes": sum(len(payload) for payload in payloads) / len(records),
+    }
+
+
+if __name__ == "__main__":
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    records = sample_records(count)
+
+    results = {
+        "json": measure(records, json_encode, json_decode),
+        "msgpack": measure(records, task_wire.encode, task_wire.decode),
+    }
+
+    print(f"{count} records, per record:")
+    print(f"{'format':<10}{'encode µs':>12}{'decode µs':>12}{'bytes':>10}")
+    for name, result in results.items():
+        print(
+            f"{name:<10}{result['encode_us']:>12.2f}{result['decode_us']:>12.2f}{result['bytes']:>10.1f}"
+        )
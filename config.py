@@ -39,6 +39,178 @@ MODEL_TYPES = [
     MODEL_TYPE_API,
 ]
 
+ENGINE_THREAD = "Thread"
+ENGINE_ASYNCIO = "Asyncio"
+ENGINES = [
+    ENGINE_THREAD,
+    ENGINE_ASYNCIO,
+]
+
+LOAD_MODE_CLOSED = "Closed Loop"
+LOAD_MODE_OPEN = "Open Loop"
+LOAD_MODE_PROFILE = "Profile"
+LOAD_MODES = [
+    LOAD_MODE_CLOSED,
+    LOAD_MODE_OPEN,
+    LOAD_MODE_PROFILE,
+]
+
+# concurrency moves linearly from "from" to "to" over "duration" seconds
+DEFAULT_LOAD_PROFILE = [
+    {"name": "ramp", "duration": 300, "from": 10, "to": 500},
+    {"name": "hold", "duration": 1200, "from": 500, "to": 500},
+    {"name": "spike", "duration": 30, "from": 1000, "to": 1000},
+]
+
+TRANSPORT_SDK = "SDK"
+TRANSPORT_SSE = "Raw SSE"
+TRANSPORTS = [
+    TRANSPORT_SDK,
+    TRANSPORT_SSE,
+]
+TRANSPORT_SSE_MODEL_TYPES = [
+    MODEL_TYPE_AOAI,
+    MODEL_TYPE_API,
+]
+
+QUEUE_OVERFLOW_BACKPRESSURE = "Backpressure"
+QUEUE_OVERFLOW_SPILL = "Spill"
+QUEUE_OVERFLOWS = [
+    QUEUE_OVERFLOW_BACKPRESSURE,
+    QUEUE_OVERFLOW_SPILL,
+]
+
+RESULT_SINK_QUEUE = "Queue"
+RESULT_SINK_SPOOL = "Spool"
+RESULT_SINKS = [
+    RESULT_SINK_QUEUE,
+    RESULT_SINK_SPOOL,
+]
+
+CHUNK_STORAGE_PACKED = "Packed"
+CHUNK_STORAGE_ROWS = "Rows"
+CHUNK_STORAGES = [
+    CHUNK_STORAGE_PACKED,
+    CHUNK_STORAGE_ROWS,
+]
+
+TOKEN_COUNTING_INLINE = "Inline"
+TOKEN_COUNTING_DEFERRED = "Deferred"
+TOKEN_COUNTING_SERVER = "Server"
+TOKEN_COUNTINGS = [
+    TOKEN_COUNTING_INLINE,
+    TOKEN_COUNTING_DEFERRED,
+    TOKEN_COUNTING_SERVER,
+]
+
+TOKEN_SOURCE_CLIENT = "client"
+TOKEN_SOURCE_SERVER = "server"
+
+ARRIVAL_CONSTANT = "Constant"
+ARRIVAL_POISSON = "Poisson"
+ARRIVAL_BURSTY = "Bursty"
+ARRIVAL_DISTRIBUTIONS = [
+    ARRIVAL_CONSTANT,
+    ARRIVAL_POISSON,
+    ARRIVAL_BURSTY,
+]
+
+CONNECTION_WARM = "Warm"
+CONNECTION_COLD = "Cold"
+CONNECTION_MODES = [
+    CONNECTION_WARM,
+    CONNECTION_COLD,
+]
+
+# connection pool of the clients shared by requests in Warm connection mode, raised
+# to the task's threads when it runs more so requests never wait for a connection
+CLIENT_MAX_CONNECTIONS = int(os.getenv("CLIENT_MAX_CONNECTIONS", 2000))
+CLIENT_MAX_KEEPALIVE = int(os.getenv("CLIENT_MAX_KEEPALIVE", 2000))
+CLIENT_KEEPALIVE_EXPIRY = float(os.getenv("CLIENT_KEEPALIVE_EXPIRY", 60))
+
+# a request worker holds a shard lease while it runs it, and renews it every third of it
+SHARD_LEASE_MS = int(os.getenv("SHARD_LEASE_MS", 30000))
+# shards start this long after the last one was claimed, on the Redis clock
+SHARD_START_DELAY_MS = int(os.getenv("SHARD_START_DELAY_MS", 1000))
+# a task run by several processes starts this long after it was picked up, so every
+# process has spawned by then and schedules its requests from the same start
+PROCESS_START_DELAY_MS = int(os.getenv("PROCESS_START_DELAY_MS", 2000))
+# shards that are claimed start anyway if the others are not claimed in time
+SHARD_BARRIER_TIMEOUT = int(os.getenv("SHARD_BARRIER_TIMEOUT", 300))
+
+# tasks, users and results are stored in MySQL, or in the SQLITE_PATH file with the SQLite
+# backend for single-node and offline runs, whose task metrics are then computed by DuckDB
+DB_BACKEND_MYSQL = "mysql"
+DB_BACKEND_SQLITE = "sqlite"
+DB_BACKEND = os.getenv("DB_BACKEND", DB_BACKEND_MYSQL).lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "llmperf.db")
+# a SQLite write waits this many seconds at most for the lock held by another process
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 30))
+
+# every process shares one MySQL engine, whose pool keeps MYSQL_POOL_SIZE connections and
+# opens up to MYSQL_MAX_OVERFLOW more under load, a checkout waits MYSQL_POOL_TIMEOUT seconds
+# at most, and connections older than MYSQL_POOL_RECYCLE seconds are replaced
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 10))
+MYSQL_MAX_OVERFLOW = int(os.getenv("MYSQL_MAX_OVERFLOW", 20))
+MYSQL_POOL_TIMEOUT = int(os.getenv("MYSQL_POOL_TIMEOUT", 30))
+MYSQL_POOL_RECYCLE = int(os.getenv("MYSQL_POOL_RECYCLE", 3600))
+# MySQL caps a table at 8192 partitions, tasks created past it keep their results in a
+# shared partition and are deleted row by row
+MYSQL_MAX_PARTITIONS = int(os.getenv("MYSQL_MAX_PARTITIONS", 8192))
+# task metrics stream the rows of a task from the database and turn this many at a time
+# into numpy columns
+SQL_FETCH_ROWS = int(os.getenv("SQL_FETCH_ROWS", 10000))
+
+# request workers push results to Redis in pipelined batches of up to this many items,
+# at least every ENQUEUE_FLUSH_MS and as soon as a request completes
+ENQUEUE_BATCH_SIZE = int(os.getenv("ENQUEUE_BATCH_SIZE", 500))
+ENQUEUE_FLUSH_MS = int(os.getenv("ENQUEUE_FLUSH_MS", 50))
+# records a task's Redis queues hold by default, past it the task's producers wait
+# or spill records to segment files, as its queue overflow says
+QUEUE_LIMIT = int(os.getenv("QUEUE_LIMIT", 1000000))
+# producers block while this many records wait in their buffer for a full queue
+ENQUEUE_BUFFER_MAX = int(os.getenv("ENQUEUE_BUFFER_MAX", 10000))
+# a closing producer waits this many seconds at most for full queues to take its held
+# back items, then spills them to segment files
+ENQUEUE_CLOSE_TIMEOUT = int(os.getenv("ENQUEUE_CLOSE_TIMEOUT", 60))
+# spilled records are appended to segment files of up to SPILL_SEGMENT_RECORDS records
+# under this directory, which request and queue workers must share
+SPILL_DIR = os.getenv("SPILL_DIR", "spill")
+SPILL_SEGMENT_RECORDS = int(os.getenv("SPILL_SEGMENT_RECORDS", 10000))
+# tasks in Spool mode write their results to Arrow files under this directory, in record
+# batches of SPOOL_BATCH_ROWS rows, and queue workers load them once the run is over
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_BATCH_ROWS = int(os.getenv("SPOOL_BATCH_ROWS", 10000))
+# keep the loaded files for analysis with task_spool.read_spool, instead of deleting them
+SPOOL_KEEP = os.getenv("SPOOL_KEEP", "false").lower() == "true"
+
+# queue workers read up to this many items per queue and insert them with one statement
+# per table, and block up to INGEST_FLUSH_MS for new items once the queues are drained
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 1000))
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", 1000))
+# entries a queue worker did not acknowledge this long after reading them are claimed by
+# another worker, and dropped once they were delivered INGEST_MAX_DELIVERIES times
+INGEST_RECLAIM_IDLE_MS = int(os.getenv("INGEST_RECLAIM_IDLE_MS", 60000))
+INGEST_MAX_DELIVERIES = int(os.getenv("INGEST_MAX_DELIVERIES", 5))
+INGEST_RECLAIM_INTERVAL = 30
+# queue workers look for active tasks whose queues drained this often, in seconds
+INGEST_DRAIN_INTERVAL = 1
+# consumers with nothing pending that were idle this long are removed from the group
+INGEST_CONSUMER_IDLE_MS = 24 * 3600 * 1000
+# queue workers report their ingest rate this often, a report older than the TTL is dropped
+INGEST_RATE_INTERVAL = 10
+INGEST_RATE_TTL = 60
+# queue workers count stored requests in Redis, and one of them writes the counts
+# of each running task to MySQL at most this often
+TASK_COUNTS_FLUSH_MS = int(os.getenv("TASK_COUNTS_FLUSH_MS", 2000))
+
+# idle request workers block on task events, and look for queued tasks at least this often
+TASK_EVENT_TIMEOUT = int(os.getenv("TASK_EVENT_TIMEOUT", 30))
+TASK_EVENTS_MAX = 1000
+
+# interval of the asyncio event loop lag probe, in seconds
+LOOP_LAG_INTERVAL = 0.1
+
 MODEL_DEPLOYMENT_TYPES = [
     "Global Standard",
     "Data Zone Standard",
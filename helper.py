@@ -1,13 +1,29 @@
 import os
+import threading
+import time
 import uuid
+from contextlib import contextmanager
 from datetime import datetime
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 from dotenv import load_dotenv
 import re
 import streamlit as st
 from sqlalchemy import text
+from logger import logger
+from config import (
+    DB_BACKEND,
+    DB_BACKEND_SQLITE,
+    MYSQL_MAX_OVERFLOW,
+    MYSQL_POOL_RECYCLE,
+    MYSQL_POOL_SIZE,
+    MYSQL_POOL_TIMEOUT,
+    SQLITE_BUSY_TIMEOUT,
+    SQLITE_PATH,
+)
 
 
 load_dotenv()
@@ -19,6 +35,13 @@ database = os.getenv("MYSQL_DB")
 
 db_string = f"mysql+pymysql://{user}:{password}@{host}"
 sql_string = f"{db_string}/{database}"
+sqlite_string = f"sqlite:///{SQLITE_PATH}"
+
+engine = None
+engine_lock = threading.Lock()
+analytics = None
+session_factory = sessionmaker()
+checkout_stats = {"checkouts": 0, "wait_ms": 0.0, "max_wait_ms": 0.0}
 
 
 def format_milliseconds(timestamp_ms):
@@ -36,6 +59,12 @@ def pad_number(num1, num2):
 
 
 def create_db():
+    if DB_BACKEND == DB_BACKEND_SQLITE:
+        # the database file is created on first connect
+        os.makedirs(os.path.dirname(os.path.abspath(SQLITE_PATH)), exist_ok=True)
+        st.success(f"DB created")
+        return
+
     engine = create_engine(db_string)
     Session = sessionmaker(bind=engine)
     session = Session()
@@ -51,6 +80,7 @@ def create_db():
         st.error(f"DB create failed: {e}")
     finally:
         session.close()
+        engine.dispose()
 
 
 def check_username(s):
@@ -66,8 +96,156 @@ def time_now():
     return datetime.now().timestamp() * 1000
 
 
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long checkouts wait for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait_ms = (time.perf_counter() - started) * 1000
+            checkout_stats["checkouts"] += 1
+            checkout_stats["wait_ms"] += wait_ms
+            checkout_stats["max_wait_ms"] = max(checkout_stats["max_wait_ms"], wait_ms)
+
+
+def sqlite_pragmas(dbapi_connection, connection_record):
+    """Let readers run alongside the writer, SQLite files are shared by all processes."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    cursor.execute("PRAGMA synchronous=NORMAL;")
+    cursor.close()
+
+
+def create_sqlite_engine() -> Engine:
+    engine = create_engine(
+        sqlite_string,
+        poolclass=TimedQueuePool,
+        pool_size=MYSQL_POOL_SIZE,
+        max_overflow=MYSQL_MAX_OVERFLOW,
+        pool_timeout=MYSQL_POOL_TIMEOUT,
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT, "check_same_thread": False},
+    )
+    event.listen(engine, "connect", sqlite_pragmas)
+    return engine
+
+
+def create_mysql_engine() -> Engine:
+    return create_engine(
+        sql_string,
+        poolclass=TimedQueuePool,
+        pool_size=MYSQL_POOL_SIZE,
+        max_overflow=MYSQL_MAX_OVERFLOW,
+        pool_timeout=MYSQL_POOL_TIMEOUT,
+        pool_recycle=MYSQL_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
+def get_engine() -> Engine:
+    """Return the engine of the process, created on first use."""
+    global engine
+    if engine is None:
+        with engine_lock:
+            if engine is None:
+                if DB_BACKEND == DB_BACKEND_SQLITE:
+                    engine = create_sqlite_engine()
+                else:
+                    engine = create_mysql_engine()
+                session_factory.configure(bind=engine)
+    return engine
+
+
+def reset_engine():
+    """Drop the connections a forked child inherited, they belong to the parent."""
+    global analytics
+    if engine is not None:
+        engine.dispose(close=False)
+    analytics = None
+    checkout_stats.update(checkouts=0, wait_ms=0.0, max_wait_ms=0.0)
+
+
+os.register_at_fork(after_in_child=reset_engine)
+
+
 def get_mysql_session() -> Session:
-    return sessionmaker(bind=create_engine(sql_string))()
+    get_engine()
+    return session_factory()
+
+
+@contextmanager
+def session_scope():
+    """Provide a session that commits when the block succeeds and rolls back when it fails."""
+    session = get_mysql_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_analytics():
+    """Return the DuckDB database of the process, the SQLite file attached read only.
+
+    None when DuckDB cannot load its sqlite extension, which is downloaded on first use.
+    """
+    global analytics
+    if analytics is None:
+        with engine_lock:
+            if analytics is None:
+                try:
+                    import duckdb
+
+                    database = duckdb.connect()
+                    database.execute(
+                        f"ATTACH '{SQLITE_PATH}' AS results (TYPE sqlite, READ_ONLY);"
+                    )
+                    analytics = database
+                except Exception as e:
+                    logger.warning(f"DuckDB unavailable, metrics run on SQLite: {e}")
+                    analytics = False
+    return analytics or None
+
+
+def analytics_query(sql: str) -> list:
+    """Run a query of the result tables in DuckDB, which scans their columns in parallel."""
+    cursor = get_analytics().cursor()
+    try:
+        cursor.execute("USE results;")
+        return cursor.execute(sql).fetchall()
+    finally:
+        cursor.close()
+
+
+def analytics_columns(sql: str) -> dict:
+    """Run a query of the result tables in DuckDB, returning numpy arrays by column."""
+    cursor = get_analytics().cursor()
+    try:
+        cursor.execute("USE results;")
+        return cursor.execute(sql).fetchnumpy()
+    finally:
+        cursor.close()
+
+
+def pool_status() -> dict:
+    """Return the size and checkout wait times of the process's connection pool."""
+    pool = get_engine().pool
+    checkouts = checkout_stats["checkouts"]
+    return {
+        "pool_size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checked_in": pool.checkedin(),
+        "checkouts": checkouts,
+        "avg_wait_ms": (
+            round(checkout_stats["wait_ms"] / checkouts, 3) if checkouts else 0
+        ),
+        "max_wait_ms": round(checkout_stats["max_wait_ms"], 3),
+    }
 
 
 def data_id():
@@ -0,0 +1,67 @@
+"""Move the results of tasks from their requests_{id}, chunks_{id} and logs_{id} tables
+into the partitioned requests, chunks and logs tables, then drop the old tables.
+
+python migrate_tables.py [--keep]
+"""
+
+import sys
+from sqlalchemy import inspect, text
+from helper import get_engine
+from logger import logger
+from tables import add_task_partitions, result_tables, upgrade_tables
+
+
+def legacy_tasks(engine) -> list:
+    """Return the ids of the tasks that still have tables of their own, ascending."""
+    task_ids = set()
+    for name in inspect(engine).get_table_names():
+        prefix, _, task_id = name.rpartition("_")
+        if prefix in ("requests", "chunks", "logs") and task_id.isdigit():
+            task_ids.add(int(task_id))
+    return sorted(task_ids)
+
+
+def migrate_task(engine, task_id: int, keep: bool):
+    add_task_partitions(task_id)
+
+    names = inspect(engine).get_table_names()
+    for table in result_tables:
+        legacy = f"{table.name}_{task_id}"
+        if legacy not in names:
+            continue
+
+        # tables created before a column was added lack it, it stays NULL
+        legacy_columns = {
+            column["name"] for column in inspect(engine).get_columns(legacy)
+        }
+        columns = [
+            column.name for column in table.columns if column.name in legacy_columns
+        ]
+        values = [str(task_id) if name == "task_id" else name for name in columns]
+
+        with engine.begin() as conn:
+            result = conn.execute(
+                text(
+                    f"INSERT IGNORE INTO {table.name} ({', '.join(columns)}) SELECT {', '.join(values)} FROM {legacy};"
+                )
+            )
+            logger.info(
+                f"Task {task_id}: {result.rowcount} rows {legacy} -> {table.name}"
+            )
+
+            if not keep:
+                conn.execute(text(f"DROP TABLE {legacy};"))
+
+
+if __name__ == "__main__":
+
+    keep = "--keep" in sys.argv[1:]
+
+    upgrade_tables()
+
+    engine = get_engine()
+    for task_id in legacy_tasks(engine):
+        try:
+            migrate_task(engine, task_id, keep)
+        except Exception as e:
+            logger.error(f"Task {task_id} migration failed: {e}")
@@ -7,7 +7,20 @@ from tables import Tasks
 from page_request import request_page
 from page_task import task_page
 from task_loads import current_user, load_all_tasks
-from config import DEFAULT_MESSAGES_COMPLETE, MESSAGE_COMPLETE
+from config import (
+    ARRIVAL_CONSTANT,
+    CHUNK_STORAGE_PACKED,
+    CONNECTION_WARM,
+    DEFAULT_MESSAGES_COMPLETE,
+    ENGINE_THREAD,
+    LOAD_MODE_CLOSED,
+    MESSAGE_COMPLETE,
+    QUEUE_LIMIT,
+    QUEUE_OVERFLOW_BACKPRESSURE,
+    RESULT_SINK_QUEUE,
+    TOKEN_COUNTING_INLINE,
+    TRANSPORT_SDK,
+)
 
 
 load_dotenv()
@@ -48,6 +61,20 @@ def create_task():
         deployment_type="",
         messages=DEFAULT_MESSAGES_COMPLETE,
         message_type=MESSAGE_COMPLETE,
+        engine=ENGINE_THREAD,
+        load_mode=LOAD_MODE_CLOSED,
+        arrival_rate=1,
+        arrival_distribution=ARRIVAL_CONSTANT,
+        burst_size=10,
+        processes=0,
+        shards=1,
+        connection_mode=CONNECTION_WARM,
+        token_counting=TOKEN_COUNTING_INLINE,
+        transport=TRANSPORT_SDK,
+        queue_limit=QUEUE_LIMIT,
+        queue_overflow=QUEUE_OVERFLOW_BACKPRESSURE,
+        result_sink=RESULT_SINK_QUEUE,
+        chunk_storage=CHUNK_STORAGE_PACKED,
     )
 
     with st.container(border=True):
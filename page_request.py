@@ -4,10 +4,10 @@ import json
 import streamlit as st
 from dotenv import load_dotenv
 from helper import get_mysql_session
-from tables import Tasks, create_request_table_class
+from tables import Requests, Tasks
+from task_chunks import chunk_rows
 from task_loads import current_user, is_admin, load_all_chunks, load_all_logs
 
-
 load_dotenv()
 
 
@@ -21,16 +21,23 @@ def request_page(task_id: int, request_id: str):
     request = None
 
     session = get_mysql_session()
-    Requests = create_request_table_class(task_id)
 
     task = session.query(Tasks).filter(Tasks.id == task_id).first()
 
     if is_admin():
-        request = session.query(Requests).filter(Requests.id == request_id).first()
+        request = (
+            session.query(Requests)
+            .filter(Requests.task_id == task_id, Requests.id == request_id)
+            .first()
+        )
     else:
         request = (
             session.query(Requests)
-            .filter(Requests.id == request_id, Requests.user_id == current_user().id)
+            .filter(
+                Requests.task_id == task_id,
+                Requests.id == request_id,
+                Requests.user_id == current_user().id,
+            )
             .first()
         )
 
@@ -60,6 +67,14 @@ def request_page(task_id: int, request_id: str):
             st.markdown(f"output_token_count: `{request.output_token_count}`")
         with col3:
             st.markdown(f"chunks_count: `{request.chunks_count}`")
+        with col4:
+            st.markdown(f"token_source: `{request.token_source}`")
+
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.markdown(f"cached_token_count: `{request.cached_token_count}`")
+        with col2:
+            st.markdown(f"reasoning_token_count: `{request.reasoning_token_count}`")
 
         col1, col2, col3, col4 = st.columns(4)
         with col1:
@@ -81,6 +96,13 @@ def request_page(task_id: int, request_id: str):
         with col4:
             st.markdown(f"completed_at_fmt: `{request.completed_at_fmt}`")
 
+        if request.scheduled_req_time:
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.markdown(
+                    f"scheduled_req_time_fmt: `{request.scheduled_req_time_fmt}`"
+                )
+
         st.markdown("input:")
         st.text_area(
             label="input: ",
@@ -99,21 +121,28 @@ def request_page(task_id: int, request_id: str):
             label_visibility="hidden",
         )
 
-    render_chunks(task_id, request_id, "🚀 Chunks")
+    render_chunks(task_id, request, "🚀 Chunks")
 
     render_logs(task_id, request_id, "📒 Logs")
 
 
-def render_chunks(task_id: int, request_id: str, title):
+def render_chunks(task_id: int, request, title):
     """Render a table of chunks associated with a request.
 
     Args:
         task_id: ID of the task
-        request_id: ID of the request to show chunks for
+        request: Request to show chunks for, its packed chunks when it has them
         title: Title to display above the chunks table
     """
     try:
-        chunks = load_all_chunks(task_id, request_id)
+        if request.chunk_arrays:
+            chunk_list = chunk_rows(request)
+            if chunk_list:
+                st.markdown(f"## {title} ({len(chunk_list)})")
+                st.dataframe(chunk_list, use_container_width=True)
+            return
+
+        chunks = load_all_chunks(task_id, request.id)
         chunk_list = []
 
         for chunk in chunks:
@@ -4,6 +4,8 @@ from dotenv import load_dotenv
 from helper import format_milliseconds, get_mysql_session, task_status_icon
 from page_task_edit import task_form
 from task_cache import TaskCache
+from task_spill import spill_backlog
+from task_spool import pending_spools
 from tables import Tasks
 from task_count import task_count
 from task_metrics import task_metrics
@@ -11,7 +13,6 @@ from task_diff import diff_tasks
 from task_loads import current_user, is_admin, load_all_requests, load_all_tasks
 from logger import logger
 
-
 load_dotenv()
 
 
@@ -76,6 +77,14 @@ def render_count(task):
             st.write(f"Request Failed: `{task.request_failed}`")
             st.write(f"Request Succeed: `{task.request_succeed}`")
 
+            if task.engine_stats:
+                for stat in task.engine_stats:
+                    st.write(f"{stat}: `{task.engine_stats[stat]}`")
+
+            if task.queue_stats:
+                for stat in task.queue_stats:
+                    st.write(f"{stat}: `{task.queue_stats[stat]}`")
+
 
 def diff_tasks_page(current_task: Tasks):
     tasks = load_all_tasks()
@@ -160,12 +169,20 @@ def render_metrics(task):
             data = task_metrics(task)
             df = pd.DataFrame.from_dict(data, orient="index")
             cache = TaskCache()
-            queue_len = cache.len()
+            queue_len = cache.task_queue_len(task.id)
             st.markdown("## 📊 Metrics")
             st.markdown(f"Name: `{task.name}`")
-            if queue_len > 0:
+            segments, spilled_bytes = spill_backlog(task.id)
+            spools = len(pending_spools(task.id))
+            if queue_len > 0 or segments > 0 or spools > 0:
                 st.markdown(
-                    f"`{queue_len}` chunks in queue, please wait them to finish and refresh report."
+                    f"`{queue_len}` chunks in queue, `{cache.queue_pending(task.id)}` being stored, `{segments}` spilled segments (`{spilled_bytes}` bytes) and `{spools}` spool files on disk, ingesting `{cache.ingest_rate()}` rows/sec, please wait them to finish and refresh report."
+                )
+
+            overflow = cache.overflow_stats(task.id)
+            if overflow:
+                st.warning(
+                    f"Queues reached their limit of `{task.queue_limit}` records: `{overflow.get('spilled_records', 0)}` records (`{overflow.get('spilled_bytes', 0)}` bytes) spilled to disk, requests waited `{overflow.get('backpressure_ms', 0)}` ms for room."
                 )
 
             st.table(df)
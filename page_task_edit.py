@@ -1,3 +1,4 @@
+import json
 import streamlit as st
 from dotenv import load_dotenv
 from task_cache import TaskCache
@@ -25,8 +26,26 @@ from config import (
     MODEL_TYPE_DS_MODELS,
     MODEL_TYPE_AOAI_MODELS,
     MODEL_TYPES,
+    ENGINES,
+    CONNECTION_MODES,
+    CONNECTION_COLD,
+    TOKEN_COUNTINGS,
+    TRANSPORTS,
+    TRANSPORT_SSE_MODEL_TYPES,
+    QUEUE_LIMIT,
+    QUEUE_OVERFLOWS,
+    RESULT_SINKS,
+    CHUNK_STORAGES,
+    CHUNK_STORAGE_ROWS,
+    LOAD_MODES,
+    LOAD_MODE_OPEN,
+    LOAD_MODE_PROFILE,
+    DEFAULT_LOAD_PROFILE,
+    ARRIVAL_DISTRIBUTIONS,
+    ARRIVAL_BURSTY,
 )
 
+from task_schedule import profile_max_concurrency, profile_phases
 from template_complete import template_complete
 from template_vision import template_vision
 
@@ -76,6 +95,18 @@ def create_update(task: Tasks, edit: bool, messages: list):
             st.error("Messages is required.")
             return
 
+        if task.load_mode == LOAD_MODE_PROFILE:
+            try:
+                task.threads = profile_max_concurrency(
+                    profile_phases(task.load_profile)
+                )
+            except (ValueError, TypeError) as e:
+                st.error(f"Load Profile is invalid: {e}")
+                return
+            if task.threads < 1:
+                st.error("Load Profile must reach a concurrency of at least 1.")
+                return
+
         if edit:
             update_task(task, messages)
             st.success("Updated Succeed")
@@ -117,7 +148,8 @@ def task_form(task: Tasks, edit: bool = False):
             value=task.threads,
             step=1,
             min_value=1,
-            max_value=2000,
+            max_value=10000,
+            help="Use the Asyncio engine above a few hundred concurrency, caps requests in flight in Open Loop mode",
         )
     with col2:
         task.request_per_thread = st.number_input(
@@ -244,6 +276,161 @@ def task_form(task: Tasks, edit: bool = False):
                 placeholder="2024-08-01-preview",
             )
 
+    col1, col2, col3, col4, col5, col6 = st.columns(6)
+    with col1:
+        task.engine = st.selectbox(
+            label="Engine",
+            options=ENGINES,
+            index=ENGINES.index(task.engine) if task.engine in ENGINES else 0,
+            help="Thread runs one OS thread per concurrency, Asyncio runs all of them on one event loop",
+        )
+    with col2:
+        task.processes = st.number_input(
+            label="Processes",
+            value=task.processes or 0,
+            step=1,
+            min_value=0,
+            max_value=256,
+            help="Concurrency is split across this many processes, 0 means one per CPU core",
+        )
+    with col3:
+        task.shards = st.number_input(
+            label="Shards",
+            value=task.shards or 1,
+            step=1,
+            min_value=1,
+            max_value=256,
+            help="Concurrency is split across this many request workers, which start together",
+        )
+    with col4:
+        task.connection_mode = st.selectbox(
+            label="Connection Mode",
+            options=CONNECTION_MODES,
+            index=(
+                CONNECTION_MODES.index(task.connection_mode)
+                if task.connection_mode in CONNECTION_MODES
+                else CONNECTION_MODES.index(CONNECTION_COLD)
+            ),
+            help="Warm reuses pooled connections across requests, Cold opens a new connection for every request",
+        )
+    with col5:
+        task.token_counting = st.selectbox(
+            label="Token Counting",
+            options=TOKEN_COUNTINGS,
+            index=(
+                TOKEN_COUNTINGS.index(task.token_counting)
+                if task.token_counting in TOKEN_COUNTINGS
+                else 0
+            ),
+            help="Inline counts output tokens chunk by chunk while streaming, Deferred counts them in one batch after the stream ends, Server uses the usage the server reports and falls back to Deferred",
+        )
+    with col6:
+        if task.model_type in TRANSPORT_SSE_MODEL_TYPES:
+            task.transport = st.selectbox(
+                label="Transport",
+                options=TRANSPORTS,
+                index=(
+                    TRANSPORTS.index(task.transport)
+                    if task.transport in TRANSPORTS
+                    else 0
+                ),
+                help="SDK streams through the OpenAI SDK, Raw SSE posts the request with httpx and reads the SSE frames directly",
+            )
+
+    col1, col2, col3, col4, col5 = st.columns(5)
+    with col1:
+        task.load_mode = st.selectbox(
+            label="Load Mode",
+            options=LOAD_MODES,
+            index=(
+                LOAD_MODES.index(task.load_mode) if task.load_mode in LOAD_MODES else 0
+            ),
+            help="Closed Loop sends the next request when the previous one finished, Open Loop sends requests at the arrival rate",
+        )
+    if task.load_mode == LOAD_MODE_OPEN:
+        with col2:
+            task.arrival_rate = st.number_input(
+                label="Arrival Rate (RPS)",
+                value=float(task.arrival_rate or 1),
+                step=1.0,
+                min_value=0.01,
+                max_value=100000.0,
+            )
+        with col3:
+            task.arrival_distribution = st.selectbox(
+                label="Arrival Distribution",
+                options=ARRIVAL_DISTRIBUTIONS,
+                index=(
+                    ARRIVAL_DISTRIBUTIONS.index(task.arrival_distribution)
+                    if task.arrival_distribution in ARRIVAL_DISTRIBUTIONS
+                    else 0
+                ),
+            )
+        if task.arrival_distribution == ARRIVAL_BURSTY:
+            with col4:
+                task.burst_size = st.number_input(
+                    label="Burst Size",
+                    value=task.burst_size or 10,
+                    step=1,
+                    min_value=1,
+                    max_value=10000,
+                )
+    if task.load_mode == LOAD_MODE_PROFILE:
+        load_profile = st.text_area(
+            label="Load Profile",
+            value=json.dumps(task.load_profile or DEFAULT_LOAD_PROFILE, indent=2),
+            height=200,
+            help="Phases run in order, concurrency moves linearly from `from` to `to` over `duration` seconds. Concurrency is set to the profile peak",
+        )
+        try:
+            task.load_profile = json.loads(load_profile)
+        except json.JSONDecodeError as e:
+            st.error(f"Load Profile is not valid JSON: {e}")
+
+    col1, col2, col3, col4, col5 = st.columns(5)
+    with col1:
+        task.queue_limit = st.number_input(
+            label="Queue Limit",
+            value=task.queue_limit or QUEUE_LIMIT,
+            step=10000,
+            min_value=1000,
+            max_value=100000000,
+            help="Records of the task Redis may hold until they are stored",
+        )
+    with col2:
+        task.queue_overflow = st.selectbox(
+            label="Queue Overflow",
+            options=QUEUE_OVERFLOWS,
+            index=(
+                QUEUE_OVERFLOWS.index(task.queue_overflow)
+                if task.queue_overflow in QUEUE_OVERFLOWS
+                else 0
+            ),
+            help="Backpressure makes requests wait while the queues are full, Spill appends records to segment files on disk that queue workers store later",
+        )
+    with col3:
+        task.result_sink = st.selectbox(
+            label="Result Sink",
+            options=RESULT_SINKS,
+            index=(
+                RESULT_SINKS.index(task.result_sink)
+                if task.result_sink in RESULT_SINKS
+                else 0
+            ),
+            help="Queue stores results through Redis while the task runs, Spool writes them to local Arrow files that queue workers load once the run is over",
+        )
+    with col4:
+        task.chunk_storage = st.selectbox(
+            label="Chunk Storage",
+            options=CHUNK_STORAGES,
+            index=(
+                CHUNK_STORAGES.index(task.chunk_storage)
+                if task.chunk_storage in CHUNK_STORAGES
+                else CHUNK_STORAGES.index(CHUNK_STORAGE_ROWS)
+            ),
+            help="Packed keeps the arrival times and lengths of a request's chunks in compressed arrays on the request, Rows stores every chunk as a row for debugging",
+        )
+
     try:
         index = MESSAGE_TYPES.index(task.message_type)
     except:
@@ -299,10 +486,14 @@ def task_form(task: Tasks, edit: bool = False):
             )
         if run_btn:
             cache = TaskCache()
-            queue_len = cache.len()
-            if queue_len > 0:
+            # truncating or clearing the spool now would lose rows still being stored
+            backlog = cache.task_backlog(task.id)
+            if backlog:
+                backlog_text = ", ".join(
+                    f"{count} {name}" for name, count in backlog.items()
+                )
                 st.warning(
-                    f"Other tasks({queue_len}) are still running, please wait..."
+                    f"Data of the last run({backlog_text}) is still being stored, please wait..."
                 )
             else:
                 if truncate_table(task.id):
@@ -327,8 +518,8 @@ def task_form(task: Tasks, edit: bool = False):
                 use_container_width=True,
             )
         if rebuild_btn:
-            delete_task_tables(task.id)
-            if create_task_tables(task.id):
+            # keep the task's partition, a partition added again would not be its own
+            if truncate_table(task.id) and create_task_tables(task.id):
                 rebuild_task(task.id)
                 st.success("Rebuild Succeed")
         with col5:
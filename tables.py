@@ -6,26 +6,21 @@ from sqlalchemy import (
     Boolean,
     BigInteger,
     Float,
+    Double,
     Text,
     Index,
     JSON,
+    LargeBinary,
 )
-from helper import format_milliseconds, get_mysql_session, time_now
+from helper import format_milliseconds, get_engine, get_mysql_session, time_now
 from logger import logger
-from sqlalchemy import create_engine
-from helper import sql_string
+from sqlalchemy import inspect
 import streamlit as st
 from sqlalchemy import text
-from sqlalchemy.orm import sessionmaker
-import threading
-from config import DEFAULT_MESSAGES_COMPLETE
+from config import DEFAULT_MESSAGES_COMPLETE, LOAD_MODE_PROFILE, MYSQL_MAX_PARTITIONS
 
 Base = declarative_base()
 
-created_table_classes = {}
-
-table_creation_lock = threading.Lock()
-
 
 class Users(Base):
     __tablename__ = "users"
@@ -67,6 +62,24 @@ class Tasks(Base):
     status = Column(Integer)
     error_message = Column(String(1024))
     enable_think = Column(Boolean)
+    engine = Column(String(1024))
+    engine_stats = Column(JSON, nullable=True)
+    load_mode = Column(String(1024))
+    arrival_rate = Column(Float)
+    arrival_distribution = Column(String(1024))
+    burst_size = Column(Integer)
+    load_profile = Column(JSON, nullable=True)
+    request_planned = Column(Integer, nullable=True)
+    processes = Column(Integer, default=0)
+    shards = Column(Integer, default=1)
+    connection_mode = Column(String(1024))
+    token_counting = Column(String(1024))
+    transport = Column(String(1024))
+    queue_limit = Column(Integer)
+    queue_overflow = Column(String(1024))
+    queue_stats = Column(JSON, nullable=True)
+    result_sink = Column(String(1024))
+    chunk_storage = Column(String(1024))
     request_succeed = Column(Integer, default=0)
     request_failed = Column(Integer, default=0)
     created_at = Column(BigInteger, nullable=False, default=lambda: int(time_now()))
@@ -84,10 +97,19 @@ class Tasks(Base):
         else:
             return DEFAULT_MESSAGES_COMPLETE
 
+    @property
+    def request_target(self):
+        """Return the number of requests the task sends, None while a profile is still running."""
+        if self.load_mode == LOAD_MODE_PROFILE:
+            return self.request_planned
+        return self.threads * self.request_per_thread
+
     @property
     def progress_percentage(self):
         """Calculate and return the task progress as a percentage, capped at 100."""
-        request_total = self.threads * self.request_per_thread
+        request_total = self.request_target
+        if not request_total:
+            return 0
         request_done = self.request_failed + self.request_succeed
         return min(100, round((request_done / request_total) * 100))
 
@@ -108,231 +130,383 @@ class Tasks(Base):
         return "N/A"
 
 
-def create_request_table_class(task_id: int):
-    table_name = f"requests_{task_id}"
-
-    if table_name in created_table_classes:
-        return created_table_classes[table_name]
-
-    with table_creation_lock:
-        if table_name in created_table_classes:
-            return created_table_classes[table_name]
-
-    class Requests(Base):
-        """Database model for storing request data associated with a specific task.
-
-        Contains request metadata, timing information, and processing results.
-        """
-
-        __tablename__ = table_name
-        __table_args__ = (Index("idx_success", "success"), {"extend_existing": True})
-        id = Column(String(48), primary_key=True)
-        task_id = Column(Integer)
-        user_id = Column(Integer)
-        thread_num = Column(Integer)
-        input_token_count = Column(Integer, default=0)
-        output_token_count = Column(Integer, default=0)
-        response = Column(Text)
-        chunks_count = Column(Integer, default=0)
-        first_token_latency_ms = Column(Integer)
-        last_token_latency_ms = Column(Integer)
-        request_index = Column(Integer)
-        request_latency_ms = Column(Integer)
-        success = Column(Integer)
-        end_req_time = Column(BigInteger, nullable=True)
-        start_req_time = Column(BigInteger, nullable=True)
-        created_at = Column(BigInteger, nullable=False, default=lambda: int(time_now()))
-        completed_at = Column(
-            BigInteger, nullable=True, default=lambda: int(time_now())
-        )
+class Requests(Base):
+    """Database model for storing request data, all tasks in one table partitioned by task.
 
-        @property
-        def start_req_time_fmt(self) -> str:
-            """Return the start_req_time timestamp formatted as a human-readable string."""
-            return format_milliseconds(self.start_req_time)
+    Contains request metadata, timing information, and processing results.
+    """
 
-        @property
-        def end_req_time_fmt(self) -> str:
-            """Return the end_req_time timestamp formatted as a human-readable string."""
-            return format_milliseconds(self.end_req_time)
+    __tablename__ = "requests"
+    __table_args__ = (Index("idx_requests_task_success", "task_id", "success"),)
+    task_id = Column(Integer, primary_key=True, autoincrement=False)
+    id = Column(String(48), primary_key=True)
+    user_id = Column(Integer)
+    thread_num = Column(Integer)
+    input_token_count = Column(Integer, default=0)
+    output_token_count = Column(Integer, default=0)
+    response = Column(Text)
+    chunks_count = Column(Integer, default=0)
+    first_token_latency_ms = Column(Integer)
+    last_token_latency_ms = Column(Integer)
+    request_index = Column(Integer)
+    request_latency_ms = Column(Integer)
+    success = Column(Integer)
+    end_req_time = Column(BigInteger, nullable=True)
+    start_req_time = Column(BigInteger, nullable=True)
+    scheduled_req_time = Column(BigInteger, nullable=True)
+    load_phase = Column(String(255), nullable=True)
+    cached_token_count = Column(Integer, nullable=True)
+    reasoning_token_count = Column(Integer, nullable=True)
+    token_source = Column(String(255), nullable=True)
+    chunk_arrays = Column(LargeBinary(16777215), nullable=True)
+    created_at = Column(BigInteger, nullable=False, default=lambda: int(time_now()))
+    completed_at = Column(BigInteger, nullable=True, default=lambda: int(time_now()))
 
-        @property
-        def completed_at_fmt(self) -> str:
-            """Return the completed_at timestamp formatted as a human-readable string."""
-            return format_milliseconds(self.completed_at)
+    @property
+    def start_req_time_fmt(self) -> str:
+        """Return the start_req_time timestamp formatted as a human-readable string."""
+        return format_milliseconds(self.start_req_time)
 
-        @property
-        def created_at_fmt(self) -> str:
-            """Return the created_at timestamp formatted as a human-readable string."""
-            return format_milliseconds(self.created_at)
+    @property
+    def scheduled_req_time_fmt(self) -> str:
+        """Return the scheduled_req_time timestamp formatted as a human-readable string."""
+        return format_milliseconds(self.scheduled_req_time)
 
-    created_table_classes[table_name] = Requests
+    @property
+    def end_req_time_fmt(self) -> str:
+        """Return the end_req_time timestamp formatted as a human-readable string."""
+        return format_milliseconds(self.end_req_time)
 
-    return Requests
+    @property
+    def completed_at_fmt(self) -> str:
+        """Return the completed_at timestamp formatted as a human-readable string."""
+        return format_milliseconds(self.completed_at)
 
+    @property
+    def created_at_fmt(self) -> str:
+        """Return the created_at timestamp formatted as a human-readable string."""
+        return format_milliseconds(self.created_at)
+
+
+class Chunks(Base):
+    """Database model for storing chunk data, all tasks in one table partitioned by task.
+
+    Contains chunk metadata, timing information, and processing results.
+    """
+
+    __tablename__ = "chunks"
+    __table_args__ = (Index("idx_chunks_task_request", "task_id", "request_id"),)
+    task_id = Column(Integer, primary_key=True, autoincrement=False)
+    id = Column(String(48), primary_key=True)
+    request_id = Column(String(48))
+    chunk_index = Column(Integer)
+    thread_num = Column(Integer)
+    chunk_content = Column(String(1024))
+    token_len = Column(Integer)
+    characters_len = Column(Integer)
+    request_latency_ms = Column(Double)
+    tpot = Column(Integer)
+    last_token_latency_ms = Column(Double)
+    created_at = Column(BigInteger, nullable=False, default=lambda: int(time_now()))
+    created_at_us = Column(BigInteger, nullable=True)
 
-def create_chunk_table_class(task_id: int):
-    table_name = f"chunks_{task_id}"
+    @property
+    def created_at_fmt(self) -> str:
+        """Return the created_at timestamp formatted as a human-readable string."""
+        return format_milliseconds(self.created_at)
 
-    if table_name in created_table_classes:
-        return created_table_classes[table_name]
 
-    with table_creation_lock:
-        if table_name in created_table_classes:
-            return created_table_classes[table_name]
+class Logs(Base):
+    """Database model for storing log data, all tasks in one table partitioned by task.
 
-    class Chunks(Base):
-        """Database model for storing chunk data associated with a specific task.
+    Contains log data.
+    """
 
-        Contains chunk metadata, timing information, and processing results.
-        """
+    __tablename__ = "logs"
+    __table_args__ = (Index("idx_logs_task_request", "task_id", "request_id"),)
+    task_id = Column(Integer, primary_key=True, autoincrement=False)
+    id = Column(String(48), primary_key=True)
+    thread_num = Column(Integer)
+    request_id = Column(String(48))
+    log_message = Column(Text)
+    log_data = Column(JSON, nullable=True)
+    created_at = Column(BigInteger, nullable=False, default=lambda: int(time_now()))
 
-        __tablename__ = table_name
-        __table_args__ = (
-            Index("chunk_request_id", "request_id"),
-            {"extend_existing": True},
-        )
-        id = Column(String(48), primary_key=True)
-        task_id = Column(Integer)
-        request_id = Column(String(48))
-        chunk_index = Column(Integer)
-        thread_num = Column(Integer)
-        chunk_content = Column(String(1024))
-        token_len = Column(Integer)
-        characters_len = Column(Integer)
-        request_latency_ms = Column(Integer)
-        tpot = Column(Integer)
-        last_token_latency_ms = Column(Integer)
-        created_at = Column(BigInteger, nullable=False, default=lambda: int(time_now()))
+    @property
+    def created_at_fmt(self) -> str:
+        """Return the created_at timestamp formatted as a human-readable string."""
+        return format_milliseconds(self.created_at)
 
-        @property
-        def created_at_fmt(self) -> str:
-            """Return the created_at timestamp formatted as a human-readable string."""
-            return format_milliseconds(self.created_at)
 
-    created_table_classes[table_name] = Chunks
+result_tables = [Requests.__table__, Chunks.__table__, Logs.__table__]
 
-    return Chunks
 
+def task_table(table_name: str, task_id: int) -> str:
+    """Return SQL selecting the rows of one task from a result table, for use after FROM.
 
-def create_log_table_class(task_id: int):
-    table_name = f"logs_{task_id}"
+    MySQL merges the derived table into the query, so it reads the task's partition only.
+    """
+    return f"(SELECT * FROM {table_name} WHERE task_id = {int(task_id)}) AS {table_name}_{int(task_id)}"
 
-    if table_name in created_table_classes:
-        return created_table_classes[table_name]
 
-    with table_creation_lock:
-        if table_name in created_table_classes:
-            return created_table_classes[table_name]
+def is_partitioned(engine) -> bool:
+    """Whether the result tables are partitioned by task, which only MySQL supports."""
+    return engine.dialect.name == "mysql"
 
-    class Logs(Base):
-        """Database model for storing log data associated with a specific task.
 
-        Contains log data.
-        """
+def delete_task_rows(conn, task_id: int, tables: list = result_tables):
+    """Delete the results of a task from tables where it has no partition of its own."""
+    for table in tables:
+        conn.execute(table.delete().where(table.c.task_id == task_id))
 
-        __tablename__ = table_name
-        __table_args__ = (
-            Index("log_request_id", "request_id"),
-            {"extend_existing": True},
-        )
-        id = Column(String(48), primary_key=True)
-        task_id = Column(Integer)
-        thread_num = Column(Integer)
-        request_id = Column(String(48))
-        log_message = Column(Text)
-        log_data = Column(JSON, nullable=True)
-        created_at = Column(BigInteger, nullable=False, default=lambda: int(time_now()))
 
-        @property
-        def created_at_fmt(self) -> str:
-            """Return the created_at timestamp formatted as a human-readable string."""
-            return format_milliseconds(self.created_at)
+def partition_name(task_id: int) -> str:
+    return f"p{int(task_id)}"
 
-    created_table_classes[table_name] = Logs
 
-    return Logs
+def table_partitions(conn, table_name: str) -> set:
+    """Return the partition names of a table, empty if it is not partitioned."""
+    return {name for _, name, _ in partition_layout(conn, table_name)}
 
 
-def create_task_tables(task_id: int) -> bool:
-    engine = create_engine(sql_string)
+def partition_layout(conn, table_name: str) -> list:
+    """Return (method, name, description) of the partitions of a table, in order."""
+    rows = conn.execute(
+        text(
+            "SELECT PARTITION_METHOD, PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION"
+        ),
+        {"table_name": table_name},
+    )
+    return [tuple(row) for row in rows]
+
+
+def range_partitions(task_ids: list, bound: int = 0) -> str:
+    """Return RANGE partition definitions giving each task, ascending from bound, a partition.
+
+    Ids skipped between tasks go to a gap partition, so a task partition only ever holds
+    its own task, and ids past the last task go to pmax.
+    """
+    definitions = []
+    for task_id in task_ids:
+        if task_id > bound:
+            definitions.append(f"PARTITION g{task_id} VALUES LESS THAN ({task_id})")
+        definitions.append(
+            f"PARTITION {partition_name(task_id)} VALUES LESS THAN ({task_id + 1})"
+        )
+        bound = task_id + 1
+    definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return ", ".join(definitions)
+
+
+def partition_result_tables(engine):
+    """Create the result tables, partitioned by RANGE (task_id), each task adds its partition.
+
+    Tables partitioned by LIST (task_id) before are repartitioned, keeping the partitions
+    of their tasks.
+    """
+    Base.metadata.create_all(engine, tables=result_tables)
+    if not is_partitioned(engine):
+        return
+
+    with engine.begin() as conn:
+        for table in result_tables:
+            layout = partition_layout(conn, table.name)
+            if layout and layout[0][0] == "RANGE":
+                continue
+
+            task_ids = sorted(
+                int(description)
+                for _, name, description in layout
+                if name != "p0" and description.isdigit()
+            )
+            conn.execute(
+                text(
+                    f"ALTER TABLE {table.name} PARTITION BY RANGE (task_id) ({range_partitions(task_ids)});"
+                )
+            )
+            logger.info(f"Table {table.name} partitioned by task_id ranges")
+
+
+def add_task_partitions(task_id: int):
+    """Add the partitions holding the results of a task, if it has none yet.
+
+    A task with a lower id than the last partitioned one, or past MYSQL_MAX_PARTITIONS,
+    gets none, its results stay in a shared partition.
+    """
+    engine = get_engine()
+    if not is_partitioned(engine):
+        return
+
+    with engine.begin() as conn:
+        for table in result_tables:
+            layout = partition_layout(conn, table.name)
+            if partition_name(task_id) in {name for _, name, _ in layout}:
+                continue
+
+            bound = max(
+                [
+                    int(description)
+                    for _, _, description in layout
+                    if description.isdigit()
+                ],
+                default=0,
+            )
+            if task_id < bound:
+                logger.warning(
+                    f"Task {task_id} results share a partition of {table.name}, a later task is partitioned already"
+                )
+                continue
+            if len(layout) + 2 > MYSQL_MAX_PARTITIONS:
+                logger.warning(
+                    f"Task {task_id} results share a partition of {table.name}, it has {len(layout)} of {MYSQL_MAX_PARTITIONS} partitions"
+                )
+                continue
+
+            # pmax only holds results of tasks past the limit, usually none
+            conn.execute(
+                text(
+                    f"ALTER TABLE {table.name} REORGANIZE PARTITION pmax INTO ({range_partitions([task_id], bound)});"
+                )
+            )
 
-    Chunks = create_chunk_table_class(task_id)
-    Requests = create_request_table_class(task_id)
-    Logs = create_log_table_class(task_id)
 
+def create_task_tables(task_id: int) -> bool:
     try:
-        Base.metadata.create_all(engine)
-        st.success(f"Table {Chunks.__tablename__} created")
-        st.success(f"Table {Requests.__tablename__} created")
-        st.success(f"Table {Logs.__tablename__} created")
+        add_task_partitions(task_id)
+        st.success(f"Partitions {partition_name(task_id)} created")
         return True
     except Exception as e:
-        st.error(f"Table {Chunks.__tablename__} create failed: {e}")
-        st.error(f"Table {Requests.__tablename__} create failed: {e}")
-        st.error(f"Table {Logs.__tablename__} create failed: {e}")
-        logger.error(f"Table {Chunks.__tablename__} create failed: {e}")
-        logger.error(f"Table {Requests.__tablename__} create failed: {e}")
-        logger.error(f"Table {Logs.__tablename__} create failed: {e}")
+        st.error(f"Partitions {partition_name(task_id)} create failed: {e}")
+        logger.error(f"Partitions {partition_name(task_id)} create failed: {e}")
         return False
 
 
 def truncate_table(task_id: int) -> bool:
-    engine = create_engine(sql_string)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    Chunks = create_chunk_table_class(task_id)
-    Requests = create_request_table_class(task_id)
-    Logs = create_log_table_class(task_id)
+    """Empty the results of a task, keeping its partitions for the next run."""
     try:
-        session.execute(text(f"TRUNCATE TABLE {Chunks.__tablename__};"))
-        session.execute(text(f"TRUNCATE TABLE {Requests.__tablename__};"))
-        session.execute(text(f"TRUNCATE TABLE {Logs.__tablename__};"))
+        engine = get_engine()
+        with engine.begin() as conn:
+            if not is_partitioned(engine):
+                delete_task_rows(conn, task_id)
+                return True
+
+            for table in result_tables:
+                if partition_name(task_id) not in table_partitions(conn, table.name):
+                    delete_task_rows(conn, task_id, [table])
+                    continue
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} TRUNCATE PARTITION {partition_name(task_id)};"
+                    )
+                )
         return True
     except Exception as e:
         st.error(f"DB truncate failed: {e}")
         logger.error(f"DB truncate failed: {e}")
         return False
-    finally:
-        session.close()
 
 
 def delete_task_tables(task_id: int) -> bool:
-    engine = create_engine(sql_string)
+    """Drop the partitions of a task being deleted.
 
-    Chunks = create_chunk_table_class(task_id)
-    Requests = create_request_table_class(task_id)
-    Logs = create_log_table_class(task_id)
+    Its range merges into the next partition, so only a task that never runs again may
+    lose its partition, use truncate_table to reset one.
+    """
     try:
-        Chunks.__table__.drop(engine)
-        Requests.__table__.drop(engine)
-        Logs.__table__.drop(engine)
-        st.success(f"Table {Chunks.__tablename__} deleted")
-        st.success(f"Table {Requests.__tablename__} deleted")
-        st.success(f"Table {Logs.__tablename__} deleted")
+        engine = get_engine()
+        with engine.begin() as conn:
+            if not is_partitioned(engine):
+                delete_task_rows(conn, task_id)
+            else:
+                for table in result_tables:
+                    if partition_name(task_id) not in table_partitions(
+                        conn, table.name
+                    ):
+                        delete_task_rows(conn, task_id, [table])
+                        continue
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE {table.name} DROP PARTITION {partition_name(task_id)};"
+                        )
+                    )
+        st.success(f"Partitions {partition_name(task_id)} deleted")
         return True
     except Exception as e:
-        st.error(f"Table {Chunks.__tablename__} deletion failed: {e}")
-        st.error(f"Table {Requests.__tablename__} deletion failed: {e}")
-        st.error(f"Table {Logs.__tablename__} deletion failed: {e}")
-        logger.error(f"Table {Chunks.__tablename__} deletion failed: {e}")
-        logger.error(f"Table {Requests.__tablename__} deletion failed: {e}")
-        logger.error(f"Table {Logs.__tablename__} deletion failed: {e}")
+        st.error(f"Partitions {partition_name(task_id)} deletion failed: {e}")
+        logger.error(f"Partitions {partition_name(task_id)} deletion failed: {e}")
         return False
 
 
 def create_tables():
-    engine = create_engine(sql_string)
+    engine = get_engine()
 
     try:
         Base.metadata.create_all(engine)
+        partition_result_tables(engine)
         st.success("Tables created")
     except Exception as e:
         st.error(f"Tables create failed: {e}")
         logger.error(f"Tables create failed: {e}")
 
 
+def add_missing_columns(engine, table):
+    """Add the model's columns missing from the table, and widen integer columns now stored as Double."""
+    inspector = inspect(engine)
+    if not inspector.has_table(table.name):
+        return
+
+    existing = {
+        column["name"]: column["type"] for column in inspector.get_columns(table.name)
+    }
+
+    with engine.begin() as conn:
+        for column in table.columns:
+            column_type = column.type.compile(dialect=engine.dialect)
+
+            if column.name not in existing:
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN `{column.name}` {column_type};"
+                    )
+                )
+                logger.info(f"Column {table.name}.{column.name} added")
+
+            elif (
+                isinstance(column.type, Double)
+                and isinstance(existing[column.name], Integer)
+                and engine.dialect.name == "mysql"
+            ):
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} MODIFY COLUMN `{column.name}` {column_type};"
+                    )
+                )
+                logger.info(
+                    f"Column {table.name}.{column.name} changed to {column_type}"
+                )
+
+
+def upgrade_tables():
+    """Add the tables and columns introduced after the database was initialized."""
+    engine = get_engine()
+
+    try:
+        add_missing_columns(engine, Tasks.__table__)
+        partition_result_tables(engine)
+        for table in result_tables:
+            add_missing_columns(engine, table)
+    except Exception as e:
+        logger.error(f"Tables upgrade failed: {e}")
+
+
+def upgrade_task_tables(task_id: int):
+    """Add the partitions of a task created before the result tables were partitioned."""
+    try:
+        add_task_partitions(task_id)
+    except Exception as e:
+        logger.error(f"Task {task_id} partitions upgrade failed: {e}")
+
+
 def init_user():
     session = get_mysql_session()
     try:
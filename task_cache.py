@@ -1,24 +1,136 @@
+import asyncio
 import os
+import threading
+import time
+from time import sleep
 from dotenv import load_dotenv
 import json
 from redis import Redis
+from redis.exceptions import ResponseError
+from helper import time_now
+import task_wire
+from task_spill import (
+    SpillWriter,
+    remove_task_spill_dir,
+    spill_backlog,
+    task_segments,
+)
+from task_spool import (
+    TaskSpool,
+    clear_task_spool,
+    pending_spools,
+    remove_task_spool_dir,
+)
 from logger import logger
-from tables import (
-    create_chunk_table_class,
-    create_log_table_class,
-    create_request_table_class,
+from config import (
+    ENQUEUE_BATCH_SIZE,
+    ENQUEUE_BUFFER_MAX,
+    ENQUEUE_CLOSE_TIMEOUT,
+    ENQUEUE_FLUSH_MS,
+    INGEST_MAX_DELIVERIES,
+    INGEST_RATE_TTL,
+    INGEST_RECLAIM_IDLE_MS,
+    QUEUE_OVERFLOW_BACKPRESSURE,
+    QUEUE_OVERFLOW_SPILL,
+    TASK_EVENTS_MAX,
+    SHARD_BARRIER_TIMEOUT,
+    SHARD_LEASE_MS,
+    SHARD_START_DELAY_MS,
 )
 
-requests_queue_name = "requests"
-chunks_queue_name = "chunks"
-logs_queue_name = "logs"
+QUEUE_CHUNKS = "chunks"
+QUEUE_LOGS = "logs"
+QUEUE_REQUESTS = "requests"
+# chunks and logs are read before the requests they belong to
+queue_kinds = [QUEUE_CHUNKS, QUEUE_LOGS, QUEUE_REQUESTS]
+# queues shared by all tasks before every task had its own, lists first, then streams
+legacy_queue_names = [
+    "chunks",
+    "logs",
+    "requests",
+    "chunks_stream",
+    "logs_stream",
+    "requests_stream",
+]
+ingest_group_name = "ingest"
+active_tasks_name = "active_tasks"
+sharded_tasks_name = "sharded_tasks"
+ingest_rates_name = "ingest_rates"
+task_events_name = "task_events"
+# a task opening its queues adds an entry, idle queue workers block reading it
+queue_wakeup_name = "queue_wakeup"
+
+queue_schemas = {
+    QUEUE_REQUESTS: task_wire.SCHEMA_REQUEST,
+    QUEUE_CHUNKS: task_wire.SCHEMA_CHUNK,
+    QUEUE_LOGS: task_wire.SCHEMA_LOG,
+}
+
+
+def overflow_name(task_id: int) -> str:
+    return f"task_{task_id}_overflow"
+
+
+def queue_name(task_id: int, kind: str) -> str:
+    return f"task_{task_id}_{kind}"
+
+
+def queue_gone(e: ResponseError) -> bool:
+    """Whether a stream command failed because the queue or its group was deleted."""
+    message = str(e)
+    return "NOGROUP" in message or "no such key" in message
+
+
+# extend a lease only while it is still held by the caller
+renew_lease_script = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
 
 load_dotenv()
 
 
 class TaskCache:
-    def __init__(self):
+    def __init__(
+        self,
+        buffered: bool = False,
+        queue_limit: int = None,
+        queue_overflow: str = QUEUE_OVERFLOW_BACKPRESSURE,
+        spool: bool = False,
+    ):
+        """Connect to Redis.
+
+        Args:
+            buffered: Buffer enqueued requests, chunks and logs in memory and push them
+                from a background thread, instead of one XADD round trip per item
+            queue_limit: Records a task's queues may hold before buffered items of the
+                task are held back or spilled, None for no limit
+            queue_overflow: Backpressure holds items back and throttles new requests once
+                the buffer is full, Spill appends them to segment files
+            spool: Write enqueued items to local Arrow files instead of Redis, queue
+                workers load them once the task stopped producing
+        """
         self.redis: Redis = self.connect()
+        # set when the worker running the task is shutting down
+        self.stopped = False
+        self.requests_enqueued = 0
+
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.closing = False
+        self.flusher = None
+        self.queue_limit = queue_limit
+        self.queue_overflow = queue_overflow
+        self.spill_writers = {}
+        self.spool = TaskSpool() if spool else None
+        if buffered:
+            self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flusher.start()
+
         logger.info("TaskCache initialized")
 
     def get_task(self, task_id: int):
@@ -30,67 +142,698 @@ class TaskCache:
     def update_task_status(self, task_id: int, status: int):
         self.redis.set(f"task_{task_id}", status)
 
-    def to_dict(self, obj):
-        return {
-            column.name: getattr(obj, column.name) for column in obj.__table__.columns
-        }
+    def notify_task_event(self, count: int = 1):
+        """Wake up to count idle request workers, to pick up a queued task or claim shards."""
+        pipe = self.redis.pipeline()
+        pipe.rpush(task_events_name, *[time_now()] * count)
+        pipe.ltrim(task_events_name, -TASK_EVENTS_MAX, -1)
+        pipe.execute()
 
-    def serialize(self, task):
-        task_dict = self.to_dict(task)
-        return json.dumps(task_dict)
+    def wait_task_event(self, timeout: float) -> bool:
+        return self.redis.blpop(task_events_name, timeout) is not None
 
-    def deserialize(self, task_dict, instance):
-        for key, value in task_dict.items():
-            setattr(instance, key, value)
-        return instance
+    def task_stopped(self, task_id: int) -> bool:
+        if self.stopped:
+            return True
+        task_status = self.get_task(task_id)
+        return not task_status or int(task_status) == 5
 
-    def request_enqueue(self, task):
-        task_json = self.serialize(task)
-        self.redis.rpush(requests_queue_name, task_json)
-
-    def request_dequeue(self):
-        if task_json := self.redis.lpop(requests_queue_name):
-            task_dict = json.loads(task_json.decode("utf-8"))
-            Requests = create_request_table_class(task_dict["task_id"])
-            return self.deserialize(task_dict, Requests())
-        return None
+    def create_shards(self, task_id: int, shards: int):
+        """Open the shards of a task so idle request workers can claim them."""
+        pipe = self.redis.pipeline()
+        for shard_index in range(shards):
+            pipe.delete(f"task_{task_id}_shard_{shard_index}_lease")
+            pipe.delete(f"task_{task_id}_shard_{shard_index}_done")
+        pipe.delete(
+            f"task_{task_id}_shards_claimed",
+            f"task_{task_id}_shards_done",
+            f"task_{task_id}_shards_requests",
+            f"task_{task_id}_shards_stats",
+            f"task_{task_id}_start_at",
+        )
+        pipe.set(f"task_{task_id}_shards", shards)
+        pipe.sadd(sharded_tasks_name, task_id)
+        pipe.execute()
 
-    def request_len(self) -> int:
-        return self.redis.llen(requests_queue_name)
+        self.notify_task_event(shards)
+
+    def claim_shard(self, owner: str):
+        """Lease the first shard that is neither done nor held by a live worker.
+
+        Returns:
+            tuple: (task_id, shard_index, shards), None if there is nothing to run
+        """
+        for task_id in self.redis.smembers(sharded_tasks_name):
+            task_id = int(task_id)
+
+            shards = self.redis.get(f"task_{task_id}_shards")
+            if not shards or self.task_stopped(task_id):
+                self.redis.srem(sharded_tasks_name, task_id)
+                continue
+
+            for shard_index in range(int(shards)):
+                if self.redis.exists(f"task_{task_id}_shard_{shard_index}_done"):
+                    continue
+                if self.redis.set(
+                    f"task_{task_id}_shard_{shard_index}_lease",
+                    owner,
+                    nx=True,
+                    px=SHARD_LEASE_MS,
+                ):
+                    return task_id, shard_index, int(shards)
 
-    def chunk_enqueue(self, task):
-        task_json = self.serialize(task)
-        self.redis.rpush(chunks_queue_name, task_json)
-
-    def chunk_dequeue(self):
-        if task_json := self.redis.lpop(chunks_queue_name):
-            task_dict = json.loads(task_json.decode("utf-8"))
-            Chunks = create_chunk_table_class(task_dict["task_id"])
-            return self.deserialize(task_dict, Chunks())
         return None
 
-    def chunk_len(self) -> int:
-        return self.redis.llen(chunks_queue_name)
+    def renew_shard(self, task_id: int, shard_index: int, owner: str) -> bool:
+        renewed = self.redis.eval(
+            renew_lease_script,
+            1,
+            f"task_{task_id}_shard_{shard_index}_lease",
+            owner,
+            SHARD_LEASE_MS,
+        )
+        return bool(renewed)
+
+    def server_time_ms(self) -> float:
+        seconds, microseconds = self.redis.time()
+        return seconds * 1000 + microseconds / 1000
+
+    def clock_offset_ms(self) -> float:
+        """Return local clock minus Redis clock, halving the round trip."""
+        before = time_now()
+        server = self.server_time_ms()
+        after = time_now()
+        return (before + after) / 2 - server
+
+    def wait_shard_start(self, task_id: int, shards: int) -> float:
+        """Block until every shard of the task is claimed, then agree on a start time.
+
+        Returns:
+            float: Start time in milliseconds on the Redis clock
+        """
+        start_key = f"task_{task_id}_start_at"
+
+        claimed = self.redis.incr(f"task_{task_id}_shards_claimed")
+        if claimed >= shards:
+            self.redis.set(
+                start_key, self.server_time_ms() + SHARD_START_DELAY_MS, nx=True
+            )
+
+        deadline = time_now() + SHARD_BARRIER_TIMEOUT * 1000
+        while (start_at := self.redis.get(start_key)) is None:
+            if time_now() > deadline:
+                logger.warning(f"task {task_id} shards not all claimed, starting")
+                self.redis.set(
+                    start_key, self.server_time_ms() + SHARD_START_DELAY_MS, nx=True
+                )
+            sleep(0.01)
+
+        return float(start_at)
+
+    def finish_shard(
+        self, task_id: int, shard_index: int, requests: int, engine_stats: dict
+    ):
+        """Mark a shard done and collect what it sent.
+
+        Done shards are a set and their requests a hash keyed by shard index, so a shard
+        re-run after its lease expired is counted once.
+
+        Returns:
+            tuple: (whether the shard was not done before, shards done, requests sent by
+                done shards, engine stats of done shards)
+        """
+        pipe = self.redis.pipeline()
+        pipe.set(f"task_{task_id}_shard_{shard_index}_done", 1)
+        pipe.delete(f"task_{task_id}_shard_{shard_index}_lease")
+        pipe.hset(f"task_{task_id}_shards_requests", shard_index, requests or 0)
+        if engine_stats:
+            pipe.hset(
+                f"task_{task_id}_shards_stats", shard_index, json.dumps(engine_stats)
+            )
+        pipe.sadd(f"task_{task_id}_shards_done", shard_index)
+        pipe.scard(f"task_{task_id}_shards_done")
+        pipe.hvals(f"task_{task_id}_shards_requests")
+        pipe.hvals(f"task_{task_id}_shards_stats")
+        results = pipe.execute()
+
+        return (
+            results[-4] == 1,
+            results[-3],
+            sum(int(requests) for requests in results[-2]),
+            [json.loads(stats) for stats in results[-1]],
+        )
+
+    def close_shards(self, task_id: int):
+        self.redis.srem(sharded_tasks_name, task_id)
+
+    def serialize(self, kind: str, item) -> bytes:
+        return task_wire.encode(queue_schemas[kind], item)
+
+    def enqueue(self, kind: str, item, urgent: bool = False):
+        if self.spool:
+            self.spool.write(kind, queue_schemas[kind], item)
+            return
+
+        if not self.flusher:
+            self.redis.xadd(
+                queue_name(item.task_id, kind), {"d": self.serialize(kind, item)}
+            )
+            return
+
+        # never blocks, it runs while responses stream, producers wait before requests
+        with self.buffer_lock:
+            self.buffer.append((kind, item))
+            full = len(self.buffer) >= ENQUEUE_BATCH_SIZE
+
+        if full or urgent:
+            self.flush_event.set()
+
+    def buffer_full(self) -> bool:
+        return len(self.buffer) >= ENQUEUE_BUFFER_MAX and not self.closing
+
+    def wait_backlog(self, task_id: int):
+        """Block until the buffer, held back by a full queue, has room for a new request.
+
+        Requests in flight keep streaming meanwhile, so only new arrivals are throttled.
+        """
+        if not self.buffer_full():
+            return
+
+        started = time.perf_counter()
+        while self.buffer_full():
+            sleep(ENQUEUE_FLUSH_MS / 1000)
+
+        waited_ms = round((time.perf_counter() - started) * 1000)
+        self.redis.hincrby(overflow_name(task_id), "backpressure_ms", waited_ms)
+
+    async def wait_room(self, task_id: int):
+        """Await room in the buffer before a new request, like wait_backlog on an event loop."""
+        if not self.buffer_full():
+            return
+
+        started = time.perf_counter()
+        while self.buffer_full():
+            await asyncio.sleep(ENQUEUE_FLUSH_MS / 1000)
+
+        waited_ms = round((time.perf_counter() - started) * 1000)
+        self.redis.hincrby(overflow_name(task_id), "backpressure_ms", waited_ms)
+
+    def flush_loop(self):
+        while not self.closing:
+            self.flush_event.wait(ENQUEUE_FLUSH_MS / 1000)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Flush Error: {e}", exc_info=True)
+                sleep(1)
+
+    def flush(self):
+        """Push the buffered items to Redis in one transaction, in the order they were enqueued.
+
+        Items stay buffered when the push fails, so the next flush retries them.
+        """
+        with self.flush_lock:
+            with self.buffer_lock:
+                items, self.buffer = self.buffer, []
+
+            if not items:
+                return
+
+            try:
+                held = self.push(items)
+            except Exception:
+                with self.buffer_lock:
+                    self.buffer = items + self.buffer
+                raise
+
+            if held:
+                with self.buffer_lock:
+                    self.buffer = held + self.buffer
+
+    def push(self, items: list) -> list:
+        """Push items to their task queues, spilling or holding back those of full queues.
+
+        Returns:
+            list: Items held back until their queues have room
+        """
+        full = self.full_tasks({item.task_id for _, item in items})
+        held = []
+        spilled = {}
+
+        pipe = self.redis.pipeline()
+        for kind, item in items:
+            if item.task_id not in full:
+                pipe.xadd(
+                    queue_name(item.task_id, kind),
+                    {"d": self.serialize(kind, item)},
+                )
+            elif self.queue_overflow == QUEUE_OVERFLOW_SPILL:
+                spilled.setdefault(item.task_id, []).append(
+                    (kind, self.serialize(kind, item))
+                )
+            else:
+                held.append((kind, item))
+
+        for task_id in full:
+            pipe.hsetnx(overflow_name(task_id), "overflowed_at", int(time_now()))
+        self.write_spilled(pipe, spilled)
+        pipe.execute()
+        return held
+
+    def write_spilled(self, pipe, spilled: dict):
+        """Append the (kind, payload) records of each task to its segments, and count them."""
+        for task_id, records in spilled.items():
+            written = self.spill_writer(task_id).write(records)
+            pipe.hincrby(overflow_name(task_id), "spilled_records", len(records))
+            pipe.hincrby(overflow_name(task_id), "spilled_bytes", written)
+
+    def spill_buffer(self):
+        """Spill the items still held back, queue workers store them from the segments."""
+        with self.buffer_lock:
+            items, self.buffer = self.buffer, []
+
+        spilled = {}
+        for kind, item in items:
+            spilled.setdefault(item.task_id, []).append(
+                (kind, self.serialize(kind, item))
+            )
+
+        try:
+            pipe = self.redis.pipeline()
+            self.write_spilled(pipe, spilled)
+            pipe.execute()
+            logger.warning(f"{len(items)} held back items spilled on close")
+        except Exception as e:
+            logger.error(f"Spilling {len(items)} held back items on close failed: {e}")
+
+    def full_tasks(self, task_ids: set) -> set:
+        """Return the tasks whose queues hold queue_limit records or more."""
+        if not self.queue_limit:
+            return set()
+        return {
+            task_id
+            for task_id in task_ids
+            if self.task_queue_len(task_id) >= self.queue_limit
+        }
+
+    def spill_writer(self, task_id: int) -> SpillWriter:
+        if task_id not in self.spill_writers:
+            self.spill_writers[task_id] = SpillWriter(task_id)
+        return self.spill_writers[task_id]
+
+    def request_enqueue(self, task):
+        # a completed request flushes at once, with the chunks and logs before it
+        self.enqueue(QUEUE_REQUESTS, task, urgent=True)
+        self.requests_enqueued += 1
+
+    def chunk_enqueue(self, task):
+        self.enqueue(QUEUE_CHUNKS, task)
 
     def log_enqueue(self, task):
-        task_json = self.serialize(task)
-        self.redis.rpush(logs_queue_name, task_json)
-
-    def log_dequeue(self):
-        if task_json := self.redis.lpop(logs_queue_name):
-            task_dict = json.loads(task_json.decode("utf-8"))
-            Logs = create_log_table_class(task_dict["task_id"])
-            return self.deserialize(task_dict, Logs())
-        return None
+        self.enqueue(QUEUE_LOGS, task)
+
+    def create_queue_group(self, name: str):
+        try:
+            self.redis.xgroup_create(name, ingest_group_name, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def open_task_queues(self, task_id: int):
+        """Create the queues of a task and add it to the tasks queue workers read from.
+
+        The task counts as producing until finish_producing, its queues are not
+        drained before that even when they are empty.
+        """
+        for kind in queue_kinds:
+            self.create_queue_group(queue_name(task_id, kind))
+        clear_task_spool(task_id)
+
+        pipe = self.redis.pipeline()
+        pipe.delete(
+            f"task_{task_id}_drained", f"task_{task_id}_counts", overflow_name(task_id)
+        )
+        pipe.set(f"task_{task_id}_producing", 1)
+        pipe.sadd(active_tasks_name, task_id)
+        pipe.xadd(queue_wakeup_name, {"task_id": task_id}, maxlen=100, approximate=True)
+        pipe.execute()
+
+    def finish_producing(self, task_id: int):
+        """Called once everything the task's executors enqueued is in Redis."""
+        self.redis.delete(f"task_{task_id}_producing")
+
+    def task_producing(self, task_id: int) -> bool:
+        return bool(self.redis.exists(f"task_{task_id}_producing"))
+
+    def active_tasks(self) -> list:
+        return sorted(
+            int(task_id) for task_id in self.redis.smembers(active_tasks_name)
+        )
+
+    def active_queues(self) -> list:
+        """Return (kind, queue name) of every queue of the active tasks, chunks and logs first."""
+        task_ids = self.active_tasks()
+        return [
+            (kind, queue_name(task_id, kind))
+            for kind in queue_kinds
+            for task_id in task_ids
+        ]
+
+    def task_queue_len(self, task_id: int) -> int:
+        """Return the entries of a task not stored yet, read or not."""
+        pipe = self.redis.pipeline()
+        for kind in queue_kinds:
+            pipe.xlen(queue_name(task_id, kind))
+        return sum(pipe.execute())
+
+    def task_drained(self, task_id: int) -> bool:
+        """Whether every chunk, log and request of the task's last run is stored."""
+        return bool(self.redis.exists(f"task_{task_id}_drained"))
+
+    def task_backlog(self, task_id: int) -> dict:
+        """Return what of the task's last run is not stored yet, empty once all of it is.
+
+        Returns:
+            dict: Nonzero counts of queued, pending (read, not acknowledged) entries,
+                spilled segments and spool files, and active while the task is not drained
+        """
+        backlog = {
+            "active": int(self.redis.sismember(active_tasks_name, task_id)),
+            "queued": self.task_queue_len(task_id),
+            "pending": self.queue_pending(task_id),
+            "segments": spill_backlog(task_id)[0],
+            "spools": len(pending_spools(task_id)),
+        }
+        return {name: count for name, count in backlog.items() if count}
+
+    def close_drained_queues(self, task_id: int) -> bool:
+        """Mark the task drained once it finished producing, its queues are empty and
+        its spilled segments are stored.
+
+        Returns:
+            bool: Whether the task is drained
+        """
+        if self.task_producing(task_id):
+            return False
+        if self.task_queue_len(task_id) > 0:
+            return False
+        if task_segments(task_id) or pending_spools(task_id):
+            return False
+
+        pipe = self.redis.pipeline()
+        pipe.set(f"task_{task_id}_drained", 1)
+        pipe.srem(active_tasks_name, task_id)
+        pipe.delete(*[queue_name(task_id, kind) for kind in queue_kinds])
+        pipe.execute()
+        remove_task_spill_dir(task_id)
+        remove_task_spool_dir(task_id)
+        logger.info(f"task {task_id} queues drained")
+        return True
+
+    def count_requests(self, counts: dict):
+        """Add newly stored requests to the task counters, counts maps a task id to (succeed, failed)."""
+        pipe = self.redis.pipeline()
+        for task_id, (succeed, failed) in counts.items():
+            pipe.hincrby(f"task_{task_id}_counts", "succeed", succeed)
+            pipe.hincrby(f"task_{task_id}_counts", "failed", failed)
+        pipe.execute()
+
+    def request_counts(self, task_id: int) -> tuple:
+        """Return the stored (succeed, failed) requests of the task's last run."""
+        succeed, failed = self.redis.hmget(
+            f"task_{task_id}_counts", "succeed", "failed"
+        )
+        return int(succeed or 0), int(failed or 0)
+
+    def overflow_stats(self, task_id: int) -> dict:
+        """Return how the task's last run overflowed its queues, empty if it did not."""
+        # overflowed_at was written as a float timestamp before
+        return {
+            key.decode(): int(float(value))
+            for key, value in self.redis.hgetall(overflow_name(task_id)).items()
+        }
 
-    def log_len(self) -> int:
-        return self.redis.llen(logs_queue_name)
+    def claim_counts_flush(self, task_id: int, interval_ms: int) -> bool:
+        """Whether this worker writes the task counters to MySQL, one worker per interval."""
+        return bool(
+            self.redis.set(f"task_{task_id}_counts_flush", 1, nx=True, px=interval_ms)
+        )
+
+    def move_legacy_queues(self):
+        """Move items left in the queues shared by all tasks to the queues of their task."""
+        for legacy_name in legacy_queue_names:
+            legacy_type = self.redis.type(legacy_name)
+            if legacy_type not in (b"list", b"stream"):
+                continue
+
+            kind = legacy_name.split("_")[0]
+            moved = 0
+            while True:
+                if legacy_type == b"list":
+                    items = self.redis.lpop(legacy_name, ENQUEUE_BATCH_SIZE) or []
+                else:
+                    entries = self.redis.xrange(legacy_name, count=ENQUEUE_BATCH_SIZE)
+                    items = [fields[b"d"] for _, fields in entries]
+                if not items:
+                    break
+
+                task_ids = set()
+                pipe = self.redis.pipeline()
+                for item in items:
+                    task_id = task_wire.decode(item)["task_id"]
+                    task_ids.add(task_id)
+                    pipe.xadd(queue_name(task_id, kind), {"d": item})
+                if legacy_type == b"stream":
+                    pipe.xdel(legacy_name, *[entry_id for entry_id, _ in entries])
+                pipe.execute()
+
+                for task_id in task_ids:
+                    self.open_task_queues(task_id)
+                    # whatever produced these items stopped before the upgrade
+                    self.finish_producing(task_id)
+                moved += len(items)
+
+            self.redis.delete(legacy_name)
+            logger.info(f"Moved {moved} items from {legacy_name} to the task queues")
+
+    def queue_entries(self, kind: str, name: str, entries: list) -> list:
+        """Decode stream entries to (kind, queue name, entry id, column dict), skipping deleted ones."""
+        return [
+            (kind, name, entry_id, task_wire.decode(fields[b"d"]))
+            for entry_id, fields in entries
+            if entry_id and fields
+        ]
+
+    def read_queues(self, consumer: str, count: int, block_ms: int) -> list:
+        """Read entries of the active tasks not delivered to any consumer yet.
+
+        Blocks up to block_ms for new entries, count applies to each queue. Without
+        active tasks it blocks until a task opens its queues, up to block_ms.
+
+        Returns:
+            list: (kind, queue name, entry id, column dict), chunks and logs first
+        """
+        queues = self.active_queues()
+        if not queues:
+            # the last wakeup before checking again, so a task opened since is not missed
+            latest = self.redis.xrevrange(queue_wakeup_name, count=1)
+            if not self.active_queues():
+                self.redis.xread(
+                    {queue_wakeup_name: latest[0][0] if latest else "0-0"},
+                    count=1,
+                    block=max(1, block_ms),
+                )
+            return []
+
+        try:
+            streams = self.redis.xreadgroup(
+                ingest_group_name,
+                consumer,
+                {name: ">" for _, name in queues},
+                count=count,
+                block=block_ms,
+            )
+        except ResponseError as e:
+            # another worker closed a task and deleted its queues while this read blocked
+            if not queue_gone(e) or self.active_queues() == queues:
+                raise
+            return []
+
+        read = {}
+        for name, entries in streams or []:
+            read[name.decode()] = entries
+
+        return [
+            entry
+            for kind, name in queues
+            for entry in self.queue_entries(kind, name, read.get(name, []))
+        ]
+
+    def ack_queues(self, entries: list):
+        """Acknowledge stored entries and delete them from their queues."""
+        if not entries:
+            return
+
+        queues = {}
+        for _, name, entry_id, _ in entries:
+            queues.setdefault(name, []).append(entry_id)
+
+        pipe = self.redis.pipeline()
+        for name, entry_ids in queues.items():
+            pipe.xack(name, ingest_group_name, *entry_ids)
+            pipe.xdel(name, *entry_ids)
+        pipe.execute()
+
+    def reclaim_queues(self, consumer: str, count: int) -> list:
+        """Claim the entries other consumers did not acknowledge within INGEST_RECLAIM_IDLE_MS.
+
+        Entries delivered INGEST_MAX_DELIVERIES times are dropped instead, so a row
+        that can never be stored does not block the queue.
+
+        Returns:
+            list: (kind, queue name, entry id, column dict) of the claimed entries
+        """
+        claimed = []
+        for kind, name in self.active_queues():
+            try:
+                pending = self.redis.xpending_range(
+                    name,
+                    ingest_group_name,
+                    min="-",
+                    max="+",
+                    count=count,
+                    idle=INGEST_RECLAIM_IDLE_MS,
+                )
+            except ResponseError as e:
+                # the task was closed since active_queues
+                if not queue_gone(e):
+                    raise
+                continue
+
+            dropped = [
+                entry["message_id"]
+                for entry in pending
+                if entry["times_delivered"] >= INGEST_MAX_DELIVERIES
+            ]
+            if dropped:
+                logger.error(
+                    f"Dropped {len(dropped)} entries of {name} delivered {INGEST_MAX_DELIVERIES} times: {dropped}"
+                )
+                self.ack_queues([(kind, name, entry_id, None) for entry_id in dropped])
+
+            retried = [
+                entry["message_id"]
+                for entry in pending
+                if entry["times_delivered"] < INGEST_MAX_DELIVERIES
+            ]
+            if retried:
+                try:
+                    entries = self.redis.xclaim(
+                        name,
+                        ingest_group_name,
+                        consumer,
+                        INGEST_RECLAIM_IDLE_MS,
+                        retried,
+                    )
+                except ResponseError as e:
+                    if not queue_gone(e):
+                        raise
+                    continue
+                claimed += self.queue_entries(kind, name, entries)
+
+        return claimed
+
+    def remove_idle_consumers(self, idle_ms: int):
+        """Remove consumers that have nothing pending and were idle for idle_ms."""
+        for _, name in self.active_queues():
+            try:
+                for consumer in self.redis.xinfo_consumers(name, ingest_group_name):
+                    if consumer["pending"] == 0 and consumer["idle"] > idle_ms:
+                        self.redis.xgroup_delconsumer(
+                            name, ingest_group_name, consumer["name"]
+                        )
+            except ResponseError as e:
+                if not queue_gone(e):
+                    raise
+
+    def queue_lag(self, task_id: int = None) -> dict:
+        """Return entries not yet read and read but not acknowledged, per queue.
+
+        Args:
+            task_id: Only the queues of this task, all active tasks by default
+        """
+        if task_id is None:
+            names = [name for _, name in self.active_queues()]
+        else:
+            names = [queue_name(task_id, kind) for kind in queue_kinds]
+
+        lag = {}
+        for name in names:
+            try:
+                groups = self.redis.xinfo_groups(name)
+            except ResponseError as e:
+                if not queue_gone(e):
+                    raise
+                continue
+            for group in groups:
+                if group["name"] in (ingest_group_name, ingest_group_name.encode()):
+                    lag[name] = {
+                        "lag": group.get("lag"),
+                        "pending": group["pending"],
+                    }
+        return lag
+
+    def queue_pending(self, task_id: int = None) -> int:
+        return sum(lag["pending"] for lag in self.queue_lag(task_id).values())
 
     def len(self):
-        return self.request_len() + self.chunk_len() + self.log_len()
+        """Return the entries of all active tasks not stored yet."""
+        return sum(self.task_queue_len(task_id) for task_id in self.active_tasks())
+
+    def report_ingest_rate(self, owner: str, rows_per_sec: float):
+        self.redis.hset(
+            ingest_rates_name,
+            owner,
+            json.dumps({"rows_per_sec": rows_per_sec, "updated_at": time_now()}),
+        )
+
+    def ingest_rate(self) -> float:
+        """Return the rows per second all queue workers ingested lately."""
+        rate = 0
+        for owner, report in self.redis.hgetall(ingest_rates_name).items():
+            report = json.loads(report)
+            if time_now() - report["updated_at"] > INGEST_RATE_TTL * 1000:
+                self.redis.hdel(ingest_rates_name, owner)
+                continue
+            rate += report["rows_per_sec"]
+        return round(rate, 2)
 
     def close(self):
-        self.redis.close()
+        try:
+            if self.flusher:
+                self.closing = True
+                self.flush_event.set()
+                self.flusher.join()
+                # held back items wait until their queues have room, those left after
+                # ENQUEUE_CLOSE_TIMEOUT are spilled, so closing never hangs
+                deadline = time.monotonic() + ENQUEUE_CLOSE_TIMEOUT
+                while True:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        logger.error(f"Flush Error: {e}", exc_info=True)
+                    if not self.buffer or time.monotonic() > deadline:
+                        break
+                    sleep(ENQUEUE_FLUSH_MS / 1000)
+                if self.buffer:
+                    self.spill_buffer()
+        finally:
+            for writer in self.spill_writers.values():
+                writer.seal()
+            if self.spool:
+                self.spool.close()
+            self.redis.close()
 
     def connect(self):
         host = os.getenv("REDIS_HOST", "localhost")
@@ -101,5 +844,5 @@ class TaskCache:
         return Redis(host=host, port=port, db=0)
 
     def reset(self):
-        self.close()
+        self.redis.close()
         self.redis = self.connect()
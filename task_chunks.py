@@ -0,0 +1,82 @@
+"""Chunk arrival times and lengths of a request, packed into one blob on the request row.
+
+Arrival offsets from the request start are delta encoded in microseconds, so most values
+are the small gaps between tokens, then the arrays are msgpacked and zlib compressed.
+"""
+
+import zlib
+import msgpack
+import numpy as np
+from tables import Tasks
+from helper import format_milliseconds
+from config import CHUNK_STORAGE_PACKED
+
+PACK_V1 = 1
+
+
+def is_packed(task: Tasks) -> bool:
+    return task.chunk_storage == CHUNK_STORAGE_PACKED
+
+
+def pack_chunks(offsets_us: list, token_lens: list, characters_lens: list) -> bytes:
+    """Pack the arrival offsets, in microseconds from the request start, and lengths of chunks."""
+    deltas = [
+        offset - previous for previous, offset in zip([0] + offsets_us[:-1], offsets_us)
+    ]
+    return zlib.compress(msgpack.packb([PACK_V1, deltas, token_lens, characters_lens]))
+
+
+def unpack_chunks(blob: bytes) -> dict:
+    """Unpack a blob of pack_chunks to numpy arrays.
+
+    Returns:
+        dict: offsets_us from the request start, gaps_us since the chunk before,
+            token_lens and characters_lens, one item per chunk
+    """
+    version, deltas, token_lens, characters_lens = msgpack.unpackb(
+        zlib.decompress(blob)
+    )
+    if version != PACK_V1:
+        raise ValueError(f"Unknown chunk pack version {version}")
+
+    gaps_us = np.asarray(deltas, dtype=np.int64)
+    return {
+        "offsets_us": np.cumsum(gaps_us),
+        "gaps_us": gaps_us,
+        "token_lens": np.asarray(token_lens, dtype=np.int64),
+        "characters_lens": np.asarray(characters_lens, dtype=np.int64),
+    }
+
+
+def chunk_rows(request) -> list:
+    """Rebuild the chunk rows of a request from its packed arrays, contents cut from the response."""
+    if not request.chunk_arrays:
+        return []
+
+    arrays = unpack_chunks(request.chunk_arrays)
+    response = request.response or ""
+
+    rows = []
+    position = 0
+    for index, (offset_us, gap_us, token_len, characters_len) in enumerate(
+        zip(
+            arrays["offsets_us"],
+            arrays["gaps_us"],
+            arrays["token_lens"],
+            arrays["characters_lens"],
+        )
+    ):
+        rows.append(
+            {
+                "created_at": format_milliseconds(
+                    int(request.start_req_time + offset_us / 1000)
+                ),
+                "chunk_index": index + 1,
+                "chunk_content": response[position : position + characters_len],
+                "token_len": int(token_len),
+                "request_latency_ms": float(offset_us) / 1000,
+                "last_token_latency_ms": float(gap_us) / 1000 if index > 0 else 0,
+            }
+        )
+        position += characters_len
+    return rows
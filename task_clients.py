@@ -0,0 +1,292 @@
+"""SDK clients for the model types, shared per process in Warm connection mode.
+
+Warm clients are keyed by model type, endpoint, key, version, timeout and pool size,
+and keep their connections alive between requests. Cold clients are built for one
+request and closed after it, so every request pays for a new TCP and TLS handshake.
+"""
+
+import asyncio
+import threading
+import aiohttp
+import httpx
+import openai
+import requests
+from openai import AsyncAzureOpenAI, AzureOpenAI
+from azure.ai.inference import ChatCompletionsClient
+from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
+from ollama import AsyncClient, Client
+from tables import Tasks
+from config import (
+    CLIENT_KEEPALIVE_EXPIRY,
+    CLIENT_MAX_CONNECTIONS,
+    CLIENT_MAX_KEEPALIVE,
+    CONNECTION_WARM,
+)
+
+shared_clients = {}
+
+shared_clients_lock = threading.Lock()
+
+# async clients are bound to the event loop they were created on
+shared_async_clients = {}
+
+
+def is_warm(task: Tasks) -> bool:
+    return task.connection_mode == CONNECTION_WARM
+
+
+def pool_size(task: Tasks) -> int:
+    """Connections a warm client may open, at least one per thread of the task."""
+    return max(CLIENT_MAX_CONNECTIONS, task.threads or 0)
+
+
+def http_limits(task: Tasks):
+    return httpx.Limits(
+        max_connections=pool_size(task),
+        max_keepalive_connections=max(CLIENT_MAX_KEEPALIVE, task.threads or 0),
+        keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY,
+    )
+
+
+def client_key(task: Tasks, kind: str):
+    return (
+        kind,
+        task.azure_endpoint,
+        task.deployment_name,
+        task.api_key,
+        task.api_version,
+        task.timeout,
+        pool_size(task),
+    )
+
+
+def shared_client(key: tuple, factory):
+    if client := shared_clients.get(key):
+        return client
+
+    with shared_clients_lock:
+        if key not in shared_clients:
+            shared_clients[key] = factory()
+        return shared_clients[key]
+
+
+def shared_async_client(key: tuple, factory):
+    key = (id(asyncio.get_running_loop()),) + key
+    if key not in shared_async_clients:
+        shared_async_clients[key] = factory()
+    return shared_async_clients[key]
+
+
+async def close_async_clients():
+    """Close the async clients of the running event loop, before the loop ends."""
+    loop_id = id(asyncio.get_running_loop())
+    for key in [key for key in shared_async_clients if key[0] == loop_id]:
+        client = shared_async_clients.pop(key)
+        await client_aclose(client)
+
+
+async def client_aclose(client):
+    if isinstance(client, httpx.AsyncClient):
+        await client.aclose()
+    elif isinstance(client, AsyncClient):
+        await client._client.aclose()
+    else:
+        await client.close()
+
+
+def client_close(client):
+    if isinstance(client, Client):
+        client._client.close()
+    else:
+        client.close()
+
+
+def aoai_client(task: Tasks, http_client=None):
+    return AzureOpenAI(
+        api_version=task.api_version,
+        azure_endpoint=task.azure_endpoint,
+        azure_deployment=task.deployment_name,
+        api_key=task.api_key,
+        timeout=httpx.Timeout(task.timeout / 1000),
+        http_client=http_client,
+    )
+
+
+def api_client(task: Tasks, http_client=None):
+    return openai.Client(
+        base_url=task.azure_endpoint, api_key=task.api_key, http_client=http_client
+    )
+
+
+def ollama_client(task: Tasks, **kwargs):
+    return Client(
+        host=task.azure_endpoint,
+        headers={"api-key": task.api_key if task.api_key else ""},
+        timeout=httpx.Timeout(task.timeout / 1000),
+        **kwargs,
+    )
+
+
+def foundry_client(task: Tasks, **kwargs):
+    return ChatCompletionsClient(
+        endpoint=task.azure_endpoint,
+        credential=AzureKeyCredential(task.api_key),
+        **kwargs,
+    )
+
+
+def http_client(task: Tasks, **kwargs):
+    return httpx.Client(timeout=httpx.Timeout(task.timeout / 1000), **kwargs)
+
+
+def requests_transport(task: Tasks):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=CLIENT_MAX_KEEPALIVE, pool_maxsize=pool_size(task)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+
+def get_aoai_client(task: Tasks) -> AzureOpenAI:
+    if not is_warm(task):
+        return aoai_client(task)
+
+    return shared_client(
+        client_key(task, "aoai"),
+        lambda: aoai_client(task, httpx.Client(limits=http_limits(task))),
+    )
+
+
+def get_api_client(task: Tasks) -> openai.Client:
+    if not is_warm(task):
+        return api_client(task)
+
+    return shared_client(
+        client_key(task, "api"),
+        lambda: api_client(task, httpx.Client(limits=http_limits(task))),
+    )
+
+
+def get_ollama_client(task: Tasks) -> Client:
+    if not is_warm(task):
+        return ollama_client(task)
+
+    return shared_client(
+        client_key(task, "ollama"),
+        lambda: ollama_client(task, limits=http_limits(task)),
+    )
+
+
+def get_foundry_client(task: Tasks) -> ChatCompletionsClient:
+    if not is_warm(task):
+        return foundry_client(task)
+
+    return shared_client(
+        client_key(task, "foundry"),
+        lambda: foundry_client(task, transport=requests_transport(task)),
+    )
+
+
+def get_http_client(task: Tasks) -> httpx.Client:
+    if not is_warm(task):
+        return http_client(task)
+
+    return shared_client(
+        client_key(task, "http"),
+        lambda: http_client(task, limits=http_limits(task)),
+    )
+
+
+def get_async_aoai_client(task: Tasks) -> AsyncAzureOpenAI:
+    def factory(http_client=None):
+        return AsyncAzureOpenAI(
+            api_version=task.api_version,
+            azure_endpoint=task.azure_endpoint,
+            azure_deployment=task.deployment_name,
+            api_key=task.api_key,
+            timeout=httpx.Timeout(task.timeout / 1000),
+            http_client=http_client,
+        )
+
+    if not is_warm(task):
+        return factory()
+
+    return shared_async_client(
+        client_key(task, "aoai"),
+        lambda: factory(httpx.AsyncClient(limits=http_limits(task))),
+    )
+
+
+def get_async_api_client(task: Tasks) -> openai.AsyncClient:
+    def factory(http_client=None):
+        return openai.AsyncClient(
+            base_url=task.azure_endpoint,
+            api_key=task.api_key,
+            http_client=http_client,
+        )
+
+    if not is_warm(task):
+        return factory()
+
+    return shared_async_client(
+        client_key(task, "api"),
+        lambda: factory(httpx.AsyncClient(limits=http_limits(task))),
+    )
+
+
+def get_async_ollama_client(task: Tasks) -> AsyncClient:
+    def factory(**kwargs):
+        return AsyncClient(
+            host=task.azure_endpoint,
+            headers={"api-key": task.api_key if task.api_key else ""},
+            timeout=httpx.Timeout(task.timeout / 1000),
+            **kwargs,
+        )
+
+    if not is_warm(task):
+        return factory()
+
+    return shared_async_client(
+        client_key(task, "ollama"),
+        lambda: factory(limits=http_limits(task)),
+    )
+
+
+def get_async_foundry_client(task: Tasks) -> AsyncChatCompletionsClient:
+    def factory(**kwargs):
+        return AsyncChatCompletionsClient(
+            endpoint=task.azure_endpoint,
+            credential=AzureKeyCredential(task.api_key),
+            **kwargs,
+        )
+
+    if not is_warm(task):
+        return factory()
+
+    def warm_factory():
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=pool_size(task),
+                keepalive_timeout=CLIENT_KEEPALIVE_EXPIRY,
+            )
+        )
+        return factory(transport=AioHttpTransport(session=session, session_owner=True))
+
+    return shared_async_client(client_key(task, "foundry"), warm_factory)
+
+
+def get_async_http_client(task: Tasks) -> httpx.AsyncClient:
+    def factory(**kwargs):
+        return httpx.AsyncClient(timeout=httpx.Timeout(task.timeout / 1000), **kwargs)
+
+    if not is_warm(task):
+        return factory()
+
+    return shared_async_client(
+        client_key(task, "http"),
+        lambda: factory(limits=http_limits(task)),
+    )
@@ -1,7 +1,7 @@
 import traceback
 import streamlit as st
 from task_loads import sql_query
-from tables import Tasks
+from tables import Tasks, task_table
 from logger import logger
 
 
@@ -23,7 +23,7 @@ def report_number(sql_string: str, index: int):
 
 def task_count(task: Tasks):
 
-    requests = f"requests_{task.id}"
+    requests = task_table("requests", task.id)
 
     return {
         "Duration Seconds": report_number(
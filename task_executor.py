@@ -1,52 +1,522 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import wait
+from helper import get_mysql_session, time_now
 from tables import Tasks
 from task_cache import TaskCache
 from task_runtime import TaskRuntime
+from task_executor_async import async_executor, merge_loop_lag_reports
+from task_loads import plan_task, update_task_engine_stats
+from task_schedule import (
+    arrival_offsets,
+    profile_phases,
+    profile_target,
+    request_slot,
+    shard_slots,
+    slot_activation,
+)
+from worker_queue import check_status
 from theodoretools.bot import feishu_text
 from concurrent.futures import ThreadPoolExecutor
 from logger import logger
-from config import APP_URL
+from config import (
+    APP_URL,
+    ENGINE_ASYNCIO,
+    LOAD_MODE_OPEN,
+    LOAD_MODE_PROFILE,
+    QUEUE_LIMIT,
+    PROCESS_START_DELAY_MS,
+    RESULT_SINK_SPOOL,
+    SHARD_LEASE_MS,
+)
 
 
 def safe_create_and_run_task(
-    task: Tasks, thread_num: int, request_index: int, cache: TaskCache
+    task: Tasks,
+    thread_num: int,
+    request_index: int,
+    cache: TaskCache,
+    scheduled_time: float = None,
+    load_phase: str = None,
 ):
     task_runtime = TaskRuntime(
-        task=task, thread_num=thread_num, request_index=request_index, cache=cache
+        task=task,
+        thread_num=thread_num,
+        request_index=request_index,
+        cache=cache,
+        scheduled_time=scheduled_time,
+        load_phase=load_phase,
     )
     task_runtime.latency()
+    return task_runtime
 
 
-def task_executor(task: Tasks):
+def perf_counter_at(started_at: float) -> float:
+    """Return the perf_counter reading, in seconds, at the wall clock time started_at in milliseconds."""
+    return time.perf_counter() + (started_at - time_now()) / 1000
 
-    if task.feishu_token:
-        feishu_text(
-            f"start to run {task.name}: {APP_URL}/?task_id={task.id}", task.feishu_token
+
+def wait_start(started_at: float):
+    delay = started_at - time_now()
+    if delay > 0:
+        time.sleep(delay / 1000)
+
+
+def run_slot(task: Tasks, thread_num: int, cache: TaskCache, started_at: float):
+    """Run the requests of one concurrency slot back to back.
+
+    Each request is scheduled when the previous one in the slot completed, the
+    first one when the task started, so time lost in the harness is not hidden.
+    """
+    scheduled_time = started_at
+    for request_index in range(task.request_per_thread):
+        task_runtime = safe_create_and_run_task(
+            task, thread_num, request_index + 1, cache, scheduled_time
         )
+        scheduled_time = task_runtime.request.completed_at
 
-    cache = TaskCache()
 
-    try:
-        with ThreadPoolExecutor(max_workers=task.threads) as executor:
-            futures = [
+def thread_executor(task: Tasks, cache: TaskCache, slots: range, started_at: float):
+    wait_start(started_at)
+
+    with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+        futures = [
+            executor.submit(
+                run_slot,
+                task,
+                thread_num,
+                cache,
+                started_at,
+            )
+            for thread_num in slots
+        ]
+
+        for future in futures:
+            try:
+                logger.info(future.result())
+            except Exception as e:
+                logger.error(f"Threads Error: {e}", exc_info=True)
+
+
+def open_loop_thread_executor(
+    task: Tasks, cache: TaskCache, slots: range, started_at: float
+):
+    """Send requests on the task's arrival schedule, whether or not earlier ones finished.
+
+    Concurrency caps the requests in flight, a request waiting for a free thread
+    keeps its scheduled time so the delay stays visible. Every process schedules
+    against the same started_at, so their arrivals add up to the task's rate.
+    """
+    offsets = arrival_offsets(
+        task.arrival_distribution,
+        task.arrival_rate,
+        task.threads * task.request_per_thread,
+        task.burst_size,
+        seed=task.id,
+    )
+
+    started = perf_counter_at(started_at)
+    stopped = False
+    checked = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+        futures = []
+        for index, offset in enumerate(offsets):
+            thread_num, request_index = request_slot(task, index)
+            if thread_num not in slots:
+                continue
+
+            now = time.perf_counter()
+            if now - checked >= 1:
+                stopped = cache.task_stopped(task.id)
+                checked = now
+
+            delay = started + offset - now
+            if delay > 0 and not stopped:
+                time.sleep(delay)
+
+            futures.append(
                 executor.submit(
                     safe_create_and_run_task,
                     task,
-                    thread_index + 1,
-                    request_index + 1,
+                    thread_num,
+                    request_index,
                     cache,
+                    started_at + offset * 1000,
                 )
-                for thread_index in range(task.threads)
-                for request_index in range(task.request_per_thread)
-            ]
+            )
+
+        for future in futures:
+            try:
+                logger.info(future.result())
+            except Exception as e:
+                logger.error(f"Threads Error: {e}", exc_info=True)
+
+
+def run_profile_slot(
+    task: Tasks,
+    thread_num: int,
+    cache: TaskCache,
+    phases: list,
+    started: float,
+    started_at: float,
+    stopped: threading.Event,
+):
+    """Run one concurrency slot while the load profile keeps it active.
+
+    Returns:
+        int: Number of requests the slot sent
+    """
+    requests = 0
+    scheduled_time = None
+
+    while not stopped.is_set():
+        elapsed = time.perf_counter() - started
+        activation = slot_activation(phases, thread_num, elapsed)
+        if activation is None:
+            break
+
+        if activation > elapsed:
+            if stopped.wait(activation - elapsed):
+                break
+            scheduled_time = started_at + activation * 1000
+        elif scheduled_time is None:
+            scheduled_time = started_at + elapsed * 1000
+
+        load_phase, _ = profile_target(phases, (scheduled_time - started_at) / 1000)
+
+        requests += 1
+        task_runtime = safe_create_and_run_task(
+            task, thread_num, requests, cache, scheduled_time, load_phase
+        )
+        scheduled_time = task_runtime.request.completed_at
+
+    return requests
+
+
+def profile_thread_executor(
+    task: Tasks, cache: TaskCache, slots: range, started_at: float
+):
+    """Follow the task's load profile, starting and parking slots as concurrency moves.
+
+    Returns:
+        int: Number of requests sent
+    """
+    # validated once, the slots look the phases up on every request
+    phases = profile_phases(task.load_profile)
+    started = perf_counter_at(started_at)
+    stopped = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+        futures = [
+            executor.submit(
+                run_profile_slot,
+                task,
+                thread_num,
+                cache,
+                phases,
+                started,
+                started_at,
+                stopped,
+            )
+            for thread_num in slots
+        ]
+
+        while wait(futures, timeout=1).not_done:
+            if cache.task_stopped(task.id):
+                stopped.set()
+
+        requests = 0
+        for future in futures:
+            try:
+                requests += future.result()
+            except Exception as e:
+                logger.error(f"Threads Error: {e}", exc_info=True)
+
+    return requests
+
+
+def run_engine(task: Tasks, cache: TaskCache, slots: range, started_at: float):
+    """Run the task's concurrency slots in this process with the task's engine.
+
+    started_at is the wall clock time in milliseconds every process of the task
+    schedules its requests from.
+
+    Returns:
+        tuple: Event loop lag report (None for the thread engine), requests sent
+    """
+    if task.engine == ENGINE_ASYNCIO:
+        return asyncio.run(async_executor(task, cache, slots, started_at))
+
+    if task.load_mode == LOAD_MODE_PROFILE:
+        return None, profile_thread_executor(task, cache, slots, started_at)
+
+    if task.load_mode == LOAD_MODE_OPEN:
+        open_loop_thread_executor(task, cache, slots, started_at)
+    else:
+        thread_executor(task, cache, slots, started_at)
+
+    return None, None
+
+
+def task_processes(task: Tasks) -> int:
+    """Return how many processes run the task, 0 processes means one per CPU core."""
+    processes = task.processes or os.cpu_count() or 1
+    return max(1, min(processes, task.threads))
+
+
+def start_epoch(task: Tasks) -> float:
+    """Return the time the task's requests are scheduled from, in milliseconds.
+
+    Child processes take a moment to spawn, so the task starts that much later.
+    """
+    if task_processes(task) > 1 and task.threads > 1:
+        return time_now() + PROCESS_START_DELAY_MS
+    return time_now()
+
+
+def task_cache(task: Tasks) -> TaskCache:
+    """Return the cache the executors of the task enqueue their results to."""
+    spool = task.result_sink == RESULT_SINK_SPOOL
+    return TaskCache(
+        buffered=not spool,
+        queue_limit=task.queue_limit or QUEUE_LIMIT,
+        queue_overflow=task.queue_overflow,
+        spool=spool,
+    )
+
+
+def shard_process(
+    task: Tasks,
+    slots: range,
+    started_at: float,
+    stop_event,
+    progress,
+    results,
+):
+    """Child process entry, runs a range of slots with its own Redis connection."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    cache = task_cache(task)
+    finished = threading.Event()
+
+    def watch():
+        while not finished.wait(1):
+            progress.value = cache.requests_enqueued
+            if stop_event.is_set():
+                cache.stopped = True
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+
+    try:
+        logger.info(f"task {task.id} process {os.getpid()} runs slots {slots}")
+        results.put(run_engine(task, cache, slots, started_at))
+    except Exception as e:
+        logger.error(f"Process Error: {e}", exc_info=True)
+        results.put((None, None))
+    finally:
+        finished.set()
+        progress.value = cache.requests_enqueued
+        cache.close()
+
+
+def process_executor(task: Tasks, slots: range, processes: int, started_at: float):
+    """Split the slots across child processes and wait for all of them.
+
+    The parent logs aggregated progress, and on SIGINT/SIGTERM asks the children
+    to stop sending requests before it exits.
 
-            for future in futures:
-                try:
-                    logger.info(future.result())
-                except Exception as e:
-                    logger.error(f"Threads Error: {e}", exc_info=True)
+    Returns:
+        tuple: Merged event loop lag report, requests sent
+    """
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    results = context.Queue()
+
+    shards = []
+    for shard in shard_slots(slots, processes):
+        progress = context.Value("i", 0)
+        process = context.Process(
+            target=shard_process,
+            args=(task, shard, started_at, stop_event, progress, results),
+            daemon=True,
+        )
+        process.start()
+        shards.append((process, progress))
+
+    received = []
+
+    def handle_signal(signum, frame):
+        logger.warning(f"task {task.id} received signal {signum}, stopping processes")
+        received.append(signum)
+        stop_event.set()
+
+    previous_handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous_handlers[signum] = signal.signal(signum, handle_signal)
+
+    reports = []
+    requests = 0
+    pending = len(shards)
+    logged = time.perf_counter()
+
+    try:
+        while pending:
+            try:
+                engine_stats, shard_requests = results.get(timeout=1)
+                pending -= 1
+                if engine_stats:
+                    reports.append(engine_stats)
+                requests += shard_requests or 0
+            except queue.Empty:
+                if not any(process.is_alive() for process, _ in shards):
+                    logger.error(f"task {task.id} {pending} processes exited early")
+                    break
+
+            if time.perf_counter() - logged >= 5:
+                done = sum(progress.value for _, progress in shards)
+                logger.info(f"task {task.id} requests done: {done}")
+                logged = time.perf_counter()
+
+        for process, _ in shards:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    if received:
+        signal.raise_signal(received[0])
+
+    return merge_loop_lag_reports(reports), requests
+
+
+def finish_profile(task: Tasks, requests: int):
+    """Record how many requests a profile sent, then check whether they are all stored."""
+    plan_task(task.id, requests)
+
+    db = get_mysql_session()
+    cache = TaskCache()
+    try:
+        check_status(db, cache, task.id)
+    finally:
+        db.close()
+        cache.close()
+
+
+def execute_slots(task: Tasks, slots: range, started_at: float):
+    """Run a range of the task's slots, in child processes when the task asks for them.
+
+    All of them schedule their requests from started_at, see start_epoch.
+
+    Returns:
+        tuple: Event loop lag report, requests sent
+    """
+    processes = task_processes(task)
+    if processes > 1 and len(slots) > 1:
+        return process_executor(task, slots, processes, started_at)
+
+    cache = task_cache(task)
+    try:
+        return run_engine(task, cache, slots, started_at)
+    finally:
+        cache.close()
+
+
+def task_executor(task: Tasks):
+
+    if task.feishu_token:
+        feishu_text(
+            f"start to run {task.name}: {APP_URL}/?task_id={task.id}", task.feishu_token
+        )
+
+    try:
+        engine_stats, requests = execute_slots(
+            task, range(1, task.threads + 1), start_epoch(task)
+        )
+
+        if engine_stats:
+            update_task_engine_stats(task.id, engine_stats)
+
+        if task.load_mode == LOAD_MODE_PROFILE:
+            finish_profile(task, requests)
 
     except Exception as e:
         logger.error(f"Task Error: {e}", exc_info=True)
         raise e
     finally:
+        cache = TaskCache()
+        try:
+            cache.finish_producing(task.id)
+        finally:
+            cache.close()
+
+
+def start_shards(task: Tasks):
+    """Open the task's shards for request workers, the caller then claims one itself."""
+    if task.feishu_token:
+        feishu_text(
+            f"start to run {task.name}: {APP_URL}/?task_id={task.id}", task.feishu_token
+        )
+
+    cache = TaskCache()
+    try:
+        cache.create_shards(task.id, min(task.shards, task.threads))
+    finally:
+        cache.close()
+
+
+def shard_executor(task: Tasks, shard_index: int, shards: int, owner: str):
+    """Run one shard of a task once every shard is claimed.
+
+    Shards start together on the Redis clock. The worker finishing the last shard
+    stores the merged loop lag report and, for load profiles, the request count.
+    """
+    cache = TaskCache()
+    slots = shard_slots(range(1, task.threads + 1), shards)[shard_index]
+    finished = threading.Event()
+
+    def renew():
+        while not finished.wait(SHARD_LEASE_MS / 3000):
+            if not cache.renew_shard(task.id, shard_index, owner):
+                logger.warning(f"task {task.id} shard {shard_index} lease lost")
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+
+    try:
+        # the shared start on the local clock, processes spawn until then
+        started_at = cache.wait_shard_start(task.id, shards) + cache.clock_offset_ms()
+
+        logger.info(f"task {task.id} shard {shard_index} runs slots {slots}")
+        engine_stats, requests = execute_slots(task, slots, started_at)
+
+        first_finish, shards_done, shards_requests, shards_stats = cache.finish_shard(
+            task.id, shard_index, requests, engine_stats
+        )
+
+        # only the worker finishing the last shard, a re-run shard does not finish twice
+        if first_finish and shards_done >= shards:
+            cache.close_shards(task.id)
+            cache.finish_producing(task.id)
+
+            if engine_stats := merge_loop_lag_reports(shards_stats):
+                update_task_engine_stats(task.id, engine_stats)
+
+            if task.load_mode == LOAD_MODE_PROFILE:
+                finish_profile(task, shards_requests)
+
+    except Exception as e:
+        logger.error(f"Shard Error: {e}", exc_info=True)
+        raise e
+    finally:
+        finished.set()
         cache.close()
@@ -0,0 +1,256 @@
+import asyncio
+import numpy as np
+from helper import time_now
+from tables import Tasks
+from task_cache import TaskCache
+from task_runtime_async import AsyncTaskRuntime
+from task_clients import close_async_clients
+from task_schedule import (
+    arrival_offsets,
+    profile_phases,
+    profile_target,
+    request_slot,
+    slot_activation,
+)
+from config import LOAD_MODE_OPEN, LOAD_MODE_PROFILE, LOOP_LAG_INTERVAL
+from logger import logger
+
+
+async def monitor_loop_lag(samples: list, interval: float = LOOP_LAG_INTERVAL):
+    """Sample how late the event loop wakes up from a fixed sleep, in milliseconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append((loop.time() - expected) * 1000)
+
+
+def loop_lag_report(samples: list):
+    if not samples:
+        return None
+
+    return {
+        "Loop Lag P50 (ms)": round(float(np.percentile(samples, 50)), 2),
+        "Loop Lag P99 (ms)": round(float(np.percentile(samples, 99)), 2),
+        "Loop Lag Max (ms)": round(float(max(samples)), 2),
+        "Loop Lag Samples": len(samples),
+    }
+
+
+def merge_loop_lag_reports(reports: list):
+    """Merge the loop lag reports of several processes, keeping the worst lag."""
+    if not reports:
+        return None
+
+    merged = {}
+    for report in reports:
+        for key, value in report.items():
+            if key == "Loop Lag Samples":
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged[key] = max(merged.get(key, value), value)
+    return merged
+
+
+async def run_slot(task: Tasks, thread_num: int, cache: TaskCache, started_at: float):
+    scheduled_time = started_at
+    for request_index in range(task.request_per_thread):
+        task_runtime = AsyncTaskRuntime(
+            task=task,
+            thread_num=thread_num,
+            request_index=request_index + 1,
+            cache=cache,
+            scheduled_time=scheduled_time,
+        )
+        await task_runtime.latency()
+        scheduled_time = task_runtime.request.completed_at
+
+
+async def run_request(
+    task: Tasks,
+    thread_num: int,
+    request_index: int,
+    cache: TaskCache,
+    scheduled_time: float,
+    semaphore: asyncio.Semaphore,
+):
+    async with semaphore:
+        task_runtime = AsyncTaskRuntime(
+            task=task,
+            thread_num=thread_num,
+            request_index=request_index,
+            cache=cache,
+            scheduled_time=scheduled_time,
+        )
+        await task_runtime.latency()
+
+
+def loop_time_at(started_at: float) -> float:
+    """Return the event loop time, in seconds, at the wall clock time started_at in milliseconds."""
+    return asyncio.get_running_loop().time() + (started_at - time_now()) / 1000
+
+
+async def closed_loop(task: Tasks, cache: TaskCache, slots: range, started_at: float):
+    delay = started_at - time_now()
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+    return await asyncio.gather(
+        *[run_slot(task, thread_num, cache, started_at) for thread_num in slots],
+        return_exceptions=True,
+    )
+
+
+async def open_loop(task: Tasks, cache: TaskCache, slots: range, started_at: float):
+    """Send requests on the task's arrival schedule, whether or not earlier ones finished.
+
+    Every process schedules against the same started_at, so their arrivals add up to
+    the task's rate.
+    """
+    offsets = arrival_offsets(
+        task.arrival_distribution,
+        task.arrival_rate,
+        task.threads * task.request_per_thread,
+        task.burst_size,
+        seed=task.id,
+    )
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(len(slots))
+    started = loop_time_at(started_at)
+    stopped = False
+    checked = loop.time()
+
+    pending = []
+    for index, offset in enumerate(offsets):
+        thread_num, request_index = request_slot(task, index)
+        if thread_num not in slots:
+            continue
+
+        now = loop.time()
+        if now - checked >= 1:
+            stopped = cache.task_stopped(task.id)
+            checked = now
+
+        delay = started + offset - now
+        if delay > 0 and not stopped:
+            await asyncio.sleep(delay)
+
+        pending.append(
+            asyncio.create_task(
+                run_request(
+                    task,
+                    thread_num,
+                    request_index,
+                    cache,
+                    started_at + offset * 1000,
+                    semaphore,
+                )
+            )
+        )
+
+    return await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def run_profile_slot(
+    task: Tasks,
+    thread_num: int,
+    cache: TaskCache,
+    phases: list,
+    started: float,
+    started_at: float,
+    stopped: asyncio.Event,
+):
+    loop = asyncio.get_running_loop()
+    requests = 0
+    scheduled_time = None
+
+    while not stopped.is_set():
+        elapsed = loop.time() - started
+        activation = slot_activation(phases, thread_num, elapsed)
+        if activation is None:
+            break
+
+        if activation > elapsed:
+            try:
+                await asyncio.wait_for(stopped.wait(), activation - elapsed)
+                break
+            except TimeoutError:
+                scheduled_time = started_at + activation * 1000
+        elif scheduled_time is None:
+            scheduled_time = started_at + elapsed * 1000
+
+        load_phase, _ = profile_target(phases, (scheduled_time - started_at) / 1000)
+
+        requests += 1
+        task_runtime = AsyncTaskRuntime(
+            task=task,
+            thread_num=thread_num,
+            request_index=requests,
+            cache=cache,
+            scheduled_time=scheduled_time,
+            load_phase=load_phase,
+        )
+        await task_runtime.latency()
+        scheduled_time = task_runtime.request.completed_at
+
+    return requests
+
+
+async def profile_loop(task: Tasks, cache: TaskCache, slots: range, started_at: float):
+    """Follow the task's load profile, starting and parking slots as concurrency moves."""
+    # validated once, the slots look the phases up on every request
+    phases = profile_phases(task.load_profile)
+    started = loop_time_at(started_at)
+    stopped = asyncio.Event()
+
+    running = asyncio.gather(
+        *[
+            run_profile_slot(
+                task, thread_num, cache, phases, started, started_at, stopped
+            )
+            for thread_num in slots
+        ],
+        return_exceptions=True,
+    )
+
+    while not running.done():
+        await asyncio.wait([running], timeout=1)
+        if cache.task_stopped(task.id):
+            stopped.set()
+
+    return await running
+
+
+async def async_executor(
+    task: Tasks, cache: TaskCache, slots: range, started_at: float
+):
+    """Run the task's requests as coroutines on one event loop, scheduled from started_at.
+
+    Returns:
+        tuple: Event loop lag report (None if no sample was taken), requests sent
+    """
+    samples = []
+    monitor = asyncio.create_task(monitor_loop_lag(samples))
+    requests = 0
+
+    try:
+        if task.load_mode == LOAD_MODE_PROFILE:
+            results = await profile_loop(task, cache, slots, started_at)
+        elif task.load_mode == LOAD_MODE_OPEN:
+            results = await open_loop(task, cache, slots, started_at)
+        else:
+            results = await closed_loop(task, cache, slots, started_at)
+
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Coroutine Error: {result}", exc_info=result)
+            elif isinstance(result, int):
+                requests += result
+    finally:
+        monitor.cancel()
+        await close_async_clients()
+
+    report = loop_lag_report(samples)
+    logger.info(f"task {task.id} event loop lag: {report}")
+    return report, requests
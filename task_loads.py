@@ -1,20 +1,24 @@
+from numbers import Number
 from typing import List
-from sqlalchemy import text
+import numpy as np
+from sqlalchemy import text, update
 from dotenv import load_dotenv
 import streamlit_authenticator as stauth
-from helper import get_mysql_session
-from tables import (
-    Users,
-    create_chunk_table_class,
-    create_request_table_class,
-    create_log_table_class,
+from helper import (
+    analytics_columns,
+    analytics_query,
+    get_analytics,
+    get_mysql_session,
+    session_scope,
 )
+from tables import Users, Chunks, Requests, Logs
 from tables import Tasks
 import streamlit as st
 from logger import logger
 import copy
 
 from task_cache import TaskCache
+from config import DB_BACKEND, DB_BACKEND_SQLITE, SQL_FETCH_ROWS
 
 load_dotenv()
 
@@ -71,18 +75,72 @@ def load_all_users() -> List[Users]:
 
 
 def sql_query(sql: str):
+    if DB_BACKEND == DB_BACKEND_SQLITE and get_analytics() is not None:
+        return analytics_query(sql)
+
     session = get_mysql_session()
-    result = session.execute(text(sql))
-    session.close()
+    try:
+        return session.execute(text(sql)).fetchall()
+    finally:
+        session.close()
+
 
-    return result
+def column_array(values) -> np.ndarray:
+    """Return a column as a float array with NaN for NULL, or as an object array if not numeric."""
+    if isinstance(values, np.ma.MaskedArray):
+        if values.dtype.kind in "biuf":
+            return values.astype(np.float64).filled(np.nan)
+        return np.where(np.ma.getmaskarray(values), None, values.data).astype(object)
+    if isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+        return values.astype(np.float64)
+
+    sample = next((value for value in values if value is not None), None)
+    if sample is None or isinstance(sample, Number):
+        return np.array(values, dtype=np.float64)
+    return np.array(values, dtype=object)
+
+
+def concat_columns(parts: list) -> np.ndarray:
+    """Join the arrays of a column fetched in parts, object if any part is not numeric."""
+    if not parts:
+        return np.array([], dtype=np.float64)
+    if all(part.dtype != object for part in parts):
+        return np.concatenate(parts)
+    return np.concatenate(
+        [
+            part if part.dtype == object else np.where(np.isnan(part), None, part)
+            for part in parts
+        ]
+    )
 
 
-def sql_commit(sql: str):
+def sql_columns(sql: str) -> dict:
+    """Run a query and return its result by column, see column_array.
+
+    Rows are streamed from the database and turned into arrays SQL_FETCH_ROWS at a
+    time, so a large result is never held as Python tuples all at once.
+    """
+    if DB_BACKEND == DB_BACKEND_SQLITE and get_analytics() is not None:
+        columns = analytics_columns(sql)
+        return {name: column_array(values) for name, values in columns.items()}
+
     session = get_mysql_session()
-    session.execute(text(sql))
-    session.commit()
-    session.close()
+    try:
+        result = session.execute(text(sql), execution_options={"stream_results": True})
+        names = list(result.keys())
+        parts = {name: [] for name in names}
+        for rows in result.partitions(SQL_FETCH_ROWS):
+            for name, values in zip(names, zip(*rows)):
+                parts[name].append(column_array(values))
+    finally:
+        session.close()
+
+    return {name: concat_columns(parts[name]) for name in names}
+
+
+def sql_commit(sql: str):
+    with session_scope() as session:
+        session.execute(text(sql))
 
 
 def rebuild_task(task_id: int):
@@ -106,6 +164,8 @@ def queue_task(task: Tasks):
         task.status = 1
         task.error_message = ""
         session.commit()
+        cache = TaskCache()
+        cache.notify_task_event()
     except Exception as e:
         session.rollback()
         logger.error(f"Error: {e}")
@@ -151,6 +211,21 @@ def update_task(task_update: Tasks, messages: list):
         task.message_type = task_update.message_type
         task.temperature = task_update.temperature
         task.max_tokens = task_update.max_tokens
+        task.engine = task_update.engine
+        task.load_mode = task_update.load_mode
+        task.arrival_rate = task_update.arrival_rate
+        task.arrival_distribution = task_update.arrival_distribution
+        task.burst_size = task_update.burst_size
+        task.load_profile = task_update.load_profile
+        task.processes = task_update.processes
+        task.shards = task_update.shards
+        task.connection_mode = task_update.connection_mode
+        task.token_counting = task_update.token_counting
+        task.transport = task_update.transport
+        task.queue_limit = task_update.queue_limit
+        task.queue_overflow = task_update.queue_overflow
+        task.result_sink = task_update.result_sink
+        task.chunk_storage = task_update.chunk_storage
 
         session.commit()
     except Exception as e:
@@ -219,17 +294,57 @@ def add_task(task: Tasks):
         session.close()
 
 
-def run_task(task_id: int):
+def run_task(task_id: int) -> bool:
+    """Move a queued task to running, False if another worker already took it."""
     session = get_mysql_session()
     try:
-        task = session.query(Tasks).filter(Tasks.id == task_id).first()
-        task.status = 2
-        task.error_message = ""
-        task.request_failed = 0
-        task.request_succeed = 0
+        result = session.execute(
+            update(Tasks)
+            .where(Tasks.id == task_id, Tasks.status == 1)
+            .values(
+                status=2,
+                error_message="",
+                request_failed=0,
+                request_succeed=0,
+                engine_stats=None,
+                request_planned=None,
+                queue_stats=None,
+            )
+        )
         session.commit()
+        if result.rowcount != 1:
+            return False
         cache = TaskCache()
-        cache.update_task_status(task.id, 2)
+        cache.update_task_status(task_id, 2)
+        cache.open_task_queues(task_id)
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error: {e}")
+        return False
+    finally:
+        session.close()
+
+
+def update_task_engine_stats(task_id: int, engine_stats: dict | None):
+    session = get_mysql_session()
+    try:
+        task = session.query(Tasks).filter(Tasks.id == task_id).first()
+        task.engine_stats = engine_stats
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error: {e}")
+    finally:
+        session.close()
+
+
+def plan_task(task_id: int, request_planned: int):
+    session = get_mysql_session()
+    try:
+        task = session.query(Tasks).filter(Tasks.id == task_id).first()
+        task.request_planned = request_planned
+        session.commit()
     except Exception as e:
         session.rollback()
         logger.error(f"Error: {e}")
@@ -309,7 +424,6 @@ def load_all_tasks() -> List[Tasks]:
 
 
 def load_all_requests(task_id: int):
-    Requests = create_request_table_class(task_id)
     session = get_mysql_session()
 
     requests = (
@@ -323,7 +437,9 @@ def load_all_requests(task_id: int):
             Requests.output_token_count,
             Requests.success,
             Requests.start_req_time,
+            Requests.scheduled_req_time,
         )
+        .filter(Requests.task_id == task_id)
         .order_by(Requests.start_req_time.desc())
         .limit(10000)
         .all()
@@ -336,11 +452,11 @@ def load_all_requests(task_id: int):
 
 def load_all_chunks(task_id: int, request_id: str):
     session = get_mysql_session()
-    Chunks = create_chunk_table_class(task_id)
 
     results = (
         session.query(Chunks)
         .filter(
+            Chunks.task_id == task_id,
             Chunks.request_id == request_id,
         )
         .order_by(Chunks.created_at.asc())
@@ -355,11 +471,11 @@ def load_all_chunks(task_id: int, request_id: str):
 
 def load_all_logs(task_id: int, request_id: str):
     session = get_mysql_session()
-    Logs = create_log_table_class(task_id)
 
     results = (
         session.query(Logs)
         .filter(
+            Logs.task_id == task_id,
             Logs.request_id == request_id,
         )
         .order_by(Logs.created_at.asc())
@@ -389,10 +505,13 @@ def task_dequeue() -> Tasks | None:
 
 
 def find_request(task_id: int, request_id: str):
-    Requests = create_request_table_class(task_id)
     session = get_mysql_session()
 
-    request = session.query(Requests).filter(Requests.id == request_id).first()
+    request = (
+        session.query(Requests)
+        .filter(Requests.task_id == task_id, Requests.id == request_id)
+        .first()
+    )
 
     session.close()
 
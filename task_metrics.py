@@ -1,58 +1,190 @@
-"""Provides statistical metrics calculation functions for task performance analysis."""
+"""Provides statistical metrics calculation functions for task performance analysis.
+
+The requests and chunks of a task are loaded once, one query per table, into numpy
+columns with NaN for NULL, and every metric is computed from those columns.
+"""
 
 import numpy as np
 import streamlit as st
-from task_loads import sql_query
-from tables import Tasks
-from config import NOT_SUPPORT_STREAM_MODELS
+from task_loads import sql_columns, sql_query
+from tables import Tasks, task_table
+from task_schedule import profile_phases
+from task_chunks import is_packed, unpack_chunks
+from config import LOAD_MODE_PROFILE, NOT_SUPPORT_STREAM_MODELS
 from logger import logger
 
+request_fields = (
+    "thread_num",
+    "success",
+    "load_phase",
+    "created_at",
+    "start_req_time",
+    "scheduled_req_time",
+    "end_req_time",
+    "first_token_latency_ms",
+    "last_token_latency_ms",
+    "request_latency_ms",
+    "input_token_count",
+    "output_token_count",
+    "chunks_count",
+)
+chunk_fields = ("created_at", "thread_num", "token_len", "characters_len")
+
 
 def format_number(number: int):
     return number
     # return f"{number:,}"
 
 
-def report_number(sql_string: str, index: int):
-    """Calculate statistical metrics from SQL query results.
-
-    Args:
-        sql_string: SQL query to execute
-        index: Column index to analyze from results
+def report_values(request_count):
+    """Calculate statistical metrics of a list or array of numbers.
 
     Returns:
         dict: Statistical metrics including percentiles, avg, min, max
     """
+    if len(request_count):
+        p50, p90, p99, p999 = np.percentile(request_count, [50, 90, 99, 99.9])
+        return {
+            "P50": format_number(int(p50)),
+            "P90": format_number(int(p90)),
+            "P99": format_number(int(p99)),
+            "P999": format_number(int(p999)),
+            "Avg": format_number(int(np.mean(request_count))),
+            "Min": format_number(int(np.min(request_count))),
+            "Max": format_number(int(np.max(request_count))),
+        }
+
+    return {
+        "P50": None,
+        "P90": None,
+        "P99": None,
+        "P999": None,
+        "Avg": None,
+        "Min": None,
+        "Max": None,
+    }
+
+
+def known(*columns: np.ndarray) -> np.ndarray:
+    """Mask of the rows where none of the columns is NULL."""
+    return np.logical_and.reduce([~np.isnan(column) for column in columns])
+
+
+def report_column(values: np.ndarray, mask: np.ndarray):
+    """Metrics of the values of the masked rows, as integers like the rows of a query."""
+    return report_values(np.trunc(values[mask]))
+
+
+def dense_index(values: np.ndarray) -> np.ndarray:
+    """Number the values in ascending order, equal values alike.
+
+    Integers spanning a range no larger than their count are offset from the smallest,
+    without sorting, numbers of values absent from the range are skipped.
+    """
+    if len(values) and not np.isnan(values).any():
+        low = values.min()
+        if values.max() - low <= max(len(values), 1 << 16):
+            return (values - low).astype(np.int64)
+
+    _, index = np.unique(values, return_inverse=True)
+    return index.reshape(-1)
+
+
+def bucket_index(times: np.ndarray, unit_ms: int) -> np.ndarray:
+    """Return the ROUND(time / unit_ms) bucket of each row, numbered in ascending order."""
+    # ROUND of MySQL, halves away from zero
+    return dense_index(np.floor(times / unit_ms + 0.5))
+
+
+def bucket_counts(index: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Count the masked rows per bucket, buckets without any are left out."""
+    counts = np.bincount(index, weights=mask)
+    return counts[counts > 0]
+
+
+def bucket_sums(index: np.ndarray, values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Sum the values of the masked rows per bucket, buckets without any are left out."""
+    # weighting the rows instead of selecting them saves copying the columns
+    counts = np.bincount(index, weights=mask)
+    sums = np.bincount(index, weights=np.where(mask, values, 0))
+    return sums[counts > 0]
+
+
+def bucket_positive_sums(index: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Sum the positive values per bucket, buckets without any are left out."""
+    sums = np.bincount(index, weights=np.where(values > 0, values, 0))
+    return sums[sums > 0]
+
+
+def bucket_distinct(
+    index: np.ndarray, values: np.ndarray, mask: np.ndarray
+) -> np.ndarray:
+    """Count the distinct values of the masked rows per bucket, NULL values aside, buckets
+    without any row are left out.
+    """
+    rows = np.bincount(index, weights=mask)
+    counts = np.zeros(len(rows), dtype=np.int64)
+
+    valued = mask & ~np.isnan(values)
+    if valued.any():
+        if not valued.all():
+            index, values = index[valued], values[valued]
+        value_index = dense_index(values)
+        width = int(value_index.max()) + 1
+        pairs = index * width + value_index
+
+        if len(rows) * width <= max(len(pairs), 1 << 24):
+            seen = np.zeros(len(rows) * width, dtype=bool)
+            seen[pairs] = True
+            counts = seen.reshape(len(rows), width).sum(axis=1)
+        else:
+            counts = np.bincount(np.unique(pairs) // width, minlength=len(rows))
+    return counts[rows > 0]
+
+
+def empty_columns(fields: tuple) -> dict:
+    return {field: np.array([], dtype=np.float64) for field in fields}
+
+
+def load_columns(table: str, fields: tuple) -> dict:
+    """Load the fields of all rows of a result table, one query."""
     try:
-        # logger.info(sql_string)
+        return sql_columns(f"SELECT {', '.join(fields)} FROM {table}")
+    except Exception as e:
+        logger.error(e)
+        st.error(e)
 
-        res = sql_query(sql_string)
+    return empty_columns(fields)
 
-        if request_count := [int(item[index]) for item in res]:
 
+def packed_chunk_columns(requests: str) -> dict:
+    """Chunk columns of a task in Packed chunk storage, unpacked from its requests."""
+    try:
+        res = sql_query(
+            f"SELECT thread_num, start_req_time, chunk_arrays FROM {requests} WHERE chunk_arrays is not null"
+        )
+
+        created_at, threads, token_lens, characters_lens = [], [], [], []
+        for thread_num, start_req_time, blob in res:
+            arrays = unpack_chunks(blob)
+            created_at.append(np.floor(start_req_time + arrays["offsets_us"] / 1000))
+            threads.append(np.full(len(arrays["offsets_us"]), thread_num))
+            token_lens.append(arrays["token_lens"])
+            characters_lens.append(arrays["characters_lens"])
+
+        if created_at:
             return {
-                "P50": format_number(int(np.percentile(request_count, 50))),
-                "P90": format_number(int(np.percentile(request_count, 90))),
-                "P99": format_number(int(np.percentile(request_count, 99))),
-                "P999": format_number(int(np.percentile(request_count, 99.9))),
-                "Avg": format_number(int(np.mean(request_count))),
-                "Min": format_number(min(request_count)),
-                "Max": format_number(max(request_count)),
+                "created_at": np.concatenate(created_at).astype(np.float64),
+                "thread_num": np.concatenate(threads).astype(np.float64),
+                "token_len": np.concatenate(token_lens).astype(np.float64),
+                "characters_len": np.concatenate(characters_lens).astype(np.float64),
             }
 
     except Exception as e:
         logger.error(e)
         st.error(e)
 
-    return {
-        "P50": None,
-        "P90": None,
-        "P99": None,
-        "P999": None,
-        "Avg": None,
-        "Min": None,
-        "Max": None,
-    }
+    return empty_columns(chunk_fields)
 
 
 def task_metrics(task: Tasks):
@@ -66,112 +198,204 @@ def task_metrics(task: Tasks):
     """
     stream = task.model_id not in NOT_SUPPORT_STREAM_MODELS
 
-    chunks = f"chunks_{task.id}"
-    requests = f"requests_{task.id}"
+    requests = task_table("requests", task.id)
+    request_columns = load_columns(requests, request_fields)
 
-    if stream:
-        return {
-            "Concurrency": report_number(
-                f"SELECT COUNT(DISTINCT thread_num) AS request_count FROM {requests}",
-                0,
-            ),
-            "Threads Per Sec": report_number(
-                f"SELECT ROUND((created_at / 1000)) AS timestamp_seconds, COUNT(DISTINCT thread_num) AS request_count FROM {chunks} GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
-                1,
-            ),
-            "Threads Per Minute": report_number(
-                f"SELECT ROUND((created_at / 60000)) AS timestamp_seconds, COUNT(DISTINCT thread_num) AS request_count FROM {chunks} GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
-                1,
-            ),
-            "Requests Per Sec": report_number(
-                f"SELECT ROUND((created_at / 1000)) AS timestamp_seconds, COUNT(DISTINCT id) AS request_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
-                1,
-            ),
-            "Request Per Minute": report_number(
-                f"SELECT ROUND((created_at / 60000)) AS timestamp_seconds, COUNT(DISTINCT id) AS request_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
-                1,
-            ),
-            "Input Token Per Sec": report_number(
-                f"SELECT ROUND((start_req_time / 1000)) AS timestamp_seconds, sum(input_token_count) AS input_token_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
-                1,
-            ),
-            "Input Token Per Minute": report_number(
-                f"SELECT ROUND((start_req_time / 60000)) AS timestamp_seconds, sum(input_token_count) AS input_token_count FROM {requests} WHERE success = 1 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
-                1,
-            ),
-            "Output Token Per Sec": report_number(
-                f"SELECT ROUND((created_at / 1000)) AS timestamp_seconds, sum(token_len) AS token_count FROM {chunks} WHERE token_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
-                1,
-            ),
-            "Output Token Per Minute": report_number(
-                f"SELECT ROUND((created_at / 60000)) AS timestamp_seconds, sum(token_len) AS token_count FROM {chunks} WHERE token_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
-                1,
-            ),
-            "Output Characters Per Sec": report_number(
-                f"SELECT ROUND((created_at / 1000)) AS timestamp_seconds, sum(characters_len) AS characters_count FROM {chunks} WHERE characters_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
-                1,
-            ),
-            "Output Characters Per Minute": report_number(
-                f"SELECT ROUND((created_at / 60000)) AS timestamp_seconds, sum(characters_len) AS characters_count FROM {chunks} WHERE characters_len>0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
-                1,
-            ),
-            "Time To First Token (TTFT) Per Request": report_number(
-                f"SELECT first_token_latency_ms FROM {requests} WHERE first_token_latency_ms is not null;",
-                0,
-            ),
-            "Time Between Tokens (TBT) Per Request": report_number(
-                f"SELECT last_token_latency_ms FROM {requests} WHERE last_token_latency_ms is not null;",
-                0,
-            ),
-            "Request Latency Per Request": report_number(
-                f"SELECT request_latency_ms FROM {requests} WHERE request_latency_ms is not null;",
-                0,
-            ),
-            "Input Token Per Request": report_number(
-                f"SELECT input_token_count FROM {requests} WHERE success = 1 and input_token_count is not null;",
-                0,
-            ),
-            "Chunks Per Request": report_number(
-                f"SELECT chunks_count FROM {requests} WHERE success = 1 and chunks_count is not null;",
-                0,
-            ),
-            "Output Token Per Request": report_number(
-                f"SELECT output_token_count FROM {requests} WHERE success = 1 and output_token_count is not null;",
-                0,
+    if not stream:
+        metrics = batch_metrics(request_columns)
+    elif is_packed(task):
+        metrics = stream_metrics(
+            chunk_metrics(packed_chunk_columns(requests)), request_columns
+        )
+    else:
+        chunk_columns = load_columns(task_table("chunks", task.id), chunk_fields)
+        metrics = stream_metrics(chunk_metrics(chunk_columns), request_columns)
+
+    if task.load_mode == LOAD_MODE_PROFILE and task.load_profile:
+        metrics.update(phase_metrics(task, request_columns))
+
+    return metrics
+
+
+def phase_metrics(task: Tasks, requests: dict):
+    """Break request metrics down per load profile phase.
+
+    Args:
+        task: Task running a load profile
+        requests: Columns of the task's requests
+
+    Returns:
+        dict: Collection of performance metrics, keyed by metric and phase
+    """
+    metrics = {}
+
+    start = requests["start_req_time"]
+    index = bucket_index(start, 1000)
+    succeed = requests["success"] == 1
+    latency = known(requests["request_latency_ms"])
+    scheduled = known(requests["scheduled_req_time"], requests["end_req_time"])
+
+    for phase in profile_phases(task.load_profile):
+        name = phase["name"]
+        where = requests["load_phase"] == name
+
+        metrics[f"[{name}] Concurrency"] = report_values(
+            bucket_distinct(
+                index,
+                requests["thread_num"],
+                where & known(start),
+            )
+        )
+        metrics[f"[{name}] Requests Per Sec"] = report_values(
+            bucket_counts(index, where & succeed)
+        )
+        metrics[f"[{name}] Time To First Token (TTFT)"] = report_column(
+            requests["first_token_latency_ms"],
+            where & known(requests["first_token_latency_ms"]),
+        )
+        metrics[f"[{name}] Request Latency"] = report_column(
+            requests["request_latency_ms"], where & latency
+        )
+        metrics[f"[{name}] Request Latency, Corrected"] = report_column(
+            requests["end_req_time"] - requests["scheduled_req_time"],
+            where & latency & scheduled,
+        )
+
+    return metrics
+
+
+def chunk_metrics(chunks: dict):
+    """Metrics of the chunks of a task, from its chunk rows or its packed chunk arrays."""
+    rows = np.ones(len(chunks["created_at"]), dtype=bool)
+
+    metrics = {}
+    for unit, unit_ms in (("Sec", 1000), ("Minute", 60000)):
+        index = bucket_index(chunks["created_at"], unit_ms)
+        metrics[f"Threads Per {unit}"] = report_values(
+            bucket_distinct(index, chunks["thread_num"], rows)
+        )
+        metrics[f"Output Token Per {unit}"] = report_values(
+            bucket_positive_sums(index, chunks["token_len"])
+        )
+        metrics[f"Output Characters Per {unit}"] = report_values(
+            bucket_positive_sums(index, chunks["characters_len"])
+        )
+    return metrics
+
+
+def stream_metrics(chunk_reports: dict, requests: dict):
+    succeed = requests["success"] == 1
+    threads = known(requests["thread_num"])
+    scheduled = known(requests["scheduled_req_time"])
+    latency = known(requests["request_latency_ms"])
+    created_sec = bucket_index(requests["created_at"], 1000)
+    created_minute = bucket_index(requests["created_at"], 60000)
+    start_sec = bucket_index(requests["start_req_time"], 1000)
+    start_minute = bucket_index(requests["start_req_time"], 60000)
+    input_tokens = np.nan_to_num(requests["input_token_count"])
+
+    return {
+        "Concurrency": report_values([len(np.unique(requests["thread_num"][threads]))]),
+        "Threads Per Sec": chunk_reports["Threads Per Sec"],
+        "Threads Per Minute": chunk_reports["Threads Per Minute"],
+        "Requests Per Sec": report_values(bucket_counts(created_sec, succeed)),
+        "Request Per Minute": report_values(bucket_counts(created_minute, succeed)),
+        "Input Token Per Sec": report_values(
+            bucket_sums(start_sec, input_tokens, succeed)
+        ),
+        "Input Token Per Minute": report_values(
+            bucket_sums(start_minute, input_tokens, succeed)
+        ),
+        "Output Token Per Sec": chunk_reports["Output Token Per Sec"],
+        "Output Token Per Minute": chunk_reports["Output Token Per Minute"],
+        "Output Characters Per Sec": chunk_reports["Output Characters Per Sec"],
+        "Output Characters Per Minute": chunk_reports["Output Characters Per Minute"],
+        "Time To First Token (TTFT) Per Request": report_column(
+            requests["first_token_latency_ms"],
+            known(requests["first_token_latency_ms"]),
+        ),
+        "Time To First Token (TTFT) Per Request, Corrected": report_column(
+            requests["first_token_latency_ms"]
+            + (requests["start_req_time"] - requests["scheduled_req_time"]),
+            known(
+                requests["first_token_latency_ms"],
+                requests["start_req_time"],
+                requests["scheduled_req_time"],
             ),
-        }
+        ),
+        "Time Between Tokens (TBT) Per Request": report_column(
+            requests["last_token_latency_ms"],
+            known(requests["last_token_latency_ms"]),
+        ),
+        "Request Latency Per Request": report_column(
+            requests["request_latency_ms"], latency
+        ),
+        "Request Latency Per Request, Corrected": report_column(
+            requests["end_req_time"] - requests["scheduled_req_time"],
+            latency & scheduled & known(requests["end_req_time"]),
+        ),
+        "Harness Lag Per Request": report_column(
+            requests["start_req_time"] - requests["scheduled_req_time"],
+            scheduled & known(requests["start_req_time"]),
+        ),
+        "Input Token Per Request": report_column(
+            requests["input_token_count"],
+            succeed & known(requests["input_token_count"]),
+        ),
+        "Chunks Per Request": report_column(
+            requests["chunks_count"], succeed & known(requests["chunks_count"])
+        ),
+        "Output Token Per Request": report_column(
+            requests["output_token_count"],
+            succeed & known(requests["output_token_count"]),
+        ),
+    }
+
+
+def batch_metrics(requests: dict):
+    start = known(requests["start_req_time"])
+    scheduled = known(requests["scheduled_req_time"])
+    latency = known(requests["request_latency_ms"])
+    succeed = requests["success"] == 1
+    start_sec = bucket_index(requests["start_req_time"], 1000)
 
     return {
-        "Concurrency": report_number(
-            f"SELECT ROUND((start_req_time / 1000)) AS timestamp_seconds, COUNT(DISTINCT thread_num) AS request_count FROM {requests} WHERE start_req_time is not null GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
-            1,
+        "Concurrency": report_values(
+            bucket_distinct(start_sec, requests["thread_num"], start)
+        ),
+        "Request Per Sec": report_values(bucket_counts(start_sec, start)),
+        "Output Token Per Sec": report_values(
+            bucket_positive_sums(
+                start_sec[start], requests["output_token_count"][start]
+            )
         ),
-        "Request Per Sec": report_number(
-            f"SELECT ROUND((start_req_time / 1000)) AS timestamp_seconds, COUNT(DISTINCT id) AS request_count FROM {requests} WHERE start_req_time is not null GROUP BY timestamp_seconds ORDER BY timestamp_seconds",
-            1,
+        "Time To First Token (TTFT)": report_column(
+            requests["first_token_latency_ms"],
+            known(requests["first_token_latency_ms"]),
         ),
-        "Output Token Per Sec": report_number(
-            f"SELECT ROUND((start_req_time / 1000)) AS timestamp_seconds, sum(output_token_count) AS token_count FROM {requests} WHERE start_req_time is not null and output_token_count > 0 GROUP BY timestamp_seconds ORDER BY timestamp_seconds;",
-            1,
+        "Time To First Token (TTFT), Corrected": report_column(
+            requests["first_token_latency_ms"]
+            + (requests["start_req_time"] - requests["scheduled_req_time"]),
+            known(requests["first_token_latency_ms"]) & start & scheduled,
         ),
-        "Time To First Token (TTFT)": report_number(
-            f"SELECT first_token_latency_ms FROM {requests} WHERE first_token_latency_ms is not null;",
-            0,
+        "Time Between Tokens (TBT)": report_column(
+            requests["last_token_latency_ms"],
+            known(requests["last_token_latency_ms"]),
         ),
-        "Time Between Tokens (TBT)": report_number(
-            f"SELECT last_token_latency_ms FROM {requests} WHERE last_token_latency_ms is not null;",
-            0,
+        "Request Latency": report_column(requests["request_latency_ms"], latency),
+        "Request Latency, Corrected": report_column(
+            requests["end_req_time"] - requests["scheduled_req_time"],
+            latency & scheduled & known(requests["end_req_time"]),
         ),
-        "Request Latency": report_number(
-            f"SELECT request_latency_ms FROM {requests} WHERE request_latency_ms is not null;",
-            0,
+        "Harness Lag": report_column(
+            requests["start_req_time"] - requests["scheduled_req_time"],
+            start & scheduled,
         ),
-        "Chunks Count": report_number(
-            f"SELECT chunks_count FROM {requests} WHERE success = 1 and chunks_count is not null;",
-            0,
+        "Chunks Count": report_column(
+            requests["chunks_count"], succeed & known(requests["chunks_count"])
         ),
-        "Output Token Count": report_number(
-            f"SELECT output_token_count FROM {requests} WHERE success = 1 and output_token_count is not null;",
-            0,
+        "Output Token Count": report_column(
+            requests["output_token_count"],
+            succeed & known(requests["output_token_count"]),
         ),
     }
@@ -1,31 +1,50 @@
+import json
+import time
 import traceback
 from dotenv import load_dotenv
 import httpx
-import tiktoken
-from helper import pad_number, so_far_ms, time_now
+from helper import pad_number, time_now
 from config import (
     MODEL_TYPE_API,
     MODEL_TYPE_AOAI,
     MODEL_TYPE_DS_OLLAMA,
     MODEL_TYPE_DS_FOUNDRY,
     NOT_SUPPORT_STREAM_MODELS,
+    TOKEN_SOURCE_CLIENT,
+    TOKEN_SOURCE_SERVER,
 )
-from tables import (
-    Tasks,
-    create_chunk_table_class,
-    create_log_table_class,
-    create_request_table_class,
-)
+from tables import Chunks, Logs, Requests, Tasks
 from logger import logger
-from openai import AzureOpenAI
-from azure.ai.inference import ChatCompletionsClient
-from azure.core.credentials import AzureKeyCredential
-from ollama import Client
 import threading
 import uuid
-import openai
 
 from task_cache import TaskCache
+from task_chunks import is_packed, pack_chunks
+from task_clients import (
+    client_close,
+    get_aoai_client,
+    get_api_client,
+    get_foundry_client,
+    get_http_client,
+    get_ollama_client,
+    is_warm,
+)
+from task_sse import (
+    SSEParser,
+    request_body,
+    request_headers,
+    request_url,
+    usage_fields,
+    uses_sse,
+)
+from task_tokens import (
+    count_tokens,
+    count_tokens_batch,
+    is_deferred,
+    prompt_tokens,
+    split_tokens,
+    uses_server_usage,
+)
 
 load_dotenv()
 
@@ -33,18 +52,33 @@ load_dotenv()
 class TaskRuntime:
 
     def __init__(
-        self, task: Tasks, thread_num: int, request_index: int, cache: TaskCache
+        self,
+        task: Tasks,
+        thread_num: int,
+        request_index: int,
+        cache: TaskCache,
+        scheduled_time: float = None,
+        load_phase: str = None,
     ):
         self.task = task
-        self.last_token_time = None
+        self.started_ns = None
+        self.last_token_ns = None
         self.thread_num = thread_num
         self.request_index = request_index
         self.cache = cache
         self.stream = False if self.task.model_id in NOT_SUPPORT_STREAM_MODELS else True
-        self.Chunks = create_chunk_table_class(task.id)
-        self.Logs = create_log_table_class(task.id)
+        self.warm = is_warm(task)
+        self.deferred = is_deferred(task)
+        self.deferred_chunks = []
+        self.packed = is_packed(task)
+        self.chunk_offsets_us = []
+        self.chunk_token_lens = []
+        self.chunk_characters_lens = []
+        self.chunk_contents = []
+        self.server_usage = uses_server_usage(task)
+        self.usage = None
+        self.sse = uses_sse(task)
 
-        Requests = create_request_table_class(task.id)
         self.request = Requests(
             id=f"{pad_number(thread_num, task.threads)}{pad_number(request_index, task.request_per_thread)}",
             task_id=self.task.id,
@@ -55,11 +89,14 @@ class TaskRuntime:
             output_token_count=0,
             request_index=self.request_index,
             user_id=self.task.user_id,
+            scheduled_req_time=scheduled_time,
+            load_phase=load_phase,
+            token_source=TOKEN_SOURCE_CLIENT,
         )
         self.log("request created")
 
     def log(self, log_message: str, log_data: dict = None):
-        log_item = self.Logs(
+        log_item = Logs(
             id=f"{uuid.uuid4()}",
             task_id=self.task.id,
             thread_num=self.thread_num,
@@ -109,51 +146,254 @@ class TaskRuntime:
                 f"An error occurred in Method {method.__name__}:\n{error_info}"
             )
 
-    def num_tokens_from_messages(self):
-        tokens_per_message = 3
-        num_tokens = 0
-        for message in self.task.messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if value:
-                    num_tokens += self.encode(value)
-        num_tokens += 3
-        return num_tokens
-
     def encode(self, text):
-        if not text:
-            return 0
+        return count_tokens(self.task, text)
 
-        try:
-            encoding = tiktoken.get_encoding("cl100k_base")
+    def prepare(self):
+        if self.cache.stopped:
+            raise Exception("Worker was stopped")
 
-            if self.task.model_type == MODEL_TYPE_AOAI:
-                encoding = tiktoken.encoding_for_model(self.task.model_id)
-            else:
-                encoding = tiktoken.encoding_for_model("gpt-4o")
+        task_status = self.cache.get_task(self.task.id)
+        if not task_status:
+            raise Exception("Task not found or was deleted")
 
-            return len(encoding.encode(text))
-        except Exception as e:
-            logger.error(f"Error encoding text: {e}")
-            return 0
+        if int(task_status) == 5:
+            raise Exception("Task was stopped")
 
-    def latency(self):
+        self.request.input_token_count = prompt_tokens(self.task)
 
-        try:
-            task_status = self.cache.get_task(self.task.id)
-            if not task_status:
-                raise Exception("Task not found or was deleted")
+        # the only wall clock reading of the request, later times are perf_counter_ns offsets
+        self.request.start_req_time = time_now()
+        self.started_ns = time.perf_counter_ns()
+
+        if not self.request.scheduled_req_time:
+            self.request.scheduled_req_time = self.request.start_req_time
+
+    def elapsed_ms(self, ns: int) -> float:
+        """Milliseconds from the start of the request to a perf_counter_ns reading."""
+        return (ns - self.started_ns) / 1_000_000
+
+    def wall_ms(self, ns: int) -> float:
+        """Wall clock milliseconds of a perf_counter_ns reading, anchored at the request start."""
+        return self.request.start_req_time + self.elapsed_ms(ns)
+
+    def now_ms(self) -> float:
+        if self.started_ns is None:
+            return time_now()
+        return self.wall_ms(time.perf_counter_ns())
+
+    def complete(self):
+        ns = time.perf_counter_ns()
+        self.request.end_req_time = self.wall_ms(ns)
+        self.request.request_latency_ms = self.elapsed_ms(ns)
+
+        if self.request.first_token_latency_ms is not None:
+            self.request.last_token_latency_ms = (
+                (ns - self.last_token_ns) / 1_000_000 if self.last_token_ns else 0
+            )
+
+        self.request.success = 1
+
+    def record_chunk(self, content, arrived_ns: int = None):
+        """Record one streamed chunk, arrived_ns is its perf_counter_ns reading, now by default."""
+        ns = arrived_ns or time.perf_counter_ns()
+        self.request.chunks_count += 1
+
+        last_token_latency_ms = None
+        if self.last_token_ns is None:
+            self.request.first_token_latency_ms = self.elapsed_ms(ns)
+            last_token_latency_ms = 0
+        else:
+            last_token_latency_ms = (ns - self.last_token_ns) / 1_000_000
+        self.last_token_ns = ns
+
+        token_len = 0
+        characters_len = 0
+        if content:
+            logger.debug(content)
+
+            self.request.response += content
+
+            characters_len = len(content)
+
+            if not self.deferred:
+                token_len = self.encode(content)
+                self.request.output_token_count += token_len
+
+        if self.packed:
+            self.chunk_offsets_us.append((ns - self.started_ns) // 1000)
+            self.chunk_token_lens.append(token_len)
+            self.chunk_characters_lens.append(characters_len)
+            if self.deferred:
+                self.chunk_contents.append(content)
+            return
+
+        created_at = self.wall_ms(ns)
+        chunk_item = Chunks(
+            id=f"{self.request.id}{pad_number(self.request.chunks_count, 1000000)}",
+            chunk_index=self.request.chunks_count,
+            thread_num=self.thread_num,
+            task_id=self.task.id,
+            request_id=self.request.id,
+            token_len=token_len,
+            characters_len=characters_len,
+            created_at=int(created_at),
+            created_at_us=int(created_at * 1000),
+            chunk_content=content,
+            last_token_latency_ms=last_token_latency_ms,
+            request_latency_ms=self.elapsed_ms(ns),
+        )
+
+        if self.deferred:
+            self.deferred_chunks.append(chunk_item)
+        else:
+            self.cache.chunk_enqueue(chunk_item)
+
+    def record_usage(
+        self,
+        prompt_tokens: int = None,
+        completion_tokens: int = None,
+        cached_tokens: int = None,
+        reasoning_tokens: int = None,
+    ):
+        """Keep the token usage the server reported at the end of a response."""
+        if not self.server_usage:
+            return
+
+        self.usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "reasoning_tokens": reasoning_tokens,
+        }
+
+    def record_openai_usage(self, usage):
+        if not usage:
+            return
+
+        prompt_details = getattr(usage, "prompt_tokens_details", None)
+        completion_details = getattr(usage, "completion_tokens_details", None)
+        self.record_usage(
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            cached_tokens=getattr(prompt_details, "cached_tokens", None),
+            reasoning_tokens=getattr(completion_details, "reasoning_tokens", None),
+        )
+
+    def record_ollama_usage(self, chunk):
+        if chunk.get("done"):
+            self.record_usage(
+                prompt_tokens=chunk.get("prompt_eval_count"),
+                completion_tokens=chunk.get("eval_count"),
+            )
+
+    def apply_usage(self):
+        """Use the server-reported usage, returns the completion tokens, or None to count on the client."""
+        if not self.usage:
+            return None
+
+        if self.usage["prompt_tokens"] is not None:
+            self.request.input_token_count = self.usage["prompt_tokens"]
+        self.request.cached_token_count = self.usage["cached_tokens"]
+        self.request.reasoning_token_count = self.usage["reasoning_tokens"]
+
+        completion_tokens = self.usage["completion_tokens"]
+        if completion_tokens is not None:
+            self.request.output_token_count = completion_tokens
+            self.request.token_source = TOKEN_SOURCE_SERVER
+        return completion_tokens
+
+    def count_deferred_tokens(self):
+        """Count the tokens of the held chunks, then enqueue them.
+
+        Server-reported completion tokens are spread over the chunks, otherwise
+        the chunks are counted on the client with one batch encode. Packed chunks
+        only keep their token lengths for pack_chunk_arrays.
+        """
+        completion_tokens = self.apply_usage()
+
+        if self.packed:
+            contents = self.chunk_contents
+        else:
+            contents = [chunk.chunk_content for chunk in self.deferred_chunks]
+
+        if not contents:
+            return
+
+        if completion_tokens is None:
+            token_lens = count_tokens_batch(self.task, contents)
+            self.request.output_token_count += sum(token_lens)
+        else:
+            token_lens = split_tokens(completion_tokens, contents)
+
+        if self.packed:
+            self.chunk_token_lens = token_lens
+            self.chunk_contents = []
+            return
+
+        for chunk_item, token_len in zip(self.deferred_chunks, token_lens):
+            chunk_item.token_len = token_len
+            self.cache.chunk_enqueue(chunk_item)
+
+        self.deferred_chunks = []
+
+    def pack_chunk_arrays(self):
+        """Pack the chunks of the request onto the request row, with Packed chunk storage."""
+        if self.packed and self.chunk_offsets_us:
+            self.request.chunk_arrays = pack_chunks(
+                self.chunk_offsets_us,
+                self.chunk_token_lens,
+                self.chunk_characters_lens,
+            )
+
+    def usage_options(self) -> dict:
+        """Ask OpenAI-compatible streams for a final usage chunk when the task uses server usage."""
+        if self.server_usage and self.stream:
+            return {"stream_options": {"include_usage": True}}
+        return {}
+
+    def record_sse_frame(self, arrived_ns: int, payload: bytes):
+        if payload == b"[DONE]":
+            return
+
+        data = json.loads(payload)
+        if usage := data.get("usage"):
+            self.record_usage(**usage_fields(usage))
 
-            if int(task_status) == 5:
-                raise Exception("Task was stopped")
+        if choices := data.get("choices"):
+            self.record_chunk(choices[0].get("delta", {}).get("content"), arrived_ns)
 
-            self.request.input_token_count = self.num_tokens_from_messages()
+    def record_sse_response(self, body: bytes):
+        data = json.loads(body)
+        if usage := data.get("usage"):
+            self.record_usage(**usage_fields(usage))
 
-            self.request.start_req_time = time_now()
+        self.record_response(data["choices"][0]["message"]["content"])
+
+    def record_response(self, content):
+        self.request.response = content
+
+        self.request.first_token_latency_ms = self.elapsed_ms(time.perf_counter_ns())
+
+        self.request.request_latency_ms = self.request.first_token_latency_ms
+
+        self.request.chunks_count = 1
+
+        self.request.output_token_count = self.encode(self.request.response)
+
+    def latency(self):
+
+        try:
+            # before the request starts, so backpressure does not count as its latency
+            self.cache.wait_backlog(self.task.id)
+            self.prepare()
 
             timeout = self.task.timeout / 1000
 
-            if self.task.model_type == MODEL_TYPE_AOAI:
+            if self.sse:
+                self.request_sse()
+
+            elif self.task.model_type == MODEL_TYPE_AOAI:
                 self.request_aoai()
 
             elif self.task.model_type == MODEL_TYPE_DS_OLLAMA:
@@ -168,15 +408,7 @@ class TaskRuntime:
             else:
                 raise Exception(f"Model type {self.task.model_type} not supported")
 
-            self.request.end_req_time = time_now()
-            self.request.request_latency_ms = (
-                self.request.end_req_time - self.request.start_req_time
-            )
-
-            if self.request.first_token_latency_ms:
-                self.request.last_token_latency_ms = so_far_ms(self.last_token_time)
-
-            self.request.success = 1
+            self.complete()
         except TimeoutError as e:
             self.request.success = 0
             self.request.response = f"timeout: {self.task.timeout} ms"
@@ -186,309 +418,176 @@ class TaskRuntime:
             self.request.response = traceback.format_exc()
             logger.error(f"Error: {e}", exc_info=True)
         finally:
-            self.request.completed_at = time_now()
+            self.request.completed_at = self.now_ms()
+            self.count_deferred_tokens()
+            self.pack_chunk_arrays()
             self.cache.request_enqueue(self.request)
 
     def request_ds_ollama(self):
         self.log(f"client init start")
 
-        client = Client(
-            host=self.task.azure_endpoint,
-            headers={"api-key": self.task.api_key if self.task.api_key else ""},
-            timeout=httpx.Timeout(self.task.timeout / 1000),
-        )
+        client = get_ollama_client(self.task)
 
-        self.log(f"client request start")
-        stream = None
-
-        if self.task.enable_think:
-            stream = client.chat(
-                model=self.task.model_id,
-                messages=self.task.messages_loads,
-                stream=True,
-                options={"temperature": self.task.temperature},
-                max_tokens=self.task.max_tokens,
-            )
-        else:
-            stream = client.chat(
-                model=self.task.model_id,
-                messages=self.task.messages_loads,
-                stream=True,
-                format="json",
-                options={"temperature": self.task.temperature},
-                max_tokens=self.task.max_tokens,
-            )
-
-        self.log(f"loop stream start")
-        for chunk in stream:
-            self.request.chunks_count += 1
-
-            content = chunk["message"]["content"]
-            last_token_latency_ms = None
-
-            if not self.request.first_token_latency_ms:
-                self.request.first_token_latency_ms = so_far_ms(
-                    self.request.start_req_time
+        try:
+            self.log(f"client request start")
+            stream = None
+
+            if self.task.enable_think:
+                stream = client.chat(
+                    model=self.task.model_id,
+                    messages=self.task.messages_loads,
+                    stream=True,
+                    options={"temperature": self.task.temperature},
+                    max_tokens=self.task.max_tokens,
                 )
-                last_token_latency_ms = 0
-                self.last_token_time = time_now()
             else:
-                last_token_latency_ms = so_far_ms(self.last_token_time)
-                self.last_token_time = time_now()
-
-            token_len = 0
-            characters_len = 0
-            if content:
-                logger.info(content)
-                self.request.response += content
-                token_len = self.encode(content)
-                characters_len = len(content)
-
-                self.request.output_token_count += token_len
-
-            chunk_item = self.Chunks(
-                id=f"{self.request.id}{pad_number(self.request.chunks_count, 1000000)}",
-                chunk_index=self.request.chunks_count,
-                thread_num=self.thread_num,
-                task_id=self.task.id,
-                request_id=self.request.id,
-                token_len=token_len,
-                characters_len=characters_len,
-                created_at=time_now(),
-                chunk_content=content,
-                request_latency_ms=so_far_ms(self.request.start_req_time),
-                last_token_latency_ms=last_token_latency_ms,
-            )
+                stream = client.chat(
+                    model=self.task.model_id,
+                    messages=self.task.messages_loads,
+                    stream=True,
+                    format="json",
+                    options={"temperature": self.task.temperature},
+                    max_tokens=self.task.max_tokens,
+                )
 
-            self.cache.chunk_enqueue(chunk_item)
+            self.log(f"loop stream start")
+            for chunk in stream:
+                self.record_chunk(chunk["message"]["content"])
+                self.record_ollama_usage(chunk)
 
-        self.log(f"loop stream end")
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                client_close(client)
 
     def request_ds_foundry(self):
         self.log(f"client init start")
 
-        client = ChatCompletionsClient(
-            endpoint=self.task.azure_endpoint,
-            credential=AzureKeyCredential(self.task.api_key),
-        )
-
-        self.log(f"client request start")
-        response = client.complete(
-            stream=True,
-            messages=self.task.messages_loads,
-            max_tokens=self.task.max_tokens,
-            model=self.task.model_id,
-            temperature=self.task.temperature,
-            timeout=httpx.Timeout(self.task.timeout / 1000),
-        )
-
-        self.log(f"loop stream start")
-        for update in response:
-
-            if update.choices:
-                self.request.chunks_count += 1
-
-                last_token_latency_ms = None
-                if not self.request.first_token_latency_ms:
-                    self.request.first_token_latency_ms = so_far_ms(
-                        self.request.start_req_time
-                    )
-                    last_token_latency_ms = 0
-                    self.last_token_time = time_now()
-                else:
-                    last_token_latency_ms = so_far_ms(self.last_token_time)
-                    self.last_token_time = time_now()
+        client = get_foundry_client(self.task)
 
-                content = update.choices[0].delta.content
+        try:
+            self.log(f"client request start")
+            response = client.complete(
+                stream=True,
+                messages=self.task.messages_loads,
+                max_tokens=self.task.max_tokens,
+                model=self.task.model_id,
+                temperature=self.task.temperature,
+                timeout=httpx.Timeout(self.task.timeout / 1000),
+            )
 
-                token_len = 0
-                characters_len = 0
+            self.log(f"loop stream start")
+            for update in response:
+                self.record_openai_usage(getattr(update, "usage", None))
+                if update.choices:
+                    self.record_chunk(update.choices[0].delta.content)
 
-                if content:
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                client.close()
 
-                    logger.info(content)
+    def request_aoai(self):
+        self.log(f"client init start")
+        client = get_aoai_client(self.task)
 
-                    self.request.response += content
-                    token_len = self.encode(content)
-                    characters_len = len(content)
+        try:
+            self.log(f"client request start")
+            response = None
+
+            if self.task.model_id in ["o3-mini", "o1-mini", "o1"]:
+                response = client.chat.completions.create(
+                    messages=self.task.messages_loads,
+                    model=self.task.model_id,
+                    stream=self.stream,
+                    max_completion_tokens=self.task.max_tokens,
+                    **self.usage_options(),
+                )
+            else:
+                response = client.chat.completions.create(
+                    messages=self.task.messages_loads,
+                    model=self.task.model_id,
+                    stream=self.stream,
+                    temperature=self.task.temperature,
+                    max_tokens=self.task.max_tokens,
+                    **self.usage_options(),
+                )
 
-                    self.request.output_token_count += token_len
+            self.log(f"loop stream start")
+            if not self.stream:
+                self.record_response(response.choices[0].message.content)
+                self.record_openai_usage(response.usage)
 
-                task_chunk = self.Chunks(
-                    id=f"{self.request.id}{pad_number(self.request.chunks_count, 1000000)}",
-                    chunk_index=self.request.chunks_count,
-                    thread_num=self.thread_num,
-                    task_id=self.task.id,
-                    request_id=self.request.id,
-                    token_len=token_len,
-                    characters_len=characters_len,
-                    created_at=time_now(),
-                    chunk_content=content,
-                    request_latency_ms=so_far_ms(self.request.start_req_time),
-                    last_token_latency_ms=last_token_latency_ms,
-                )
+            if self.stream:
+                for chunk in response:
+                    self.record_openai_usage(chunk.usage)
+                    if len(chunk.choices) == 0:
+                        continue
 
-                self.cache.chunk_enqueue(task_chunk)
+                    self.record_chunk(chunk.choices[0].delta.content)
 
-        self.log(f"loop stream end")
-        client.close()
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                client.close()
 
-    def request_aoai(self):
+    def request_api(self):
         self.log(f"client init start")
-        client = AzureOpenAI(
-            api_version=self.task.api_version,
-            azure_endpoint=self.task.azure_endpoint,
-            azure_deployment=self.task.deployment_name,
-            api_key=self.task.api_key,
-            timeout=httpx.Timeout(self.task.timeout / 1000),
-        )
 
-        self.log(f"client request start")
-        response = None
+        client = get_api_client(self.task)
 
-        if self.task.model_id in ["o3-mini", "o1-mini", "o1"]:
+        try:
+            self.log(f"client request start")
             response = client.chat.completions.create(
-                messages=self.task.messages_loads,
                 model=self.task.model_id,
-                stream=self.stream,
-                max_completion_tokens=self.task.max_tokens,
-            )
-        else:
-            response = client.chat.completions.create(
                 messages=self.task.messages_loads,
-                model=self.task.model_id,
-                stream=self.stream,
                 temperature=self.task.temperature,
                 max_tokens=self.task.max_tokens,
+                stream=True,
+                **self.usage_options(),
             )
 
-        self.log(f"loop stream start")
-        if not self.stream:
-            self.request.response = response.choices[0].message.content
-
-            self.request.first_token_latency_ms = so_far_ms(self.request.start_req_time)
+            self.log(f"loop stream start")
+            if self.stream:
+                for chunk in response:
+                    self.record_openai_usage(chunk.usage)
+                    if len(chunk.choices) == 0:
+                        continue
 
-            self.request.request_latency_ms = so_far_ms(self.request.start_req_time)
+                    self.record_chunk(chunk.choices[0].delta.content)
 
-            self.request.chunks_count = 1
-
-            self.request.output_token_count = self.encode(self.request.response)
-
-        if self.stream:
-            for chunk in response:
-                if len(chunk.choices) == 0:
-                    continue
-
-                self.request.chunks_count += 1
-                content = chunk.choices[0].delta.content
-
-                last_token_latency_ms = None
-                if not self.request.first_token_latency_ms:
-                    self.request.first_token_latency_ms = so_far_ms(
-                        self.request.start_req_time
-                    )
-                    last_token_latency_ms = 0
-                    self.last_token_time = time_now()
-                else:
-                    last_token_latency_ms = so_far_ms(self.last_token_time)
-                    self.last_token_time = time_now()
-
-                token_len = 0
-                characters_len = 0
-                if content:
-                    # logger.info(content)
-
-                    self.request.response += content
-
-                    token_len = self.encode(content)
-                    characters_len = len(content)
-
-                    self.request.output_token_count += token_len
-
-                task_chunk = self.Chunks(
-                    id=f"{self.request.id}{pad_number(self.request.chunks_count, 1000000)}",
-                    chunk_index=self.request.chunks_count,
-                    thread_num=self.thread_num,
-                    task_id=self.task.id,
-                    request_id=self.request.id,
-                    token_len=token_len,
-                    characters_len=characters_len,
-                    created_at=time_now(),
-                    chunk_content=content,
-                    last_token_latency_ms=last_token_latency_ms,
-                    request_latency_ms=so_far_ms(self.request.start_req_time),
-                )
-
-                self.cache.chunk_enqueue(task_chunk)
-
-        self.log(f"loop stream end")
-        client.close()
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                client.close()
 
-    def request_api(self):
+    def request_sse(self):
         self.log(f"client init start")
 
-        client = openai.Client(
-            base_url=self.task.azure_endpoint, api_key=self.task.api_key
-        )
-
-        self.log(f"client request start")
-        response = client.chat.completions.create(
-            model=self.task.model_id,
-            messages=self.task.messages_loads,
-            temperature=self.task.temperature,
-            max_tokens=self.task.max_tokens,
-            stream=True,
-        )
+        client = get_http_client(self.task)
 
-        self.log(f"loop stream start")
-        if self.stream:
-            for chunk in response:
-                if len(chunk.choices) == 0:
-                    continue
-
-                self.request.chunks_count += 1
-                content = chunk.choices[0].delta.content
-
-                last_token_latency_ms = None
-                if not self.request.first_token_latency_ms:
-                    self.request.first_token_latency_ms = so_far_ms(
-                        self.request.start_req_time
-                    )
-                    last_token_latency_ms = 0
-                    self.last_token_time = time_now()
+        try:
+            self.log(f"client request start")
+            with client.stream(
+                "POST",
+                request_url(self.task),
+                content=request_body(self.task),
+                headers=request_headers(self.task),
+            ) as response:
+                if response.status_code >= 400:
+                    response.read()
+                    raise Exception(f"HTTP {response.status_code}: {response.text}")
+
+                self.log(f"loop stream start")
+                if not self.stream:
+                    self.record_sse_response(response.read())
                 else:
-                    last_token_latency_ms = so_far_ms(self.last_token_time)
-                    self.last_token_time = time_now()
-
-                token_len = 0
-                characters_len = 0
-                if content:
-                    logger.info(content)
-
-                    self.request.response += content
-
-                    token_len = self.encode(content)
-                    characters_len = len(content)
-
-                    self.request.output_token_count += token_len
-
-                Chunks = create_chunk_table_class(self.task.id)
-
-                task_chunk = Chunks(
-                    id=f"{self.request.id}{pad_number(self.request.chunks_count, 1000000)}",
-                    chunk_index=self.request.chunks_count,
-                    thread_num=self.thread_num,
-                    task_id=self.task.id,
-                    request_id=self.request.id,
-                    token_len=token_len,
-                    characters_len=characters_len,
-                    created_at=time_now(),
-                    chunk_content=content,
-                    last_token_latency_ms=last_token_latency_ms,
-                    request_latency_ms=so_far_ms(self.request.start_req_time),
-                )
+                    parser = SSEParser()
+                    for data in response.iter_bytes():
+                        for frame in parser.feed(data, time.perf_counter_ns()):
+                            self.record_sse_frame(*frame)
 
-                self.cache.chunk_enqueue(task_chunk)
-
-        self.log(f"loop stream end")
-        client.close()
+                self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                client.close()
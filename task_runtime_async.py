@@ -0,0 +1,234 @@
+import asyncio
+import time
+import traceback
+from config import (
+    MODEL_TYPE_API,
+    MODEL_TYPE_AOAI,
+    MODEL_TYPE_DS_OLLAMA,
+    MODEL_TYPE_DS_FOUNDRY,
+)
+from logger import logger
+from task_runtime import TaskRuntime
+from task_sse import SSEParser, request_body, request_headers, request_url
+from task_clients import (
+    client_aclose,
+    get_async_aoai_client,
+    get_async_api_client,
+    get_async_foundry_client,
+    get_async_http_client,
+    get_async_ollama_client,
+)
+
+
+class AsyncTaskRuntime(TaskRuntime):
+    """TaskRuntime driven by async clients, so many requests share one event loop."""
+
+    async def latency(self):
+
+        try:
+            # before the request starts, so backpressure does not count as its latency
+            await self.cache.wait_room(self.task.id)
+            self.prepare()
+
+            timeout = self.task.timeout / 1000
+
+            if self.sse:
+                await self.request_sse()
+
+            elif self.task.model_type == MODEL_TYPE_AOAI:
+                await self.request_aoai()
+
+            elif self.task.model_type == MODEL_TYPE_DS_OLLAMA:
+                await self.request_ds_ollama()
+
+            elif self.task.model_type == MODEL_TYPE_DS_FOUNDRY:
+                await asyncio.wait_for(self.request_ds_foundry(), timeout)
+
+            elif self.task.model_type == MODEL_TYPE_API:
+                await self.request_api()
+
+            else:
+                raise Exception(f"Model type {self.task.model_type} not supported")
+
+            self.complete()
+        except TimeoutError as e:
+            self.request.success = 0
+            self.request.response = f"timeout: {self.task.timeout} ms"
+            logger.error(f"Timeout Error: {e}", exc_info=True)
+        except Exception as e:
+            self.request.success = 0
+            self.request.response = traceback.format_exc()
+            logger.error(f"Error: {e}", exc_info=True)
+        finally:
+            self.request.completed_at = self.now_ms()
+            self.count_deferred_tokens()
+            self.pack_chunk_arrays()
+            self.cache.request_enqueue(self.request)
+
+    async def request_ds_ollama(self):
+        self.log(f"client init start")
+
+        client = get_async_ollama_client(self.task)
+
+        try:
+            self.log(f"client request start")
+            stream = None
+
+            if self.task.enable_think:
+                stream = await client.chat(
+                    model=self.task.model_id,
+                    messages=self.task.messages_loads,
+                    stream=True,
+                    options={"temperature": self.task.temperature},
+                    max_tokens=self.task.max_tokens,
+                )
+            else:
+                stream = await client.chat(
+                    model=self.task.model_id,
+                    messages=self.task.messages_loads,
+                    stream=True,
+                    format="json",
+                    options={"temperature": self.task.temperature},
+                    max_tokens=self.task.max_tokens,
+                )
+
+            self.log(f"loop stream start")
+            async for chunk in stream:
+                self.record_chunk(chunk["message"]["content"])
+                self.record_ollama_usage(chunk)
+
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                await client_aclose(client)
+
+    async def request_ds_foundry(self):
+        self.log(f"client init start")
+
+        client = get_async_foundry_client(self.task)
+
+        try:
+            self.log(f"client request start")
+            response = await client.complete(
+                stream=True,
+                messages=self.task.messages_loads,
+                max_tokens=self.task.max_tokens,
+                model=self.task.model_id,
+                temperature=self.task.temperature,
+            )
+
+            self.log(f"loop stream start")
+            async for update in response:
+                self.record_openai_usage(getattr(update, "usage", None))
+                if update.choices:
+                    self.record_chunk(update.choices[0].delta.content)
+
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                await client.close()
+
+    async def request_aoai(self):
+        self.log(f"client init start")
+        client = get_async_aoai_client(self.task)
+
+        try:
+            self.log(f"client request start")
+            response = None
+
+            if self.task.model_id in ["o3-mini", "o1-mini", "o1"]:
+                response = await client.chat.completions.create(
+                    messages=self.task.messages_loads,
+                    model=self.task.model_id,
+                    stream=self.stream,
+                    max_completion_tokens=self.task.max_tokens,
+                    **self.usage_options(),
+                )
+            else:
+                response = await client.chat.completions.create(
+                    messages=self.task.messages_loads,
+                    model=self.task.model_id,
+                    stream=self.stream,
+                    temperature=self.task.temperature,
+                    max_tokens=self.task.max_tokens,
+                    **self.usage_options(),
+                )
+
+            self.log(f"loop stream start")
+            if not self.stream:
+                self.record_response(response.choices[0].message.content)
+                self.record_openai_usage(response.usage)
+
+            if self.stream:
+                async for chunk in response:
+                    self.record_openai_usage(chunk.usage)
+                    if len(chunk.choices) == 0:
+                        continue
+
+                    self.record_chunk(chunk.choices[0].delta.content)
+
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                await client.close()
+
+    async def request_api(self):
+        self.log(f"client init start")
+
+        client = get_async_api_client(self.task)
+
+        try:
+            self.log(f"client request start")
+            response = await client.chat.completions.create(
+                model=self.task.model_id,
+                messages=self.task.messages_loads,
+                temperature=self.task.temperature,
+                max_tokens=self.task.max_tokens,
+                stream=True,
+                **self.usage_options(),
+            )
+
+            self.log(f"loop stream start")
+            if self.stream:
+                async for chunk in response:
+                    self.record_openai_usage(chunk.usage)
+                    if len(chunk.choices) == 0:
+                        continue
+
+                    self.record_chunk(chunk.choices[0].delta.content)
+
+            self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                await client.close()
+
+    async def request_sse(self):
+        self.log(f"client init start")
+
+        client = get_async_http_client(self.task)
+
+        try:
+            self.log(f"client request start")
+            async with client.stream(
+                "POST",
+                request_url(self.task),
+                content=request_body(self.task),
+                headers=request_headers(self.task),
+            ) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    raise Exception(f"HTTP {response.status_code}: {response.text}")
+
+                self.log(f"loop stream start")
+                if not self.stream:
+                    self.record_sse_response(await response.aread())
+                else:
+                    parser = SSEParser()
+                    async for data in response.aiter_bytes():
+                        for frame in parser.feed(data, time.perf_counter_ns()):
+                            self.record_sse_frame(*frame)
+
+                self.log(f"loop stream end")
+        finally:
+            if not self.warm:
+                await client.aclose()
@@ -0,0 +1,159 @@
+"""Arrival schedules for open-loop tasks and concurrency schedules for load profiles."""
+
+import math
+import random
+import re
+from tables import Tasks
+from config import ARRIVAL_BURSTY, ARRIVAL_POISSON
+
+
+def arrival_offsets(
+    distribution: str, rate: float, count: int, burst_size: int = 1, seed=None
+):
+    """Calculate when each request of an open-loop task should be sent.
+
+    Args:
+        distribution: One of ARRIVAL_DISTRIBUTIONS
+        rate: Target arrival rate in requests per second
+        count: Number of requests to schedule
+        burst_size: Requests sent together in one burst, for ARRIVAL_BURSTY
+        seed: Optional seed for the Poisson generator
+
+    Returns:
+        list: Send offsets in seconds from the start of the task, ascending
+    """
+    if not rate or rate <= 0:
+        raise ValueError("Arrival rate must be greater than 0")
+
+    if distribution == ARRIVAL_POISSON:
+        rng = random.Random(seed)
+        offsets = []
+        offset = 0.0
+        for _ in range(count):
+            offsets.append(offset)
+            offset += rng.expovariate(rate)
+        return offsets
+
+    if distribution == ARRIVAL_BURSTY:
+        burst_size = max(1, burst_size or 1)
+        interval = burst_size / rate
+        return [(index // burst_size) * interval for index in range(count)]
+
+    return [index / rate for index in range(count)]
+
+
+def request_slot(task: Tasks, index: int):
+    """Map the n-th scheduled request of a task to its (thread_num, request_index)."""
+    return index % task.threads + 1, index // task.threads + 1
+
+
+def shard_slots(slots: range, shards: int):
+    """Split a range of thread_num values into at most shards contiguous ranges."""
+    size, extra = divmod(len(slots), shards)
+    ranges = []
+    start = slots.start
+    for index in range(shards):
+        stop = start + size + (1 if index < extra else 0)
+        if stop > start:
+            ranges.append(range(start, stop))
+        start = stop
+    return ranges
+
+
+def profile_phases(profile: list):
+    """Validate a load profile and fill in default phase names.
+
+    Args:
+        profile: List of phases, each with duration (seconds), from and to (concurrency)
+
+    Returns:
+        list: Phases as dicts with name, duration, from and to
+    """
+    if not isinstance(profile, list) or len(profile) == 0:
+        raise ValueError("Load profile must be a non-empty list of phases")
+
+    phases = []
+    for index, phase in enumerate(profile):
+        if not isinstance(phase, dict):
+            raise ValueError(f"Phase {index + 1} must be an object")
+
+        name = str(phase.get("name") or f"phase {index + 1}")
+        if not re.match(r"^[A-Za-z0-9 _.-]{1,64}$", name):
+            raise ValueError(f"Phase name {name} must match [A-Za-z0-9 _.-]{{1,64}}")
+
+        duration = float(phase.get("duration", 0))
+        concurrency_from = int(phase.get("from", 0))
+        concurrency_to = int(phase.get("to", concurrency_from))
+
+        if duration <= 0:
+            raise ValueError(f"Phase {name} duration must be greater than 0")
+        if concurrency_from < 0 or concurrency_to < 0:
+            raise ValueError(f"Phase {name} concurrency must not be negative")
+
+        phases.append(
+            {
+                "name": name,
+                "duration": duration,
+                "from": concurrency_from,
+                "to": concurrency_to,
+            }
+        )
+
+    return phases
+
+
+def profile_max_concurrency(phases: list) -> int:
+    return max(max(phase["from"], phase["to"]) for phase in phases)
+
+
+def profile_target(phases: list, elapsed: float):
+    """Return (phase name, concurrency) at elapsed seconds, (None, 0) once the profile ended.
+
+    phases come from profile_phases, validated once rather than on every call.
+    """
+    phase_start = 0.0
+    for phase in phases:
+        phase_end = phase_start + phase["duration"]
+        if elapsed < phase_end:
+            progress = (elapsed - phase_start) / phase["duration"]
+            concurrency = phase["from"] + (phase["to"] - phase["from"]) * progress
+            return phase["name"], math.floor(concurrency)
+        phase_start = phase_end
+
+    return None, 0
+
+
+def slot_activation(phases: list, thread_num: int, elapsed: float):
+    """Return the first time, at or after elapsed seconds, when the slot is active.
+
+    Slot thread_num is active while the concurrency of the phases, from profile_phases,
+    is at least thread_num.
+
+    Returns:
+        float: Seconds from the start of the profile, None if the slot never runs again
+    """
+    phase_start = 0.0
+    for phase in phases:
+        duration = phase["duration"]
+        phase_end = phase_start + duration
+        concurrency_from, concurrency_to = phase["from"], phase["to"]
+
+        if elapsed < phase_end and max(concurrency_from, concurrency_to) >= thread_num:
+            if concurrency_from >= thread_num and concurrency_to >= thread_num:
+                return max(elapsed, phase_start)
+
+            # linear ramp, find where it crosses thread_num
+            crossing = phase_start + duration * (thread_num - concurrency_from) / (
+                concurrency_to - concurrency_from
+            )
+
+            # a ramp reaching thread_num only at its end leaves the slot to the next phase
+            if concurrency_to > concurrency_from:
+                if crossing < phase_end:
+                    return max(elapsed, crossing)
+            elif elapsed <= crossing:
+                return max(elapsed, phase_start)
+
+        phase_start = phase_end
+
+    return None
@@ -0,0 +1,144 @@
+"""Segment files holding the queue records of a task whose Redis queues are full.
+
+A producer appends msgpack [kind, payload] pairs to an open segment, and seals it by
+renaming it once it holds SPILL_SEGMENT_RECORDS records or the producer closes. A queue
+worker claims a sealed segment by renaming it, stores its records and deletes it.
+"""
+
+import os
+import time
+import uuid
+import msgpack
+from config import SPILL_DIR, SPILL_SEGMENT_RECORDS
+
+SEGMENT_OPEN = ".open"
+SEGMENT_SEALED = ".seg"
+SEGMENT_CLAIMED = ".claimed"
+
+
+def task_spill_dir(task_id: int) -> str:
+    return os.path.join(SPILL_DIR, f"task_{task_id}")
+
+
+def task_segments(task_id: int, suffix: str = None) -> list:
+    """Return the segment paths of a task, oldest first, only those with the suffix if given."""
+    directory = task_spill_dir(task_id)
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if suffix is None or name.endswith(suffix)
+    )
+
+
+def spill_backlog(task_id: int) -> tuple:
+    """Return the segments of a task not stored yet and their size in bytes."""
+    segments = task_segments(task_id)
+    size = 0
+    for path in segments:
+        try:
+            size += os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+    return len(segments), size
+
+
+def segment_path(path: str, suffix: str) -> str:
+    """Return the path of the same segment with another suffix, the claiming owner dropped."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, name.split(".", 1)[0] + suffix)
+
+
+class SpillWriter:
+    """Appends the spilled records of one task to its open segment."""
+
+    def __init__(self, task_id: int):
+        self.task_id = task_id
+        self.file = None
+        self.path = None
+        self.records = 0
+
+    def write(self, records: list) -> int:
+        """Append (kind, payload) records to the open segment.
+
+        Returns:
+            int: Bytes written
+        """
+        if self.file is None:
+            directory = task_spill_dir(self.task_id)
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(
+                directory, f"{time.time_ns()}-{uuid.uuid4().hex}{SEGMENT_OPEN}"
+            )
+            self.file = open(self.path, "ab")
+
+        data = b"".join(msgpack.packb([kind, payload]) for kind, payload in records)
+        self.file.write(data)
+        self.file.flush()
+
+        self.records += len(records)
+        if self.records >= SPILL_SEGMENT_RECORDS:
+            self.seal()
+        return len(data)
+
+    def seal(self):
+        """Close the open segment, so queue workers can claim it."""
+        if self.file is None:
+            return
+
+        self.file.close()
+        os.rename(self.path, segment_path(self.path, SEGMENT_SEALED))
+        self.file = None
+        self.path = None
+        self.records = 0
+
+
+def claim_segment(task_id: int, owner: str) -> str | None:
+    """Claim the oldest sealed segment of a task, None if there is none left."""
+    for path in task_segments(task_id, SEGMENT_SEALED):
+        claimed = segment_path(path, f".{owner}{SEGMENT_CLAIMED}")
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            # claimed by another queue worker
+            continue
+        os.utime(claimed)
+        return claimed
+    return None
+
+
+def read_segment(path: str) -> list:
+    """Return the (kind, payload) records of a segment."""
+    with open(path, "rb") as file:
+        return [tuple(record) for record in msgpack.Unpacker(file, raw=False)]
+
+
+def release_segments(task_id: int, idle_ms: int, producing: bool):
+    """Return segments claimed by a queue worker that stopped storing them, and seal the
+    segments left open by producers that stopped before closing them.
+    """
+    now = time.time()
+    for path in task_segments(task_id, SEGMENT_CLAIMED):
+        try:
+            if (now - os.path.getmtime(path)) * 1000 >= idle_ms:
+                os.rename(path, segment_path(path, SEGMENT_SEALED))
+        except FileNotFoundError:
+            pass
+
+    if producing:
+        return
+
+    for path in task_segments(task_id, SEGMENT_OPEN):
+        try:
+            os.rename(path, segment_path(path, SEGMENT_SEALED))
+        except FileNotFoundError:
+            pass
+
+
+def remove_task_spill_dir(task_id: int):
+    try:
+        os.rmdir(task_spill_dir(task_id))
+    except OSError:
+        pass
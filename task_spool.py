@@ -0,0 +1,275 @@
+"""Arrow IPC files holding the results of a task in Spool mode, written during the run.
+
+Every process writes the chunks, logs and requests of a task to files of its own, one
+per record type, and seals them when it closes. Queue workers load the sealed files
+into the task tables once the task stopped producing, read_spool reads them memory
+mapped for analysis.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import pyarrow as pa
+from config import SPOOL_BATCH_ROWS, SPOOL_DIR, SPOOL_KEEP
+from task_spill import segment_path
+from task_wire import SCHEMA_FIELDS
+
+SPOOL_OPEN = ".open"
+SPOOL_SEALED = ".arrow"
+SPOOL_CLAIMED = ".claimed"
+SPOOL_BROKEN = ".broken"
+SPOOL_LOADED = "loaded"
+
+string_fields = {
+    "id",
+    "request_id",
+    "chunk_content",
+    "response",
+    "log_message",
+    "log_data",
+    "load_phase",
+    "token_source",
+}
+float_fields = {
+    "request_latency_ms",
+    "first_token_latency_ms",
+    "last_token_latency_ms",
+    "tpot",
+}
+binary_fields = {"chunk_arrays"}
+json_fields = {"log_data"}
+
+
+def arrow_type(field: str) -> pa.DataType:
+    if field in string_fields:
+        return pa.string()
+    if field in float_fields:
+        return pa.float64()
+    if field in binary_fields:
+        return pa.binary()
+    return pa.int64()
+
+
+def arrow_schema(schema: int) -> pa.Schema:
+    """Return the Arrow schema of a wire schema, same fields in the same order."""
+    return pa.schema([(field, arrow_type(field)) for field in SCHEMA_FIELDS[schema]])
+
+
+def task_spool_dir(task_id: int) -> str:
+    return os.path.join(SPOOL_DIR, f"task_{task_id}")
+
+
+def task_spools(task_id: int, *suffixes: str) -> list:
+    """Return the spool files of a task with one of the suffixes, oldest first."""
+    directory = task_spool_dir(task_id)
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(suffixes)
+    )
+
+
+def pending_spools(task_id: int) -> list:
+    """Return the spool files of a task not loaded yet."""
+    return task_spools(task_id, SPOOL_OPEN, SPOOL_SEALED, SPOOL_CLAIMED)
+
+
+def spool_kind(path: str) -> str:
+    """Return the record type of a spool file, the last part of its name."""
+    return os.path.basename(path).split(".", 1)[0].rsplit("-", 1)[1]
+
+
+class SpoolWriter:
+    """Writes the records of one type of one task to a spool file, a batch at a time."""
+
+    def __init__(self, task_id: int, kind: str, schema: int):
+        self.task_id = task_id
+        self.kind = kind
+        self.fields = SCHEMA_FIELDS[schema]
+        self.schema = arrow_schema(schema)
+        self.columns = [[] for _ in self.fields]
+        self.rows = 0
+        self.lock = threading.Lock()
+        self.path = None
+        self.sink = None
+        self.writer = None
+
+    def write(self, item):
+        with self.lock:
+            for field, column in zip(self.fields, self.columns):
+                value = getattr(item, field)
+                if field in json_fields and value is not None:
+                    value = json.dumps(value)
+                column.append(value)
+
+            self.rows += 1
+            if self.rows >= SPOOL_BATCH_ROWS:
+                self.write_batch()
+
+    def write_batch(self):
+        if not self.rows:
+            return
+
+        if self.writer is None:
+            directory = task_spool_dir(self.task_id)
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(
+                directory,
+                f"{time.time_ns()}-{uuid.uuid4().hex}-{self.kind}{SPOOL_OPEN}",
+            )
+            self.sink = pa.OSFile(self.path, "wb")
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+
+        self.writer.write_batch(
+            pa.record_batch(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(self.columns, self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+        self.columns = [[] for _ in self.fields]
+        self.rows = 0
+
+    def seal(self):
+        """Write the rows left and close the file, so queue workers can load it."""
+        with self.lock:
+            self.write_batch()
+            if self.writer is None:
+                return
+
+            self.writer.close()
+            self.sink.close()
+            os.rename(self.path, segment_path(self.path, SPOOL_SEALED))
+            self.writer = None
+            self.sink = None
+            self.path = None
+
+
+class TaskSpool:
+    """The spool writers of a process, one per task and record type."""
+
+    def __init__(self):
+        self.writers = {}
+        self.lock = threading.Lock()
+
+    def write(self, kind: str, schema: int, item):
+        key = (item.task_id, kind)
+        if key not in self.writers:
+            with self.lock:
+                if key not in self.writers:
+                    self.writers[key] = SpoolWriter(item.task_id, kind, schema)
+        self.writers[key].write(item)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.seal()
+
+
+def claim_spool(task_id: int, owner: str) -> str | None:
+    """Claim the oldest sealed spool file of a task, None if there is none left."""
+    for path in task_spools(task_id, SPOOL_SEALED):
+        claimed = segment_path(path, f".{owner}{SPOOL_CLAIMED}")
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            # claimed by another queue worker
+            continue
+        os.utime(claimed)
+        return claimed
+    return None
+
+
+def read_spool_file(path: str) -> pa.Table:
+    """Read a spool file memory mapped, its columns are not copied into memory."""
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def spool_rows(batch: pa.RecordBatch) -> list:
+    """Return the rows of a record batch as dicts, JSON fields decoded."""
+    rows = batch.to_pylist()
+    for row in rows:
+        for field in json_fields:
+            if row.get(field) is not None:
+                row[field] = json.loads(row[field])
+    return rows
+
+
+def finish_spool(path: str):
+    """Delete a loaded spool file, or keep it in the loaded directory with SPOOL_KEEP."""
+    if not SPOOL_KEEP:
+        os.remove(path)
+        return
+
+    directory, name = os.path.split(path)
+    loaded = os.path.join(directory, SPOOL_LOADED)
+    os.makedirs(loaded, exist_ok=True)
+    os.rename(path, os.path.join(loaded, name.split(".", 1)[0] + SPOOL_SEALED))
+
+
+def break_spool(path: str):
+    """Set aside a spool file that cannot be read, so it does not keep the task running."""
+    os.rename(path, segment_path(path, SPOOL_BROKEN))
+
+
+def release_spools(task_id: int, idle_ms: int, producing: bool):
+    """Return spool files claimed by a queue worker that stopped loading them, and set
+    aside the files left open by processes that stopped before sealing them.
+    """
+    now = time.time()
+    for path in task_spools(task_id, SPOOL_CLAIMED):
+        try:
+            if (now - os.path.getmtime(path)) * 1000 >= idle_ms:
+                os.rename(path, segment_path(path, SPOOL_SEALED))
+        except FileNotFoundError:
+            pass
+
+    if producing:
+        return
+
+    # an open file has no footer, the batches written to it cannot be read
+    for path in task_spools(task_id, SPOOL_OPEN):
+        try:
+            break_spool(path)
+        except FileNotFoundError:
+            pass
+
+
+def read_spool(task_id: int, kind: str) -> pa.Table | None:
+    """Read the records of one type of a task from its sealed and kept spool files.
+
+    Files are memory mapped, so a table larger than memory can still be sliced and scanned.
+    """
+    directory = task_spool_dir(task_id)
+    paths = task_spools(task_id, SPOOL_SEALED)
+    loaded = os.path.join(directory, SPOOL_LOADED)
+    if os.path.isdir(loaded):
+        paths += sorted(
+            os.path.join(loaded, name)
+            for name in os.listdir(loaded)
+            if name.endswith(SPOOL_SEALED)
+        )
+
+    tables = [read_spool_file(path) for path in paths if spool_kind(path) == kind]
+    if not tables:
+        return None
+    return pa.concat_tables(tables)
+
+
+def clear_task_spool(task_id: int):
+    """Delete the spool files of the task's previous run."""
+    shutil.rmtree(task_spool_dir(task_id), ignore_errors=True)
+
+
+def remove_task_spool_dir(task_id: int):
+    try:
+        os.rmdir(task_spool_dir(task_id))
+    except OSError:
+        pass
@@ -0,0 +1,106 @@
+"""Chat completions over plain HTTP, reading SSE frames without building SDK objects."""
+
+import json
+from tables import Tasks
+from config import (
+    MODEL_TYPE_AOAI,
+    NOT_SUPPORT_STREAM_MODELS,
+    TOKEN_COUNTING_SERVER,
+    TRANSPORT_SSE,
+    TRANSPORT_SSE_MODEL_TYPES,
+)
+
+request_bodies = {}
+
+
+def uses_sse(task: Tasks) -> bool:
+    return (
+        task.transport == TRANSPORT_SSE and task.model_type in TRANSPORT_SSE_MODEL_TYPES
+    )
+
+
+def request_url(task: Tasks) -> str:
+    endpoint = task.azure_endpoint.rstrip("/")
+
+    if task.model_type == MODEL_TYPE_AOAI:
+        return f"{endpoint}/openai/deployments/{task.deployment_name}/chat/completions?api-version={task.api_version}"
+
+    return f"{endpoint}/chat/completions"
+
+
+def request_headers(task: Tasks) -> dict:
+    headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+
+    if task.model_type == MODEL_TYPE_AOAI:
+        headers["api-key"] = task.api_key
+    else:
+        headers["Authorization"] = f"Bearer {task.api_key}"
+
+    return headers
+
+
+def request_body(task: Tasks) -> bytes:
+    """Serialize the request body once per task, every request of the task sends the same one."""
+    key = (task.id, task.updated_at)
+    if key in request_bodies:
+        return request_bodies[key]
+
+    stream = task.model_id not in NOT_SUPPORT_STREAM_MODELS
+    body = {
+        "model": task.model_id,
+        "messages": task.messages_loads,
+        "stream": stream,
+    }
+
+    if task.model_type == MODEL_TYPE_AOAI and task.model_id in [
+        "o3-mini",
+        "o1-mini",
+        "o1",
+    ]:
+        body["max_completion_tokens"] = task.max_tokens
+    else:
+        body["temperature"] = task.temperature
+        body["max_tokens"] = task.max_tokens
+
+    if stream and task.token_counting == TOKEN_COUNTING_SERVER:
+        body["stream_options"] = {"include_usage": True}
+
+    request_bodies[key] = json.dumps(body).encode()
+    return request_bodies[key]
+
+
+def usage_fields(usage: dict) -> dict:
+    """Map an OpenAI usage object to the keyword arguments of TaskRuntime.record_usage."""
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "cached_tokens": (usage.get("prompt_tokens_details") or {}).get(
+            "cached_tokens"
+        ),
+        "reasoning_tokens": (usage.get("completion_tokens_details") or {}).get(
+            "reasoning_tokens"
+        ),
+    }
+
+
+class SSEParser:
+    """Split a byte stream into the payloads of its data: lines.
+
+    Each payload carries the time its bytes were read, so parsing never delays
+    the measured token arrival.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data: bytes, arrived_ns: int):
+        """Return (arrived_ns, payload) for every complete data: line in the buffer."""
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+
+        frames = []
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line.startswith(b"data:"):
+                frames.append((arrived_ns, line[5:].strip()))
+        return frames
@@ -0,0 +1,99 @@
+"""Tokenizers shared per process, so the streaming loop never looks one up again."""
+
+from functools import lru_cache
+import tiktoken
+from tables import Tasks
+from logger import logger
+from config import MODEL_TYPE_AOAI, TOKEN_COUNTING_DEFERRED, TOKEN_COUNTING_SERVER
+
+prompt_tokens_cache = {}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_type: str, model_id: str) -> tiktoken.Encoding:
+    try:
+        if model_type == MODEL_TYPE_AOAI:
+            return tiktoken.encoding_for_model(model_id)
+        return tiktoken.encoding_for_model("gpt-4o")
+    except KeyError:
+        logger.warning(f"No tokenizer for {model_id}, using cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def task_encoding(task: Tasks) -> tiktoken.Encoding:
+    return get_encoding(task.model_type, task.model_id)
+
+
+def is_deferred(task: Tasks) -> bool:
+    return task.token_counting in (TOKEN_COUNTING_DEFERRED, TOKEN_COUNTING_SERVER)
+
+
+def uses_server_usage(task: Tasks) -> bool:
+    return task.token_counting == TOKEN_COUNTING_SERVER
+
+
+def count_tokens(task: Tasks, text: str) -> int:
+    if not text:
+        return 0
+
+    try:
+        return len(task_encoding(task).encode(text))
+    except Exception as e:
+        logger.error(f"Error encoding text: {e}")
+        return 0
+
+
+def count_tokens_batch(task: Tasks, texts: list) -> list:
+    """Count the tokens of many texts with one encode_batch call, empty texts count 0."""
+    indexes = [index for index, text in enumerate(texts) if text]
+    counts = [0] * len(texts)
+    if not indexes:
+        return counts
+
+    try:
+        encoded = task_encoding(task).encode_batch([texts[index] for index in indexes])
+    except Exception as e:
+        logger.error(f"Error encoding texts: {e}")
+        return counts
+
+    for index, tokens in zip(indexes, encoded):
+        counts[index] = len(tokens)
+    return counts
+
+
+def prompt_tokens(task: Tasks) -> int:
+    """Count the prompt tokens of a task once, every request of the task sends the same messages."""
+    key = (task.id, task.updated_at, task.model_type, task.model_id)
+    if key in prompt_tokens_cache:
+        return prompt_tokens_cache[key]
+
+    tokens_per_message = 3
+    num_tokens = 0
+    for message in task.messages:
+        num_tokens += tokens_per_message
+        for value in message.values():
+            if value:
+                num_tokens += count_tokens(task, value)
+    num_tokens += 3
+
+    prompt_tokens_cache[key] = num_tokens
+    return num_tokens
+
+
+def split_tokens(total: int, texts: list) -> list:
+    """Spread a server-reported token total over chunks in proportion to their length."""
+    lengths = [len(text) if text else 0 for text in texts]
+    characters = sum(lengths)
+    if not characters:
+        return [0] * len(texts)
+
+    shares = [total * length / characters for length in lengths]
+    counts = [int(share) for share in shares]
+    remainders = sorted(
+        range(len(shares)),
+        key=lambda index: shares[index] - counts[index],
+        reverse=True,
+    )
+    for index in remainders[: total - sum(counts)]:
+        counts[index] += 1
+    return counts
@@ -0,0 +1,92 @@
+"""Compact encoding of the chunk, log and request records that travel through Redis.
+
+A record is a msgpack array of a schema id followed by its values, in the order of
+the schema's fields, so field names are not repeated in every record. A new schema
+id is added whenever the fields of a record type change, older ids stay decodable
+while their records may still be queued.
+"""
+
+import json
+import msgpack
+
+SCHEMA_CHUNK_V1 = 1
+SCHEMA_LOG_V1 = 2
+SCHEMA_REQUEST_V1 = 3
+SCHEMA_REQUEST_V2 = 4
+
+SCHEMA_FIELDS = {
+    SCHEMA_CHUNK_V1: (
+        "id",
+        "task_id",
+        "request_id",
+        "chunk_index",
+        "thread_num",
+        "chunk_content",
+        "token_len",
+        "characters_len",
+        "request_latency_ms",
+        "tpot",
+        "last_token_latency_ms",
+        "created_at",
+        "created_at_us",
+    ),
+    SCHEMA_LOG_V1: (
+        "id",
+        "task_id",
+        "thread_num",
+        "request_id",
+        "log_message",
+        "log_data",
+        "created_at",
+    ),
+    SCHEMA_REQUEST_V1: (
+        "id",
+        "task_id",
+        "user_id",
+        "thread_num",
+        "input_token_count",
+        "output_token_count",
+        "response",
+        "chunks_count",
+        "first_token_latency_ms",
+        "last_token_latency_ms",
+        "request_index",
+        "request_latency_ms",
+        "success",
+        "end_req_time",
+        "start_req_time",
+        "scheduled_req_time",
+        "load_phase",
+        "cached_token_count",
+        "reasoning_token_count",
+        "token_source",
+        "created_at",
+        "completed_at",
+    ),
+}
+# requests carry the packed chunk arrays of their task's Packed chunk storage
+SCHEMA_FIELDS[SCHEMA_REQUEST_V2] = SCHEMA_FIELDS[SCHEMA_REQUEST_V1] + ("chunk_arrays",)
+
+# schema used to encode each record type
+SCHEMA_CHUNK = SCHEMA_CHUNK_V1
+SCHEMA_LOG = SCHEMA_LOG_V1
+SCHEMA_REQUEST = SCHEMA_REQUEST_V2
+
+
+def encode(schema: int, record) -> bytes:
+    """Encode a record, any object with the schema's fields as attributes."""
+    return msgpack.packb(
+        [schema, *[getattr(record, field) for field in SCHEMA_FIELDS[schema]]]
+    )
+
+
+def decode(payload: bytes) -> dict:
+    """Decode a record to a dict of its fields, also accepts the JSON records queued before."""
+    if payload[:1] == b"{":
+        return json.loads(payload)
+
+    schema, *values = msgpack.unpackb(payload)
+    if schema not in SCHEMA_FIELDS:
+        raise ValueError(f"Unknown wire schema {schema}")
+
+    return dict(zip(SCHEMA_FIELDS[schema], values))
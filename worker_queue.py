@@ -1,94 +1,352 @@
-from time import sleep
-from helper import get_mysql_session
+import os
+import socket
+import time
+import pyarrow as pa
+import task_wire
+from helper import get_mysql_session, pool_status
 from logger import logger
-from tables import Tasks
+from tables import (
+    Chunks,
+    Logs,
+    Requests,
+    Tasks,
+    upgrade_tables,
+)
 from theodoretools.bot import feishu_text
-from config import APP_URL
-import copy
-from sqlalchemy import update
+from task_spill import claim_segment, read_segment, release_segments
+from task_spool import (
+    break_spool,
+    claim_spool,
+    finish_spool,
+    read_spool_file,
+    release_spools,
+    spool_kind,
+    spool_rows,
+)
+from config import (
+    APP_URL,
+    INGEST_BATCH_SIZE,
+    INGEST_CONSUMER_IDLE_MS,
+    INGEST_DRAIN_INTERVAL,
+    INGEST_FLUSH_MS,
+    INGEST_RATE_INTERVAL,
+    INGEST_RECLAIM_IDLE_MS,
+    INGEST_RECLAIM_INTERVAL,
+    TASK_COUNTS_FLUSH_MS,
+)
+from sqlalchemy import case, func, insert, update
 from sqlalchemy.orm.session import Session
-from task_cache import TaskCache
+from task_cache import (
+    QUEUE_CHUNKS,
+    QUEUE_LOGS,
+    QUEUE_REQUESTS,
+    TaskCache,
+    queue_kinds,
+)
 
 
-def check_status(db: Session, task_id: int):
-    task = db.query(Tasks).filter(Tasks.id == task_id).first()
+def task_counts(cache: TaskCache, task_id: int) -> dict:
+    """Return the task columns kept in Redis while the task runs."""
+    succeed, failed = cache.request_counts(task_id)
+    return {
+        "request_succeed": succeed,
+        "request_failed": failed,
+        "queue_stats": cache.overflow_stats(task_id) or None,
+    }
+
 
-    target_requests = task.request_per_thread * task.threads
-    total_requested = task.request_succeed + task.request_failed
+def flush_counts(db: Session, cache: TaskCache, task_id: int):
+    """Write the task counters kept in Redis to the task."""
+    db.execute(
+        update(Tasks).where(Tasks.id == task_id).values(**task_counts(cache, task_id))
+    )
+    db.commit()
 
-    if task.request_failed == target_requests:
-        db.execute(
-            update(Tasks)
-            .where(Tasks.id == task_id)
-            .values(status=3, error_message="All requests failed")
+
+def stored_request_counts(db: Session, task_id: int) -> tuple:
+    """Return the (succeed, failed) requests of the task committed to the database."""
+    total, succeed = (
+        db.query(
+            func.count(),
+            func.coalesce(func.sum(case((Requests.success == 1, 1), else_=0)), 0),
         )
-        db.commit()
+        .filter(Requests.task_id == task_id)
+        .one()
+    )
+    return int(succeed), int(total) - int(succeed)
+
+
+def check_status(db: Session, cache: TaskCache, task_id: int):
+    """Complete the task once all its requests are stored.
+
+    Completion counts the committed request rows, the Redis counters only show
+    progress: a worker stopping between its commit and counting leaves them short,
+    and the entries it stored are skipped by INSERT IGNORE when they are reclaimed.
+
+    Only the worker whose update moves the task out of running sends the message,
+    so a task drained by several workers at once completes once.
+    """
+    task = db.query(Tasks).filter(Tasks.id == task_id).first()
 
-        if task.feishu_token:
-            feishu_text(
-                f"All requests failed task: {task.name}: {APP_URL}/?task_id={task.id}",
-                task.feishu_token,
-            )
+    if task.status in (3, 4):
         return
 
-    if total_requested == target_requests:
-        db.execute(
-            update(Tasks).where(Tasks.id == task_id).values(status=4, error_message="")
-        )
+    target_requests = task.request_target
+    if target_requests is None:
+        return
+
+    # chunks and logs of the last requests may still be on their way
+    if not cache.task_drained(task_id):
+        return
+
+    succeed, failed = stored_request_counts(db, task_id)
+    values = task_counts(cache, task_id)
+    values.update(request_succeed=succeed, request_failed=failed)
+
+    if failed == target_requests:
+        values.update(status=3, error_message="All requests failed")
+        message = f"All requests failed task: {task.name}: {APP_URL}/?task_id={task.id}"
+    elif succeed + failed == target_requests:
+        values.update(status=4, error_message="")
+        message = f"Task {task.name} succeed: {APP_URL}/?task_id={task.id}"
+    else:
+        db.execute(update(Tasks).where(Tasks.id == task_id).values(**values))
         db.commit()
-        if task.feishu_token:
-            feishu_text(
-                f"Task {task.name} succeed: {APP_URL}/?task_id={task.id}",
-                task.feishu_token,
-            )
         return
 
+    result = db.execute(
+        update(Tasks)
+        .where(Tasks.id == task_id, Tasks.status.notin_([3, 4]))
+        .values(**values)
+    )
+    db.commit()
+
+    if result.rowcount == 1 and task.feishu_token:
+        feishu_text(message, task.feishu_token)
+
+
+def insert_rows(db: Session, table_class, rows: list) -> dict:
+    """Insert rows into a result table, one executemany per task.
+
+    Rows stored before, by a worker that stopped before acknowledging them, are skipped.
+
+    Returns:
+        dict: Number of rows inserted per task id
+    """
+    tasks_rows = {}
+    for row in rows:
+        tasks_rows.setdefault(row["task_id"], []).append(row)
+
+    inserted = {}
+    for task_id, task_rows in tasks_rows.items():
+        result = db.execute(
+            insert(table_class.__table__)
+            .prefix_with("IGNORE", dialect="mysql")
+            .prefix_with("OR IGNORE", dialect="sqlite"),
+            task_rows,
+        )
+        inserted[task_id] = result.rowcount
+    return inserted
+
+
+def store_requests(db: Session, requests: list) -> dict:
+    """Insert requests and count the newly stored ones.
+
+    Returns:
+        dict: (succeed, failed) requests stored per task id
+    """
+    succeed = insert_rows(
+        db,
+        Requests,
+        [request for request in requests if request["success"] == 1],
+    )
+    failed = insert_rows(
+        db,
+        Requests,
+        [request for request in requests if request["success"] != 1],
+    )
+
+    return {
+        task_id: (succeed.get(task_id, 0), failed.get(task_id, 0))
+        for task_id in set(succeed) | set(failed)
+    }
+
+
+def write_batch(db: Session, cache: TaskCache, entries: list):
+    """Store queue entries in one transaction, chunks and logs before the requests they belong to.
+
+    The stored requests are added to the task counters in Redis once committed.
+    """
+    rows = {kind: [] for kind in queue_kinds}
+    for kind, _, _, row in entries:
+        rows[kind].append(row)
+
+    try:
+        insert_rows(db, Chunks, rows[QUEUE_CHUNKS])
+        insert_rows(db, Logs, rows[QUEUE_LOGS])
+        counts = store_requests(db, rows[QUEUE_REQUESTS])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    cache.count_requests(counts)
+
+
+def ingest(db: Session, cache: TaskCache, entries: list) -> int:
+    """Store queue entries in MySQL, then acknowledge them.
+
+    When the batch insert fails, the entries are stored one by one. An entry that
+    still fails stays pending, so it is claimed and retried later.
+
+    Returns:
+        int: Number of entries stored
+    """
+    if not entries:
+        return 0
+
+    try:
+        write_batch(db, cache, entries)
+        stored = entries
+    except Exception as e:
+        logger.error(
+            f"Batch of {len(entries)} entries failed, storing them one by one: {e}"
+        )
+        stored = []
+        for entry in entries:
+            try:
+                write_batch(db, cache, [entry])
+                stored.append(entry)
+            except Exception as e:
+                logger.error(f"Entry {entry[2]} of {entry[1]} not stored: {e}")
+
+    cache.ack_queues(stored)
+    return len(stored)
+
+
+def drain_spills(db: Session, cache: TaskCache, owner: str) -> int:
+    """Store one spilled segment of every active task that has one.
+
+    A segment that fails stays claimed, and is returned to the others once
+    release_spills finds it idle.
+
+    Returns:
+        int: Number of records stored
+    """
+    stored = 0
+    for task_id in cache.active_tasks():
+        path = claim_segment(task_id, owner)
+        if path is None:
+            continue
+
+        entries = [
+            (kind, path, index, task_wire.decode(payload))
+            for index, (kind, payload) in enumerate(read_segment(path))
+        ]
+        for start in range(0, len(entries), INGEST_BATCH_SIZE):
+            write_batch(db, cache, entries[start : start + INGEST_BATCH_SIZE])
+
+        os.remove(path)
+        stored += len(entries)
+    return stored
+
+
+def load_spools(db: Session, cache: TaskCache, owner: str) -> int:
+    """Load one spool file of every active task that stopped producing.
+
+    Returns:
+        int: Number of records stored
+    """
+    stored = 0
+    for task_id in cache.active_tasks():
+        if cache.task_producing(task_id):
+            continue
+
+        path = claim_spool(task_id, owner)
+        if path is None:
+            continue
+
+        try:
+            table = read_spool_file(path)
+        except pa.ArrowInvalid as e:
+            logger.error(f"Spool file {path} not readable, set aside: {e}")
+            break_spool(path)
+            continue
+
+        kind = spool_kind(path)
+        for batch in table.to_batches(INGEST_BATCH_SIZE):
+            entries = [
+                (kind, path, index, row) for index, row in enumerate(spool_rows(batch))
+            ]
+            write_batch(db, cache, entries)
+
+        finish_spool(path)
+        stored += table.num_rows
+    return stored
+
+
+def release_spills(cache: TaskCache):
+    for task_id in cache.active_tasks():
+        producing = cache.task_producing(task_id)
+        release_segments(task_id, INGEST_RECLAIM_IDLE_MS, producing)
+        release_spools(task_id, INGEST_RECLAIM_IDLE_MS, producing)
+
+
+def close_drained_tasks(db: Session, cache: TaskCache):
+    """Close the queues of active tasks whose data is all stored, then complete the tasks.
+
+    The counters of the tasks still running are written to MySQL meanwhile.
+    """
+    for task_id in cache.active_tasks():
+        if cache.close_drained_queues(task_id):
+            check_status(db, cache, task_id)
+        elif cache.claim_counts_flush(task_id, TASK_COUNTS_FLUSH_MS):
+            flush_counts(db, cache, task_id)
+
 
 if __name__ == "__main__":
 
+    upgrade_tables()
+
+    owner = f"{socket.gethostname()}-{os.getpid()}"
     db = get_mysql_session()
     cache = TaskCache()
+    cache.move_legacy_queues()
+
+    ingested = 0
+    reported = time.perf_counter()
+    reclaimed = 0
+    drain_checked = 0
 
     while True:
 
         try:
-            chunk = cache.chunk_dequeue()
-            if chunk:
-                # logger.info(chunk.__dict__)
-                db.add(copy.deepcopy(chunk))
-                db.commit()
-
-            log = cache.log_dequeue()
-            if log:
-                # logger.info(log.__dict__)
-                db.add(copy.deepcopy(log))
-                db.commit()
-
-            request = cache.request_dequeue()
-            if request:
-                # logger.info(request.__dict__)
-                db.add(copy.deepcopy(request))
-                db.commit()
-
-                if request.success == 1:
-                    db.execute(
-                        update(Tasks)
-                        .where(Tasks.id == request.task_id)
-                        .values(request_succeed=Tasks.request_succeed + 1)
-                    )
-                    db.commit()
-                else:
-                    db.execute(
-                        update(Tasks)
-                        .where(Tasks.id == request.task_id)
-                        .values(request_failed=Tasks.request_failed + 1)
-                    )
-                    db.commit()
-
-                check_status(db, request.task_id)
-
-            if not chunk and not request:
-                sleep(1)
+            if time.perf_counter() - reclaimed >= INGEST_RECLAIM_INTERVAL:
+                if entries := cache.reclaim_queues(owner, INGEST_BATCH_SIZE):
+                    logger.warning(f"reclaimed {len(entries)} pending entries")
+                    ingested += ingest(db, cache, entries)
+                cache.remove_idle_consumers(INGEST_CONSUMER_IDLE_MS)
+                release_spills(cache)
+                reclaimed = time.perf_counter()
+
+            entries = cache.read_queues(owner, INGEST_BATCH_SIZE, INGEST_FLUSH_MS)
+            ingested += ingest(db, cache, entries)
+            ingested += drain_spills(db, cache, owner)
+            ingested += load_spools(db, cache, owner)
+
+            if time.perf_counter() - drain_checked >= INGEST_DRAIN_INTERVAL:
+                close_drained_tasks(db, cache)
+                drain_checked = time.perf_counter()
+
+            elapsed = time.perf_counter() - reported
+            if elapsed >= INGEST_RATE_INTERVAL:
+                rows_per_sec = round(ingested / elapsed, 2)
+                logger.info(
+                    f"ingested {ingested} rows, {rows_per_sec} rows/sec, lag {cache.queue_lag()}, pool {pool_status()}"
+                )
+                cache.report_ingest_rate(owner, rows_per_sec)
+                ingested = 0
+                reported = time.perf_counter()
 
         except Exception as e:
             logger.error(f"Error: {e}", exc_info=True)
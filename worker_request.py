@@ -1,26 +1,58 @@
-from time import sleep
+import os
+import socket
 import traceback
-from task_executor import task_executor
-from task_loads import error_task, run_task, task_dequeue
+from task_cache import TaskCache
+from task_executor import shard_executor, start_shards, task_executor
+from task_loads import error_task, find_task, run_task, task_dequeue
+from tables import upgrade_tables, upgrade_task_tables
 from logger import logger
+from config import TASK_EVENT_TIMEOUT
 
 if __name__ == "__main__":
 
+    upgrade_tables()
+
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    cache = TaskCache()
+
     while True:
 
         try:
             if task := task_dequeue():
+                if not run_task(task.id):
+                    continue
+
+                upgrade_task_tables(task.id)
+
                 try:
                     logger.info(f"task {task.id} start...")
-                    run_task(task.id)
 
-                    logger.info(f"start {task.id} request ...")
-                    task_executor(task)
+                    if task.shards and task.shards > 1:
+                        logger.info(f"start {task.id} shards ...")
+                        start_shards(task)
+                    else:
+                        logger.info(f"start {task.id} request ...")
+                        task_executor(task)
                 except Exception as e:
                     error_task(task, f"{traceback.format_exc()}")
                     logger.error(f"Error: {e}", exc_info=True)
+
+            elif shard := cache.claim_shard(owner):
+                task_id, shard_index, shards = shard
+                if not (task := find_task(task_id)):
+                    cache.close_shards(task_id)
+                    continue
+
+                try:
+                    logger.info(f"task {task_id} shard {shard_index} start...")
+                    shard_executor(task, shard_index, shards, owner)
+                except Exception as e:
+                    error_task(task, f"{traceback.format_exc()}")
+                    logger.error(f"Error: {e}", exc_info=True)
+
             else:
-                sleep(1)
+                cache.wait_task_event(TASK_EVENT_TIMEOUT)
 
         except Exception as e:
             logger.error(f"Error: {e}", exc_info=True)
+            cache.reset()
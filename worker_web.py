@@ -1,11 +1,11 @@
 import os
 import streamlit as st
 from dotenv import load_dotenv
-from helper import create_db
+from helper import create_db, pool_status
 from page_home import home_page
 from page_user import register_user
 from tables import create_tables, init_user
-from task_loads import get_authenticator
+from task_loads import get_authenticator, is_admin
 from config import APP_STARTED_AT, APP_VERSION
 
 load_dotenv()
@@ -60,6 +60,9 @@ if __name__ == "__main__":
             col1, col2 = st.columns([10, 2])
             with col1:
                 authenticator.logout()
+            if is_admin():
+                with st.expander("MySQL Pool"):
+                    st.json(pool_status())
             home_page()
 
     elif st.button("Initialize Database", key="init_db"):